@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 19 21:10:32 2014
+
+Benchmark of message batching between processes: throughput of a
+PUSH/PULL channel sending revision-like items one per message versus in
+batches of increasing size (see comutils.BatchSender), over loopback TCP
+and Unix domain sockets (ipc).
+
+Usage: python benchmarks/bench_batching.py [num_items] [port]
+
+@author: jfelipe
+"""
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from wikidat.utils.comutils import send_ujson, recv_ujson, BatchSender
+from wikidat.sources.processors import channel_address
+
+BATCH_SIZES = [1, 10, 100, 1000]
+# Typical revision item (metadata only) sent by XML readers
+ITEM = {'id': '123456789', 'parent_id': '123456788',
+        'timestamp': '2014-10-19T21:10:32Z',
+        'contributor': {'id': '1234', 'username': 'Example user'},
+        'comment': 'Minor edit', 'minor': '1', 'text_length': 2048,
+        'page_id': '42', 'rev_hash': '0123456789abcdef0123456789abcdef',
+        'seq': [0, 1, 2, 42]}
+
+
+def sender(address, num_items, batch_size):
+    context = zmq.Context()
+    socket = context.socket(zmq.PUSH)
+    socket.connect(address)
+    channel = BatchSender(socket, batch_size, linger=100)
+    for x in xrange(num_items):
+        channel.send(ITEM)
+    channel.flush()
+    send_ujson(socket, 'STOP')
+    socket.close(linger=-1)
+    context.term()
+
+
+def run(address, num_items, batch_size):
+    """
+    Return seconds needed to receive num_items sent in batches of
+    batch_size items by another process, through a channel bound to address
+    """
+    context = zmq.Context()
+    socket = context.socket(zmq.PULL)
+    socket.bind(address)
+    proc = mp.Process(target=sender, args=(address, num_items, batch_size))
+    start = time.time()
+    proc.start()
+    received = 0
+    while True:
+        batch = recv_ujson(socket)
+        if batch == 'STOP':
+            break
+        received += len(batch)
+    elapsed = time.time() - start
+    proc.join()
+    socket.close()
+    context.term()
+    assert received == num_items
+    return elapsed
+
+
+if __name__ == '__main__':
+    num_items = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    ipc_dir = tempfile.mkdtemp(prefix='wikidat-bench-')
+    try:
+        print "%d items" % num_items
+        for transport in ('tcp', 'ipc'):
+            address = channel_address(transport, ipc_dir) % port
+            for batch_size in BATCH_SIZES:
+                elapsed = run(address, num_items, batch_size)
+                print "%s batch_size=%-5d %8.3f s %10.0f items/s" % (
+                    transport, batch_size, elapsed, num_items / elapsed)
+    finally:
+        shutil.rmtree(ipc_dir)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 20 10:24:51 2014
+
+Benchmark of codecs for messages between processes (comutils.CODECS):
+CPU time spent on compression versus bytes saved, for batches of pages
+and revisions (full text and metadata only) parsed from the example dumps
+bundled with WikiDAT.
+
+Usage: python benchmarks/bench_codecs.py [batch_size] [min_size]
+
+@author: jfelipe
+"""
+import os
+import sys
+import ujson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from wikidat.sources.dump import DumpFile, process_xml
+from wikidat.sources.page import Page
+from wikidat.sources.records import page_record, revision_record
+from wikidat.utils.comutils import CODECS, Codec
+from bench_readers import SOURCES_DIR
+
+EXAMPLE = 'example-pages-meta-history-furwiki.xml'
+
+
+def batches(items, batch_size):
+    """
+    Return serialized batches of batch_size records, as sent by BatchSender
+    (revision text is kept inline, instead of a separate raw frame)
+    """
+    return [ujson.dumps(items[i:i+batch_size])
+            for i in range(0, len(items), batch_size)]
+
+
+if __name__ == '__main__':
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    min_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    dump_file = DumpFile(os.path.join(SOURCES_DIR, EXAMPLE))
+
+    channels = []
+    for metadata_only in (False, True):
+        pages, revs = [], []
+        for item in process_xml(dump_file=dump_file,
+                                metadata_only=metadata_only):
+            if isinstance(item, Page):
+                pages.append(page_record(item))
+            else:
+                revs.append(revision_record(item))
+        if not metadata_only:
+            channels.append(('pages', batches(pages, batch_size)))
+            channels.append(('revisions', batches(revs, batch_size)))
+        else:
+            channels.append(('revisions (metadata)',
+                             batches(revs, batch_size)))
+
+    print "%-22s %-6s %10s %10s %8s %10s %12s" % (
+        'channel', 'codec', 'bytes in', 'bytes out', 'saved', 'CPU (ms)',
+        'KB saved/ms')
+    for channel, messages in channels:
+        for name in sorted(CODECS):
+            codec = Codec(name, min_size)
+            # Repeat to get measurable CPU times on small examples
+            for num in range(10):
+                for message in messages:
+                    codec.encode(message)
+            saved = codec.bytes_in - codec.bytes_out
+            cpu_ms = codec.cpu_time * 1000
+            print "%-22s %-6s %10d %10d %7.1f%% %10.2f %12s" % (
+                channel, name, codec.bytes_in, codec.bytes_out,
+                100. * saved / codec.bytes_in, cpu_ms,
+                '%.1f' % (saved / 1024. / cpu_ms) if cpu_ms else '-')
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 24 10:21:48 2014
+
+Benchmark of the single process mode for small dump files (see
+etl.PageRevisionETL._run_inline) versus the pipeline of XML reader,
+workers and loaders in their own processes. Loaders just collect rows,
+instead of loading them in DB. Both modes must yield identical rows.
+
+Test files are built from the example dumps bundled with WikiDAT, repeating
+their pages to obtain files of increasing size.
+
+Usage: python benchmarks/bench_inline.py [rev_fan] [num_rounds]
+
+@author: jfelipe
+"""
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from wikidat.sources.dump import DumpFile, process_xml
+from wikidat.sources.page import process_pages_to_file
+from wikidat.sources.revision import process_revs_to_file
+from wikidat.sources.processors import (Producer, Processor, Consumer,
+                                        channel_address, split_records)
+from wikidat.sources.records import PageRecord, RevisionRecord
+from bench_readers import build_files
+
+EXAMPLE = 'example-pages-meta-history-furwiki.xml'
+NUM_COPIES = [1, 10, 100]
+# Language of FA/FLIST/GA patterns searched in revision text
+LANG = 'eswiki'
+
+
+def collect(items, results=None, name=None):
+    results.put((name, list(items)))
+
+
+def normalize(rows):
+    """
+    Return rows sorted, with tuples for all their values holding lists or
+    tuples (batches travel as JSON, so tuples arrive as lists)
+    """
+    return sorted(tuple(tuple(value) if isinstance(value, (list, tuple))
+                        else value for value in row) for row in rows)
+
+
+def split_users(rows):
+    """
+    Return revision rows without their users for table people (which
+    depend on the worker processing each revision), and the set of users
+    """
+    users = set(tuple(row[2]) for row in rows if row[2] is not None)
+    return normalize(row[:2] + row[3:] for row in rows), users
+
+
+def run_inline(dump_file):
+    """
+    Return (page rows, revision rows, users) of dump file, in a single
+    process
+    """
+    items = process_xml(dump_file=dump_file, chunk_num=0)
+    pages = []
+    revs, users = split_users(list(process_revs_to_file(
+        split_records(items, pages), lang=LANG)))
+    return normalize(process_pages_to_file(iter(pages))), revs, users
+
+
+def run_pipeline(dump_file, rev_fan, ipc_dir):
+    """
+    Return (page rows, revision rows, users) of dump file, with one
+    process for the XML reader, every worker and every loader
+    """
+    address = channel_address('ipc', ipc_dir)
+    results = mp.Queue()
+    reader = Producer(target=process_xml,
+                      kwargs=dict(dump_file=dump_file, chunk_num=0),
+                      page_consumers=1, rev_consumers=rev_fan,
+                      push_pages_port='pages', push_revs_port='revisions',
+                      page_batch_size=1000, page_batch_linger=100,
+                      rev_batch_size=100, rev_batch_linger=100,
+                      address=address)
+    workers = [Processor(target=process_pages_to_file, producers=1,
+                         consumers=1, pull_ports=['pages'],
+                         push_port='page_loader', batch_size=1000,
+                         batch_linger=100, address=address,
+                         record=PageRecord)]
+    for num in range(rev_fan):
+        workers.append(Processor(target=process_revs_to_file,
+                                 kwargs=dict(lang=LANG), producers=1,
+                                 consumers=1, pull_ports=['revisions'],
+                                 push_port='rev_loader', batch_size=100,
+                                 batch_linger=100, address=address,
+                                 record=RevisionRecord))
+    loaders = [Consumer(target=collect,
+                        kwargs=dict(results=results, name='pages'),
+                        producers=1, pull_port='page_loader',
+                        address=address),
+               Consumer(target=collect,
+                        kwargs=dict(results=results, name='revisions'),
+                        producers=rev_fan, pull_port='rev_loader',
+                        address=address)]
+    processes = [reader] + workers + loaders
+    for process in processes:
+        process.start()
+    rows = dict([results.get(), results.get()])
+    for process in processes:
+        process.join()
+    return (normalize(rows['pages']),) + split_users(rows['revisions'])
+
+
+def elapsed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    rev_fan = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    num_rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    tmp_dir = tempfile.mkdtemp(prefix='wikidat-bench-')
+    try:
+        print "%-10s %10s %10s %12s %12s %10s" % (
+            'copies', 'size (KB)', 'revisions', 'inline (s)',
+            'pipeline (s)', 'speedup')
+        for num_copies in NUM_COPIES:
+            copy_dir = os.path.join(tmp_dir, unicode(num_copies))
+            os.makedirs(copy_dir)
+            path = build_files(EXAMPLE, copy_dir, num_copies)[0]
+            dump_file = DumpFile(path)
+            # Check that both modes yield the same rows
+            inline_rows = run_inline(dump_file)
+            if inline_rows != run_pipeline(dump_file, rev_fan, copy_dir):
+                print "Different rows for %d copies" % num_copies
+                sys.exit(1)
+            inline = min(elapsed(run_inline, dump_file)
+                         for num in range(num_rounds))
+            pipeline = min(elapsed(run_pipeline, dump_file, rev_fan,
+                                   copy_dir)
+                           for num in range(num_rounds))
+            print "%-10d %10d %10d %12.4f %12.4f %9.2fx" % (
+                num_copies, os.path.getsize(path) / 1024,
+                len(inline_rows[1]), inline, pipeline, pipeline / inline)
+    finally:
+        shutil.rmtree(tmp_dir)
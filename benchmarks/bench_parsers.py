@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 18 17:02:38 2014
+
+Head-to-head benchmark of parser backends for dump files: lxml iterparse
+(dump.process_xml) versus expat (dump_expat.process_xml_expat). Both must
+yield identical items.
+
+Test files are built from the example dumps bundled with WikiDAT, repeating
+their pages to obtain a file of reasonable size.
+
+Usage: python benchmarks/bench_parsers.py [num_copies] [num_rounds]
+
+@author: jfelipe
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from wikidat.sources.dump import DumpFile, process_xml
+from wikidat.sources.dump_expat import process_xml_expat
+from bench_readers import EXAMPLES, build_files
+
+PARSERS = [('lxml', process_xml), ('expat', process_xml_expat)]
+
+
+def run_parser(parser, dump_file):
+    """
+    Parse all items from dump file, return (num. items, elapsed time)
+    """
+    start = time.time()
+    num_items = sum(1 for item in parser(dump_file=dump_file))
+    return num_items, time.time() - start
+
+
+if __name__ == '__main__':
+    num_copies = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    num_rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    tmp_dir = tempfile.mkdtemp(prefix='wikidat-bench-')
+    try:
+        print "%-48s %8s %10s %10s %10s" % ('file', 'items', 'lxml (s)',
+                                             'expat (s)', 'speedup')
+        for example in EXAMPLES:
+            for path in build_files(example, tmp_dir, num_copies):
+                dump_file = DumpFile(path)
+                # Check that both backends yield the same items
+                for ref, item in map(None, process_xml(dump_file),
+                                     process_xml_expat(dump_file)):
+                    if (type(ref) is not type(item) or
+                            dict(ref) != dict(item)):
+                        print "Different items:", ref, item
+                        sys.exit(1)
+                times = {}
+                for name, parser in PARSERS:
+                    times[name] = min(run_parser(parser, dump_file)[1]
+                                      for num in range(num_rounds))
+                num_items = run_parser(process_xml, dump_file)[0]
+                print "%-48s %8d %10.4f %10.4f %9.2fx" % (
+                    os.path.basename(path), num_items, times['lxml'],
+                    times['expat'], times['lxml'] / times['expat'])
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 18 12:40:05 2014
+
+Benchmark of readers for dump files: external decompression programs
+(through a shell pipe) versus in-process readers (memory map for plain XML,
+bz2/gzip/lzma decompression in Python).
+
+Test files are built from the example dumps bundled with WikiDAT, repeating
+their pages to obtain a file of reasonable size.
+
+Usage: python benchmarks/bench_readers.py [num_copies] [num_rounds]
+
+@author: jfelipe
+"""
+import bz2
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from wikidat.sources.dump import DumpFile, process_xml
+from wikidat.sources.readers import lzma
+
+EXAMPLES = ['example-pages-meta-history-furwiki.xml',
+            'example-pages-logging-simplewiki.xml']
+SOURCES_DIR = os.path.join(os.path.dirname(__file__), os.pardir,
+                           'wikidat', 'sources')
+
+
+def build_files(example, tmp_dir, num_copies):
+    """
+    Create test files (plain and compressed) from an example dump file.
+    The body of the example (everything after siteinfo) is repeated
+    num_copies times.
+    """
+    with open(os.path.join(SOURCES_DIR, example), 'rb') as fobj:
+        data = fobj.read()
+    if '</siteinfo>' in data:
+        head_end = data.index('</siteinfo>') + len('</siteinfo>\n')
+    else:
+        head_end = data.index('>', data.index('<mediawiki')) + 1
+    tail_start = data.rindex('</mediawiki>')
+    head, body, tail = data[:head_end], data[head_end:tail_start], \
+        data[tail_start:]
+
+    base = os.path.join(tmp_dir, example)
+    with open(base, 'wb') as fobj:
+        fobj.write(head)
+        for copy in range(num_copies):
+            fobj.write(body)
+        fobj.write(tail)
+
+    paths = [base]
+    with open(base, 'rb') as fin:
+        content = fin.read()
+    with open(base + '.bz2', 'wb') as fobj:
+        fobj.write(bz2.compress(content))
+    paths.append(base + '.bz2')
+    gz_file = gzip.open(base + '.gz', 'wb')
+    gz_file.write(content)
+    gz_file.close()
+    paths.append(base + '.gz')
+    if lzma is not None:
+        with open(base + '.lzma', 'wb') as fobj:
+            fobj.write(lzma.compress(content, format=lzma.FORMAT_ALONE))
+        paths.append(base + '.lzma')
+    return paths
+
+
+def read_all(dump_file):
+    """
+    Read all decompressed data from dump file, return number of bytes
+    """
+    in_stream = dump_file.open_dump()
+    total = 0
+    while True:
+        data = in_stream.read(64*1024)
+        if not data:
+            break
+        total += len(data)
+    return total
+
+
+def parse_all(dump_file):
+    """
+    Parse all items from dump file, return number of items
+    """
+    return sum(1 for item in process_xml(dump_file=dump_file))
+
+
+def timeit(func, dump_file, num_rounds):
+    """
+    Return best wall clock time of num_rounds executions of func
+    """
+    best = None
+    for num in range(num_rounds):
+        start = time.time()
+        func(dump_file)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+if __name__ == '__main__':
+    num_copies = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    num_rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    tmp_dir = tempfile.mkdtemp(prefix='wikidat-bench-')
+    try:
+        print "%-48s %-6s %10s %10s %10s" % ('file', 'test', 'pipe (s)',
+                                              'native (s)', 'speedup')
+        for example in EXAMPLES:
+            for path in build_files(example, tmp_dir, num_copies):
+                pipe_dump = DumpFile(path, native=False)
+                native_dump = DumpFile(path)
+                assert read_all(pipe_dump) == read_all(native_dump)
+                for test, func in (('read', read_all), ('parse', parse_all)):
+                    t_pipe = timeit(func, pipe_dump, num_rounds)
+                    t_native = timeit(func, native_dump, num_rounds)
+                    print "%-48s %-6s %10.4f %10.4f %9.2fx" % (
+                        os.path.basename(path), test, t_pipe, t_native,
+                        t_pipe / t_native)
+    finally:
+        shutil.rmtree(tmp_dir)
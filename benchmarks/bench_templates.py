@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 26 12:48:03 2014
+
+Benchmark of FA/FLIST/GA detection for every supported language: search
+of every pattern in the whole text (maps.FA_RE, maps.FLIST_RE and
+maps.GA_RE) versus a single scan with templates.TemplateDetector. Both
+must yield identical flags for every revision.
+
+Revision texts are taken from the example dumps bundled with WikiDAT.
+Since they hold no FA/FLIST/GA templates, copies of them are added with
+a sample template of some language inserted in the middle (templates of
+other languages are negative cases for every language).
+
+Usage: python benchmarks/bench_templates.py [num_copies] [num_rounds]
+
+@author: jfelipe
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from wikidat.sources.dump import DumpFile, process_xml
+from wikidat.sources.revision import Revision, text_patterns
+from wikidat.sources.templates import TemplateDetector
+from wikidat.utils import maps
+from bench_readers import EXAMPLES, SOURCES_DIR
+
+SAMPLES = [u'{{Exzellent|1. Mai 2010|123456}}', u'{{informativ}}',
+           u'{{Lesenswert|2. Mai 2010|654321}}', u'{{Featured article}}',
+           u'{{featured list}}', u'{{Good article}}',
+           u'{{Artículo destacado}}', u'{{artículo bueno}}',
+           u'{{Article de qualité|date=mai 2010}}',
+           u'{{Bon article|date=mai 2010}}', u'{{Vetrina|arg}}',
+           u'{{Voce di qualità|arg}}', u'{{Featured Japanese article}}',
+           u'{{Etalage}}', u'{{Medal}}', u'{{Dobry artykuł}}',
+           u'{{Artigo destacado}}', u'{{Artigo bom}}',
+           u'{{Избранная статья|Физика}}', u'{{Хорошая статья|Физика}}',
+           u'{{Utmärkt}}', u'{{Seçkin madde}}', u'{{Suositeltu}}',
+           u'{{Nejlepší článek}}', u'{{บทความคัดสรร}}', u'{{مقالة مختارة}}',
+           u'{{알찬 글 딱지}}', u'{{ערך מומלץ}}', u'{{Utmerket}}',
+           u'{{Kiemelt cikk}}', u'{{Sao chọn lọc}}', u'{{медаль|золото}}',
+           u'{{Fremragende artikel}}', u'{{God}}', u'{{مقاله برگزیده}}',
+           u'{{نوشتار برگزیده}}', u'{{Articol de calitate}}',
+           u'{{Article de qualitat}}', u'{{1000+AdQ}}',
+           u'{{Избрана статия}}', u'{{Izdvojeni članak}}',
+           u'{{Αξιόλογο άρθρο}}', u'{{Perfektný článok}}', u'{{изабрани}}',
+           u'{{SavStr}}', u'{{zvezdica}}', u'{{eeskujulikud artiklid}}',
+           u'{{rencana pilihan}}', u'{{Nabarmendutako artikulua}}',
+           u'{{Artigo de calidade}}', u'{{Úrvalsgrein}}', u'{{Gæðagrein}}',
+           u'{{Mánaðargrein}}',
+           # Broken or nested templates, and several templates in a line
+           u'{{{Featured article}}', u'{{Featured article}',
+           u'{{Exzellent|x|1}} {{Lesenswert|y|2}}', u'{{Featured|list}}']
+
+
+def build_texts(num_copies):
+    """
+    Return list of texts of revisions (UTF-8 encoded) of the example
+    dumps, plus copies with every sample template, repeated num_copies
+    times
+    """
+    texts = []
+    for example in EXAMPLES:
+        dump_file = DumpFile(os.path.join(SOURCES_DIR, example))
+        for item in process_xml(dump_file=dump_file):
+            if isinstance(item, Revision) and item['text'] is not None:
+                texts.append(item['text'].encode('utf-8'))
+    samples = list(texts)
+    for sample in SAMPLES:
+        for text in texts:
+            middle = len(text) / 2
+            samples.append(text[:middle] + '\n' + sample.encode('utf-8') +
+                           '\n' + text[middle:])
+    return samples * num_copies
+
+
+def search_flags(patterns, text):
+    return [int(pattern is not None and pattern.search(text) is not None)
+            for pattern in patterns]
+
+
+def elapsed(func, texts):
+    start = time.time()
+    for text in texts:
+        func(text)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    num_copies = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    num_rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    texts = build_texts(num_copies)
+    print "%d revisions, %d bytes of text" % (len(texts),
+                                              sum(len(t) for t in texts))
+    print "%-12s %6s %6s %6s %11s %11s %10s %9s" % (
+        'language', 'FA', 'FLIST', 'GA', 'search (s)', 'detect (s)',
+        'speedup', 'hit rate')
+    for lang in sorted(maps.FA_RE):
+        patterns = text_patterns(lang)
+        if patterns == (None, None, None):
+            continue
+        detector = TemplateDetector(lang, patterns)
+        # Check that detection yields the same flags as searching patterns
+        hits = [0, 0, 0]
+        for text in texts:
+            flags = detector.detect(text)
+            if flags != search_flags(patterns, text):
+                print "Different flags for %s: %r" % (lang, text)
+                sys.exit(1)
+            hits = [h + f for h, f in zip(hits, flags)]
+        search = min(elapsed(lambda t: search_flags(patterns, t), texts)
+                     for num in range(num_rounds))
+        detect = min(elapsed(detector.detect, texts)
+                     for num in range(num_rounds))
+        print "%-12s %6d %6d %6d %11.4f %11.4f %9.2fx %8.2f%%" % (
+            lang, hits[0], hits[1], hits[2], search, detect,
+            search / detect, 100. * sum(hits) / len(texts))
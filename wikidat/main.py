@@ -16,6 +16,7 @@ import codecs
 import sys
 import json
 from wikidat.tasks import tasks
+from wikidat.utils.comutils import CODECS
 
 
 def get_config(filename='config.ini'):
@@ -53,25 +54,98 @@ def get_config(filename='config.ini'):
     opts_etl = dict()
     if config.has_option('ETL', 'etl_lines'):
         opts_etl['etl_lines'] = config.getint('ETL', 'etl_lines')
+    if config.has_option('ETL', 'xml_fan'):
+        opts_etl['xml_fan'] = config.getint('ETL', 'xml_fan')
     if config.has_option('ETL', 'page_fan'):
         opts_etl['page_fan'] = config.getint('ETL', 'page_fan')
     if config.has_option('ETL', 'rev_fan'):
         opts_etl['rev_fan'] = config.getint('ETL', 'rev_fan')
+    if config.has_option('ETL', 'autoscale'):
+        opts_etl['autoscale'] = config.getboolean('ETL', 'autoscale')
+    if config.has_option('ETL', 'rev_fan_min'):
+        opts_etl['rev_fan_min'] = config.getint('ETL', 'rev_fan_min')
+    if config.has_option('ETL', 'rev_fan_max'):
+        opts_etl['rev_fan_max'] = config.getint('ETL', 'rev_fan_max')
     if config.has_option('ETL', 'page_cache_size'):
         opts_etl['page_cache_size'] = config.getint('ETL', 'page_cache_size')
     if config.has_option('ETL', 'rev_cache_size'):
         opts_etl['rev_cache_size'] = config.getint('ETL', 'rev_cache_size')
+    if config.has_option('ETL', 'read_buffer_size'):
+        opts_etl['read_buffer_size'] = config.getint('ETL',
+                                                     'read_buffer_size')
+    if config.has_option('ETL', 'xml_parser'):
+        opts_etl['xml_parser'] = config.get('ETL', 'xml_parser')
+    if config.has_option('ETL', 'inline_max_size'):
+        opts_etl['inline_max_size'] = config.getint('ETL', 'inline_max_size')
+    if config.has_option('ETL', 'page_batch_size'):
+        opts_etl['page_batch_size'] = config.getint('ETL', 'page_batch_size')
+    if config.has_option('ETL', 'rev_batch_size'):
+        opts_etl['rev_batch_size'] = config.getint('ETL', 'rev_batch_size')
+    if config.has_option('ETL', 'page_batch_linger'):
+        opts_etl['page_batch_linger'] = config.getint('ETL',
+                                                      'page_batch_linger')
+    if config.has_option('ETL', 'rev_batch_linger'):
+        opts_etl['rev_batch_linger'] = config.getint('ETL',
+                                                     'rev_batch_linger')
+    if config.has_option('ETL', 'page_codec'):
+        opts_etl['page_codec'] = config.get('ETL', 'page_codec')
+    if config.has_option('ETL', 'rev_codec'):
+        opts_etl['rev_codec'] = config.get('ETL', 'rev_codec')
+    if config.has_option('ETL', 'codec_min_size'):
+        opts_etl['codec_min_size'] = config.getint('ETL', 'codec_min_size')
+    if config.has_option('ETL', 'page_credit_window'):
+        opts_etl['page_credit_window'] = config.getint('ETL',
+                                                       'page_credit_window')
+    if config.has_option('ETL', 'rev_credit_window'):
+        opts_etl['rev_credit_window'] = config.getint('ETL',
+                                                      'rev_credit_window')
+    if config.has_option('ETL', 'page_hwm'):
+        opts_etl['page_hwm'] = config.getint('ETL', 'page_hwm')
+    if config.has_option('ETL', 'rev_hwm'):
+        opts_etl['rev_hwm'] = config.getint('ETL', 'rev_hwm')
+    if config.has_option('ETL', 'stats_interval'):
+        opts_etl['stats_interval'] = config.getint('ETL', 'stats_interval')
+    if config.has_option('ETL', 'transport'):
+        opts_etl['transport'] = config.get('ETL', 'transport')
     if config.has_option('ETL', 'base_ports'):
         opts_etl['base_ports'] = json.loads(config.get('ETL', 'base_ports'))
-    if config.has_option('ETL', 'control_ports'):
-        opts_etl['control_ports'] = json.loads(config.get('ETL',
-                                                          'control_ports'))
+    if config.has_option('ETL', 'coordinator_port'):
+        opts_etl['coordinator_port'] = config.getint('ETL',
+                                                     'coordinator_port')
+    if config.has_option('ETL', 'bind_host'):
+        opts_etl['bind_host'] = config.get('ETL', 'bind_host')
+    if config.has_option('ETL', 'public_host'):
+        opts_etl['public_host'] = config.get('ETL', 'public_host')
+    if config.has_option('ETL', 'metadata_only'):
+        opts_etl['metadata_only'] = config.getboolean('ETL', 'metadata_only')
+    if config.has_option('ETL', 'filter_namespaces'):
+        opts_etl['filter_namespaces'] = json.loads(
+            config.get('ETL', 'filter_namespaces'))
+    if config.has_option('ETL', 'filter_page_ids'):
+        opts_etl['filter_page_ids'] = json.loads(
+            config.get('ETL', 'filter_page_ids'))
+    if config.has_option('ETL', 'filter_title'):
+        opts_etl['filter_title'] = config.get('ETL', 'filter_title')
+    if config.has_option('ETL', 'filter_date_start'):
+        opts_etl['filter_date_start'] = config.get('ETL', 'filter_date_start')
+    if config.has_option('ETL', 'filter_date_end'):
+        opts_etl['filter_date_end'] = config.get('ETL', 'filter_date_end')
+    if config.has_option('ETL', 'resume'):
+        opts_etl['resume'] = config.getboolean('ETL', 'resume')
     if config.has_option('ETL', 'detect_FA'):
         opts_etl['detect_FA'] = config.getboolean('ETL', 'detect_FA')
     if config.has_option('ETL', 'detect_FLIST'):
         opts_etl['detect_FLIST'] = config.getboolean('ETL', 'detect_FLIST')
     if config.has_option('ETL', 'detect_GA'):
         opts_etl['detect_GA'] = config.getboolean('ETL', 'detect_GA')
+    if config.has_option('ETL', 'text_cache_size'):
+        opts_etl['text_cache_size'] = config.getint('ETL', 'text_cache_size')
+    if config.has_option('ETL', 'hash_type'):
+        opts_etl['hash_type'] = config.get('ETL', 'hash_type')
+    if config.has_option('ETL', 'trust_dump'):
+        opts_etl['trust_dump'] = config.getboolean('ETL', 'trust_dump')
+    if config.has_option('ETL', 'revert_radius'):
+        opts_etl['revert_radius'] = config.getint('ETL', 'revert_radius')
     opts.update(opts_etl)
 
     return opts
@@ -104,18 +178,51 @@ if __name__ == '__main__':
             'download_files': True,
             'dumps_dir': None,
             'etl_lines': 1,
+            'xml_fan': 1,
             'page_fan': 1,
             'rev_fan': 1,
+            'autoscale': False,
+            'rev_fan_min': 1,
+            'rev_fan_max': None,
             'page_cache_size': 1000000,
             'rev_cache_size': 1000000,
+            'read_buffer_size': 4194304,
+            'xml_parser': 'lxml',
+            'inline_max_size': 33554432,
+            'metadata_only': False,
+            'page_batch_size': 1000,
+            'rev_batch_size': 100,
+            'page_batch_linger': 100,
+            'rev_batch_linger': 100,
+            'page_codec': 'zlib1',
+            'rev_codec': 'zlib1',
+            'codec_min_size': 1024,
             'db_user': 'root',
             'db_passw': '',
             'db_engine': 'ARIA',
-            'base_ports': 10000,
-            'control_ports': 11000,
+            'page_credit_window': 2,
+            'rev_credit_window': 2,
+            'page_hwm': 10,
+            'rev_hwm': 10,
+            'stats_interval': 10,
+            'transport': 'ipc',
+            'base_ports': None,
+            'coordinator_port': None,
+            'bind_host': '127.0.0.1',
+            'public_host': None,
             'detect_FA': True,
             'detect_FLIST': True,
-            'detect_GA': True
+            'detect_GA': True,
+            'text_cache_size': 10000,
+            'hash_type': 'sha256',
+            'trust_dump': False,
+            'revert_radius': 15,
+            'filter_namespaces': None,
+            'filter_page_ids': None,
+            'filter_title': None,
+            'filter_date_start': None,
+            'filter_date_end': None,
+            'resume': False
             }
     # If some options are overridden by config file, update them
     if args.conf_file:
@@ -166,6 +273,15 @@ if __name__ == '__main__':
                                       'if enough CPUs/cores are available ',
                                       'for data processing.'])
                         )
+    parser.add_argument('--xml_fan', type=int, metavar='NUM_XML_READERS',
+                        help=''.join(['Number of XML reader processes ',
+                                      'parsing page-aligned chunks of each ',
+                                      'dump file in parallel. Only ',
+                                      'uncompressed XML and bz2 multistream ',
+                                      'files can be split. Each additional ',
+                                      'reader takes 2 more port numbers ',
+                                      'after the base port.'])
+                        )
     parser.add_argument('--page_fan', type=int, metavar='NUM_PAGE_WORKERS',
                         help=''.join(['Number of worker process to deal with ',
                                       'page elements in each ETL line.'])
@@ -174,6 +290,21 @@ if __name__ == '__main__':
                         help=''.join(['Number of worker process to deal with ',
                                       'revision elements in each ETL line.'])
                         )
+    parser.add_argument('--autoscale', dest='autoscale', action='store_true',
+                        help=''.join(['Start and retire revision workers ',
+                                      'according to pipeline stats, from ',
+                                      'rev_fan workers.']))
+    parser.add_argument('--no_autoscale', dest='autoscale',
+                        action='store_false',
+                        help=''.join(['Keep rev_fan revision workers for the ',
+                                      'whole run (default).']))
+    parser.add_argument('--rev_fan_min', type=int, metavar='N',
+                        help=''.join(['Min. number of revision workers in ',
+                                      'each ETL line, with autoscale.']))
+    parser.add_argument('--rev_fan_max', type=int, metavar='N',
+                        help=''.join(['Max. number of revision workers in ',
+                                      'each ETL line, with autoscale ',
+                                      '(number of CPUs by default).']))
     parser.add_argument('--page_cache_size', type=int, metavar='CACHE_SIZE',
                         help=''.join(['Num. of rows to accumulate in tmp ',
                                       'data dir for page elements before ',
@@ -184,6 +315,59 @@ if __name__ == '__main__':
                                       'data dir for revision elements before ',
                                       'flushing data to local DB.'])
                         )
+    parser.add_argument('--read_buffer_size', type=int, metavar='BYTES',
+                        help=''.join(['Size in bytes of read buffers for ',
+                                      'dump files. Dump files are ',
+                                      'decompressed in-process, except for ',
+                                      '7z files.'])
+                        )
+    parser.add_argument('--xml_parser', choices=['lxml', 'expat'],
+                        help=''.join(['Parser backend for dump files: lxml ',
+                                      '(iterparse, default) or expat ',
+                                      '(event-driven, never builds an ',
+                                      'element tree).'])
+                        )
+    parser.add_argument('--inline_max_size', type=int, metavar='BYTES',
+                        help=''.join(['Dump files with less than this of ',
+                                      'uncompressed XML data (estimated ',
+                                      'for compressed files) are ',
+                                      'processed in a single process, ',
+                                      'without starting XML readers, ',
+                                      'workers and loaders (0 to disable).'])
+                        )
+    parser.add_argument('--page_batch_size', type=int, metavar='N',
+                        help=''.join(['Max. number of pages sent in each ',
+                                      'message between processes.']))
+    parser.add_argument('--rev_batch_size', type=int, metavar='N',
+                        help=''.join(['Max. number of revisions sent in ',
+                                      'each message between processes.']))
+    parser.add_argument('--page_batch_linger', type=int, metavar='MSEC',
+                        help=''.join(['Max. time (in milliseconds) to wait ',
+                                      'for more pages before sending a ',
+                                      'message.']))
+    parser.add_argument('--rev_batch_linger', type=int, metavar='MSEC',
+                        help=''.join(['Max. time (in milliseconds) to wait ',
+                                      'for more revisions before sending a ',
+                                      'message.']))
+    parser.add_argument('--page_codec', choices=sorted(CODECS),
+                        help=''.join(['Codec to compress messages with ',
+                                      'pages between processes.']))
+    parser.add_argument('--rev_codec', choices=sorted(CODECS),
+                        help=''.join(['Codec to compress messages with ',
+                                      'revisions between processes.']))
+    parser.add_argument('--codec_min_size', type=int, metavar='BYTES',
+                        help=''.join(['Messages smaller than this are not ',
+                                      'compressed.']))
+    parser.add_argument('--metadata_only', dest='metadata_only',
+                        action='store_true',
+                        help=''.join(['Compute length, hash and flags of ',
+                                      'revision text in XML readers, and ',
+                                      'never send revision text to ',
+                                      'revision workers.']))
+    parser.add_argument('--no_metadata_only', dest='metadata_only',
+                        action='store_false',
+                        help=''.join(['Send revision text to revision ',
+                                      'workers (default).']))
     parser.add_argument('--db_name', type=str, metavar='DB_NAME',
                         help=''.join(['Name of local DB.'])
                         )
@@ -198,22 +382,61 @@ if __name__ == '__main__':
                                       'locally. Currently, only ARIA or ',
                                       'MyISAM engines are supported.'])
                         )
+    parser.add_argument('--page_credit_window', type=int, metavar='N',
+                        help=''.join(['Max. number of batches of pages ',
+                                      'that every worker requests in ',
+                                      'advance from each XML reader.']))
+    parser.add_argument('--rev_credit_window', type=int, metavar='N',
+                        help=''.join(['Max. number of batches of revisions ',
+                                      'that every worker requests in ',
+                                      'advance from each XML reader.']))
+    parser.add_argument('--page_hwm', type=int, metavar='N',
+                        help=''.join(['Max. number of batches of pages ',
+                                      'queued by every worker to the ',
+                                      'loader, and by the loader from ',
+                                      'every worker.']))
+    parser.add_argument('--rev_hwm', type=int, metavar='N',
+                        help=''.join(['Max. number of batches of revisions ',
+                                      'queued by every worker to the ',
+                                      'loader, and by the loader from ',
+                                      'every worker.']))
+    parser.add_argument('--stats_interval', type=int, metavar='SECS',
+                        help=''.join(['Seconds between summaries of ',
+                                      'pipeline stats in the log of each ',
+                                      'dump file (0 to disable).']))
+    parser.add_argument('--transport', choices=['ipc', 'tcp'],
+                        help=''.join(['Channels between processes of each ',
+                                      'ETL line: Unix domain sockets (ipc) ',
+                                      'or TCP connections (tcp).']))
     parser.add_argument('--base_ports', nargs='+', type=int,
                         help=''.join(['List of base port numbers to be ',
-                                      'used by each ETL line. Communication ',
+                                      'used by each ETL line with tcp ',
+                                      'transport. Communication ',
                                       'port numbers will be chosen as ',
                                       'consecutive ports starting from the '
                                       'specified base port. ',
-                                      'Each ETL consumes at least 4 port ',
-                                      'numbers (1 ventilator, 1 page worker ',
-                                      '1 revision worker and 1 sink).']))
-    parser.add_argument('--control_ports', nargs='+', type=int,
-                        help=''.join(['List of control port numbers to be ',
-                                      'used by each ETL line. Each ETL will ',
-                                      'utilize a socket open on this port to ',
-                                      'stop all workers when all elements ',
-                                      'from a dump file have been ',
-                                      'processed.']))
+                                      'Each ETL consumes at least 5 port ',
+                                      'numbers (2 per XML reader, 1 page ',
+                                      'loader, 1 revision loader and 1 ',
+                                      'stats channel). If not given, ',
+                                      'ephemeral ports are chosen by the ',
+                                      'OS.']))
+    parser.add_argument('--coordinator_port', type=int, metavar='PORT',
+                        help=''.join(['Run in distributed mode: revision ',
+                                      'workers on other hosts (see ',
+                                      'wikidat/worker.py) register with ',
+                                      'each ETL line on this port (plus the ',
+                                      'number of the line). Requires tcp ',
+                                      'transport.']))
+    parser.add_argument('--bind_host', metavar='HOST',
+                        help=''.join(['Interface where tcp channels are ',
+                                      'bound (* for all of them, default ',
+                                      '127.0.0.1).']))
+    parser.add_argument('--public_host', metavar='HOST',
+                        help=''.join(['Host name used by workers to connect ',
+                                      'to tcp channels (bind_host by ',
+                                      'default, or the host name of this ',
+                                      'machine if bound to all interfaces).']))
     parser.add_argument('--detect_FA', dest='detect_FA', action='store_true',
                         help=''.join(['Revisions corresponding to Featured ',
                                       'Articles will be detected.']))
@@ -237,6 +460,61 @@ if __name__ == '__main__':
                         action='store_false',
                         help=''.join(['Skip detection of revisions of ',
                                       'Good Articles.']))
+    parser.add_argument('--text_cache_size', type=int, metavar='N',
+                        help=''.join(['Max. number of distinct texts whose ',
+                                      'metadata is cached, so that reverts ',
+                                      'are not hashed nor scanned again ',
+                                      '(0 to disable).']))
+    parser.add_argument('--hash_type', choices=['sha256', 'sha1'],
+                        help=''.join(['Hash of revision text: sha256 ',
+                                      '(default) or sha1 (in base 36, the ',
+                                      'same digests as MediaWiki).']))
+    parser.add_argument('--trust_dump', dest='trust_dump',
+                        action='store_true',
+                        help=''.join(['Take length and (with sha1) hash of ',
+                                      'revision text from the dump file, ',
+                                      'instead of computing them.']))
+    parser.add_argument('--no_trust_dump', dest='trust_dump',
+                        action='store_false',
+                        help=''.join(['Compute length and hash of every ',
+                                      'revision text.']))
+    parser.add_argument('--revert_radius', type=int, metavar='N',
+                        help=''.join(['Max. number of revisions reverted by ',
+                                      'identity reverts detected while ',
+                                      'parsing, loaded in table revert ',
+                                      '(0 to disable). Unless text ',
+                                      'metadata is computed by XML ',
+                                      'readers or taken from the dump ',
+                                      'file (trust_dump), readers hash ',
+                                      'the text of every revision (MD5).']))
+    parser.add_argument('--filter_namespaces', nargs='+', type=int,
+                        metavar='NS',
+                        help=''.join(['Only load pages (and their ',
+                                      'revisions) in these namespaces ',
+                                      '(e.g. 0 for articles).']))
+    parser.add_argument('--filter_page_ids', nargs=2, type=int,
+                        metavar=('FIRST', 'LAST'),
+                        help=''.join(['Only load pages whose id is in this ',
+                                      'range (both inclusive).']))
+    parser.add_argument('--filter_title', type=str, metavar='REGEXP',
+                        help=''.join(['Only load pages whose title matches ',
+                                      'this regular expression.']))
+    parser.add_argument('--filter_date_start', type=str, metavar='DATE',
+                        help=''.join(['Only load revisions saved at or ',
+                                      'after this date (YYYY-MM-DD or ',
+                                      '"YYYY-MM-DD HH:MM:SS", UTC).']))
+    parser.add_argument('--filter_date_end', type=str, metavar='DATE',
+                        help=''.join(['Only load revisions saved before ',
+                                      'this date (YYYY-MM-DD or ',
+                                      '"YYYY-MM-DD HH:MM:SS", UTC).']))
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help=''.join(['Resume data loading from the last ',
+                                      'checkpoint of each dump file, ',
+                                      'without recreating the database.']))
+    parser.add_argument('--no_resume', dest='resume', action='store_false',
+                        help=''.join(['Recreate the database and load all ',
+                                      'dump files from the beginning ',
+                                      '(default).']))
     # Finally, any option directly specified on the command-line will
     # override previous values assigned to any argument
     args = parser.parse_args(remain_args)
@@ -251,7 +529,10 @@ if __name__ == '__main__':
                                      date=args.date,
                                      etl_lines=args.etl_lines)
 
-    task.execute(page_fan=args.page_fan, rev_fan=args.rev_fan,
+    task.execute(xml_fan=args.xml_fan,
+                 page_fan=args.page_fan, rev_fan=args.rev_fan,
+                 autoscale=args.autoscale, rev_fan_min=args.rev_fan_min,
+                 rev_fan_max=args.rev_fan_max,
                  page_cache_size=args.page_cache_size,
                  rev_cache_size=args.rev_cache_size,
                  host=args.host, port=args.port,
@@ -259,5 +540,33 @@ if __name__ == '__main__':
                  db_passw=args.db_passw, db_engine=args.db_engine,
                  mirror=args.mirror, download_files=args.download_files,
                  base_ports=args.base_ports,
-                 control_ports=args.control_ports,
-                 dumps_dir=args.dumps_dir)
+                 coordinator_port=args.coordinator_port,
+                 bind_host=args.bind_host, public_host=args.public_host,
+                 transport=args.transport,
+                 page_credit_window=args.page_credit_window,
+                 rev_credit_window=args.rev_credit_window,
+                 page_hwm=args.page_hwm, rev_hwm=args.rev_hwm,
+                 stats_interval=args.stats_interval,
+                 dumps_dir=args.dumps_dir,
+                 read_buffer_size=args.read_buffer_size,
+                 xml_parser=args.xml_parser,
+                 inline_max_size=args.inline_max_size,
+                 metadata_only=args.metadata_only,
+                 detect_FA=args.detect_FA, detect_FLIST=args.detect_FLIST,
+                 detect_GA=args.detect_GA,
+                 text_cache_size=args.text_cache_size,
+                 hash_type=args.hash_type, trust_dump=args.trust_dump,
+                 revert_radius=args.revert_radius,
+                 filter_namespaces=args.filter_namespaces,
+                 filter_page_ids=args.filter_page_ids,
+                 filter_title=args.filter_title,
+                 filter_date_start=args.filter_date_start,
+                 filter_date_end=args.filter_date_end,
+                 resume=args.resume,
+                 page_batch_size=args.page_batch_size,
+                 rev_batch_size=args.rev_batch_size,
+                 page_batch_linger=args.page_batch_linger,
+                 rev_batch_linger=args.rev_batch_linger,
+                 page_codec=args.page_codec,
+                 rev_codec=args.rev_codec,
+                 codec_min_size=args.codec_min_size)
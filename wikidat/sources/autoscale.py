@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 23 17:05:44 2014
+
+Automatic scaling of workers in a stage of the ETL pipeline, driven by
+the stats published by all stages (see wikidat.utils.stats).
+
+A stage needs more workers when they are busy most of the time, while
+XML readers are blocked waiting for them and they are not blocked by
+loaders themselves. It needs fewer workers when they spend most of the
+time waiting for batches from XML readers.
+
+@author: jfelipe
+"""
+import multiprocessing as mp
+
+# Add a worker if workers are busy at least this % of time, while they
+# are blocked on sending less than SCALE_UP_SEND_WAIT % and XML readers
+# are blocked on sending at least SCALE_UP_READER_WAIT %
+SCALE_UP_BUSY = 80
+SCALE_UP_SEND_WAIT = 20
+SCALE_UP_READER_WAIT = 20
+# Retire a worker if workers wait for batches at least this % of time
+SCALE_DOWN_RECV_WAIT = 50
+# Summaries of stats skipped after every change, until it takes effect
+COOLDOWN = 2
+
+
+class Autoscaler(object):
+    """
+    Starts and retires workers of a stage, keeping between min_workers
+    and max_workers of them running.
+
+    spawn(num, retire) must start and return a new worker (a Processor)
+    with number num, that retires when the retire event is set. count is
+    the comutils.WorkerCount shared with XML readers and loaders of the
+    stage. No workers are added once XML readers start sending their STOP
+    messages.
+    """
+    def __init__(self, stage, spawn, count, min_workers=1, max_workers=None,
+                 logger=None):
+        self.stage = stage
+        self.spawn = spawn
+        self.count = count
+        self.min_workers = min_workers
+        self.max_workers = (max_workers if max_workers is not None
+                            else mp.cpu_count())
+        self.logger = logger
+        # (process, retire event) of every worker started
+        self.workers = []
+        self.cooldown = 0
+
+    def start(self, workers):
+        """
+        Start the initial workers of the stage (already in count), and
+        return them
+        """
+        for num in range(workers):
+            self._spawn()
+        return [process for process, retire in self.workers]
+
+    def active(self):
+        """
+        Return number of workers running and not retiring
+        """
+        return len([retire for process, retire in self.workers
+                    if not retire.is_set() and process.is_alive()])
+
+    def update(self, groups):
+        """
+        Add or retire one worker according to counters of groups of stages
+        (see stats.PipelineMonitor.groups). Return list of workers started.
+        """
+        if self.cooldown > 0:
+            self.cooldown -= 1
+            return []
+        workers = groups.get(self.stage)
+        readers = groups.get('xml_reader')
+        if not workers or not workers['updated']:
+            return []
+        active = self.active()
+
+        if (active < self.max_workers and
+                workers['busy'] >= SCALE_UP_BUSY and
+                workers['send'] < SCALE_UP_SEND_WAIT and
+                readers and readers['updated'] and
+                readers['send'] >= SCALE_UP_READER_WAIT):
+            # XML readers may be sending their STOP messages already
+            if not self.count.add():
+                return []
+            self.cooldown = COOLDOWN
+            process = self._spawn()
+            self._log("started %s %d (%d active, %.0f%% busy)" % (
+                      self.stage, len(self.workers) - 1, active + 1,
+                      workers['busy']))
+            return [process]
+
+        if (active > self.min_workers and
+                workers['recv'] >= SCALE_DOWN_RECV_WAIT):
+            self.cooldown = COOLDOWN
+            # Retire the last worker started, still running
+            for num in range(len(self.workers) - 1, -1, -1):
+                process, retire = self.workers[num]
+                if not retire.is_set() and process.is_alive():
+                    retire.set()
+                    break
+            self._log("retired %s %d (%d active, %.0f%% waiting for "
+                      "batches)" % (self.stage, num, active - 1,
+                                    workers['recv']))
+        return []
+
+    def _spawn(self):
+        retire = mp.Event()
+        process = self.spawn(len(self.workers), retire)
+        self.workers.append((process, retire))
+        return process
+
+    def _log(self, message):
+        print "Autoscaling: " + message
+        if self.logger is not None:
+            self.logger.info("autoscaling: " + message)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 19 12:31:08 2014
+
+Checkpoints of data loading from dump files, at page granularity.
+
+Every page and revision extracted from a chunk of a dump file carries a
+sequence number (see dump.ItemBuilder). Since items arrive at loaders in
+any order, each loader tracks the longest contiguous sequence of items
+already loaded in the database (watermark) for every chunk. From it, a
+bound is derived, such that all pages of the chunk with a lower page_id
+are completely loaded. Before loading a new file of rows in the database,
+loaders also record the lowest (lo) and highest (hi) page_id ever sent to
+the database for every chunk, so that rows of incomplete pages can be
+deleted before resuming.
+
+Checkpoint files are JSON files stored in the logs directory:
+<file_name>.ckpt (chunks of the dump file) and <file_name>.page.ckpt,
+<file_name>.revision.ckpt (state of each loader).
+
+@author: jfelipe
+"""
+import json
+import os
+
+
+def write_json(path, obj):
+    """
+    Atomically replace the content of a file with the JSON representation
+    of an object
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fobj:
+        json.dump(obj, fobj)
+        fobj.flush()
+        os.fsync(fobj.fileno())
+    os.rename(tmp_path, path)
+
+
+def read_json(path):
+    """
+    Return object stored in a JSON file, or None if it does not exist
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as fobj:
+        return json.load(fobj)
+
+
+def load_file_db(con, queries, checkpoint=None, seqs=None):
+    """
+    Send queries to bulk load data files in DB. If a checkpoint is given,
+    it is updated with the sequence numbers of loaded items (seqs) before
+    and after loading the files. Returns True if all queries succeeded.
+    """
+    if checkpoint is not None:
+        checkpoint.begin(seqs)
+    loaded = all([con.send_query(query) for query in queries])
+    if checkpoint is not None and loaded:
+        con.commit()
+        checkpoint.commit(seqs)
+    return loaded
+
+
+class Watermark(object):
+    """
+    Tracks the longest prefix 0, 1, ..., last of a sequence of numbers
+    received in any order. Each number comes with a value (a page_id).
+    """
+    def __init__(self):
+        self.last = -1
+        self.pending = {}
+
+    def add(self, seq, value):
+        """
+        Register a new number. Return the value of the new end of the
+        prefix if it was extended, otherwise None.
+        """
+        self.pending[seq] = value
+        value = None
+        while self.last + 1 in self.pending:
+            self.last += 1
+            value = self.pending.pop(self.last)
+        return value
+
+
+class LoaderCheckpoint(object):
+    """
+    Checkpoint state of a loader (kind 'page' or 'revision') for every chunk
+    of a dump file: bound (pages below it are done), lo and hi (lowest and
+    highest page_id ever sent to the database) and done (whole chunk
+    loaded).
+    """
+    def __init__(self, path, kind, num_chunks):
+        self.path = path
+        self.kind = kind
+        state = read_json(path)
+        if state is None or len(state['bound']) != num_chunks:
+            state = {'bound': [None] * num_chunks,
+                     'lo': [None] * num_chunks,
+                     'hi': [None] * num_chunks,
+                     'done': [False] * num_chunks}
+        self.state = state
+        self.watermarks = [Watermark() for num in range(num_chunks)]
+
+    def begin(self, seqs):
+        """
+        Record lowest and highest page_id of each chunk in a new file of
+        rows, before loading it in the database
+        """
+        lo = self.state['lo']
+        hi = self.state['hi']
+        for seq in seqs:
+            chunk, page_id = seq[0], seq[-1]
+            if lo[chunk] is None or page_id < lo[chunk]:
+                lo[chunk] = page_id
+            if hi[chunk] is None or page_id > hi[chunk]:
+                hi[chunk] = page_id
+        write_json(self.path, self.state)
+
+    def commit(self, seqs):
+        """
+        Update bounds once a file of rows is loaded in the database
+        """
+        bound = self.state['bound']
+        for seq in seqs:
+            chunk = seq[0]
+            if self.kind == 'page':
+                # seq = [chunk, page_seq, page_id]
+                page_id = self.watermarks[chunk].add(seq[1], seq[-1])
+                if page_id is not None:
+                    bound[chunk] = page_id + 1
+            else:
+                # seq = [chunk, page_seq, rev_seq, page_id]. All revisions
+                # of pages before the one of the last revision are done.
+                page_id = self.watermarks[chunk].add(seq[2], seq[-1])
+                if page_id is not None and (bound[chunk] is None or
+                                            page_id > bound[chunk]):
+                    bound[chunk] = page_id
+        write_json(self.path, self.state)
+
+    def finish(self, chunks):
+        """
+        Mark chunks (list of chunk numbers) as completely loaded
+        """
+        for chunk in chunks:
+            self.state['done'][chunk] = True
+        write_json(self.path, self.state)
+
+
+class DumpCheckpoint(object):
+    """
+    Checkpoint files for a dump file, stored in the logs directory
+    """
+    def __init__(self, log_dir, file_name):
+        self.base = os.path.join(log_dir, file_name)
+        self.chunks_path = self.base + '.ckpt'
+
+    def loader_path(self, kind):
+        return '.'.join([self.base, kind, 'ckpt'])
+
+    def reset(self, chunks):
+        """
+        Start a new checkpoint for the given chunks of the dump file
+        """
+        for kind in ('page', 'revision'):
+            if os.path.isfile(self.loader_path(kind)):
+                os.remove(self.loader_path(kind))
+        write_json(self.chunks_path, [list(c) if c is not None else None
+                                      for c in chunks])
+
+    def chunks(self):
+        """
+        Return chunks of the dump file in the last checkpoint, or None if
+        no checkpoint exists
+        """
+        chunks = read_json(self.chunks_path)
+        if chunks is None:
+            return None
+        return [tuple(c) if c is not None else None for c in chunks]
+
+    def loader(self, kind, num_chunks):
+        """
+        Return checkpoint state of a loader ('page' or 'revision')
+        """
+        return LoaderCheckpoint(self.loader_path(kind), kind, num_chunks)
+
+    def resume_points(self, num_chunks):
+        """
+        Return, for each chunk, None if it is completely loaded or a tuple
+        (bound, partial): pages with page_id < bound are completely loaded,
+        and partial is None or a range (first, last) of page_id of pages
+        that may have been partially loaded.
+        """
+        loaders = [self.loader(kind, num_chunks).state
+                   for kind in ('page', 'revision')]
+        points = []
+        for num in range(num_chunks):
+            if all(state['done'][num] for state in loaders):
+                points.append(None)
+                continue
+            bounds = [state['bound'][num] for state in loaders
+                      if not state['done'][num]]
+            bound = min(bounds) if None not in bounds else 0
+            # Rows in [lo, hi] belong to this chunk, and only those of
+            # pages at or above bound may be incomplete
+            los = [state['lo'][num] for state in loaders
+                   if state['lo'][num] is not None]
+            his = [state['hi'][num] for state in loaders
+                   if state['hi'][num] is not None]
+            partial = None
+            if his and max(his) >= max(bound, min(los)):
+                partial = (max(bound, min(los)), max(his))
+            points.append((bound, partial))
+        return points
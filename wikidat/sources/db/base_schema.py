@@ -134,6 +134,34 @@ create_revision_hash = """CREATE TABLE revision_hash (
                           ENGINE {engine!s}
                           """
 
+# TABLE revert: identity reverts, detected while dump files are parsed
+# (see reverts.RevertDetector)
+"""
+rev_id:
+  -- Id of a revision reverted by an identity revert
+
+rev_page:
+  -- Key to page_id. This should _never_ be invalid.
+
+rev_reverted_by:
+  -- Id of the revision restoring an earlier text of the page (the revert)
+
+rev_reverted_to:
+  -- Id of the earlier revision whose text is restored by the revert
+
+Reverting revisions are those in rev_reverted_by, and revisions reverted by
+each one are all of those in between rev_reverted_to and rev_reverted_by.
+"""
+drop_revert = """DROP TABLE IF EXISTS revert"""
+create_revert = """CREATE TABLE revert (
+                   rev_id int unsigned NOT NULL,
+                   rev_page int unsigned NOT NULL,
+                   rev_reverted_by int unsigned NOT NULL,
+                   rev_reverted_to int unsigned NOT NULL
+                   ) MAX_ROWS=100000000000 AVG_ROW_LENGTH=64
+                   ENGINE {engine!s}
+                   """
+
 # TABLE namespaces: identifiers of MediaWiki namespaces
 # http://www.mediawiki.org/wiki/Namespaces
 """
@@ -159,11 +187,15 @@ rev_user:
 
 rev_user_text:
   -- Text username or IP address of the editor.
+
+Its primary key is created with the table, since rows loaded by revision
+loaders replace those of the same user (see revision.store_revs_file_db).
 """
 drop_people = """DROP TABLE IF EXISTS people"""
 create_people = """CREATE TABLE people (
                    rev_user INT NOT NULL DEFAULT 0,
-                   rev_user_text VARCHAR(255) BINARY DEFAULT ''
+                   rev_user_text VARCHAR(255) BINARY DEFAULT '',
+                   PRIMARY KEY rev_user(rev_user)
                    ) MAX_ROWS=100000000000 AVG_ROW_LENGTH=512
                    ENGINE {engine!s}
                    """
@@ -251,5 +283,4 @@ create_newuser = """CREATE TABLE newuser (
 pk_page = """ALTER TABLE page ADD PRIMARY KEY page_id(page_id)"""
 pk_revision = """ALTER TABLE revision ADD PRIMARY KEY rev_id(rev_id)"""
 pk_namespaces = """ALTER TABLE namespaces ADD PRIMARY KEY code(code)"""
-pk_people = """ALTER TABLE people ADD PRIMARY KEY rev_user(rev_user)"""
 pk_logging = """ALTER TABLE logging ADD PRIMARY KEY log_id(log_id)"""
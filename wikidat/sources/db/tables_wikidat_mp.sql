@@ -100,6 +100,17 @@ CREATE TABLE revision_hash (
   PRIMARY KEY rev_id(rev_id)
 ) MAX_ROWS=100000000000 AVG_ROW_LENGTH=512 ENGINE MyISAM;
 
+-- Identity reverts: one row for every revision reverted (rev_id), with the
+-- revision that reverts it and the earlier revision whose text is restored
+CREATE TABLE revert (
+  rev_id int unsigned NOT NULL,
+  -- Key to page_id. This should _never_ be invalid.
+  rev_page int unsigned NOT NULL,
+  rev_reverted_by int unsigned NOT NULL,
+  rev_reverted_to int unsigned NOT NULL,
+  KEY rev_reverted_by(rev_reverted_by)
+) MAX_ROWS=100000000000 AVG_ROW_LENGTH=64 ENGINE MyISAM;
+
 -- Special table storing info about namespaces
 CREATE TABLE namespaces (
   code smallint NOT NULL,
@@ -6,35 +6,93 @@ Created on Sat Mar 29 22:13:19 2014
 """
 from lxml import etree
 import subprocess
+import bz2
 import os
 from page import Page
-from revision import Revision
+from revision import Revision, text_detector, text_cache, process_text
 from logitem import LogItem
+from filters import ItemFilter
+from reverts import revert_detector, revision_key
+from index import PageIndex, build_index
+from readers import (RangeFile, BZ2StreamReader, ChunkReader,
+                     open_native, find_forward, read_root_tag,
+                     BZ2_STREAM_RE, PAGE_RE, ROOT_END_TAG, BUFFER_SIZE)
 # from user import User
 from wikidat.utils import maps
 
 
+# Elements of dump files handled by the XML parser. End events for any
+# other element are filtered out by lxml before reaching Python code.
+DUMP_TAGS = ('namespaces', 'contributor', 'revision', 'page', 'logitem')
+
+
+class LocalNames(dict):
+    """
+    Maps qualified tag names ({namespace}tag) to local tag names. Each
+    qualified name is split only the first time it is found in the dump.
+    """
+    def __missing__(self, qname):
+        local = qname.split('}')[-1]
+        self[qname] = local
+        return local
+
+
+def iterparse_dump(in_stream, tags=DUMP_TAGS):
+    """
+    Return an iterparse over end events of the given elements, in any
+    XML namespace (dumps may follow different export schema versions).
+    """
+    return etree.iterparse(in_stream, huge_tree=True,
+                           tag=['{*}' + tag for tag in tags])
+
+
 class DumpFile(object):
     """
     Models dump files and associated methods to extract their data
     """
-    def __init__(self, path):
+    def __init__(self, path, buffer_size=BUFFER_SIZE, native=True):
+        """
+        :Parameters:
+            path : `str`
+                the path to the dump file to read
+            buffer_size : `int`
+                size in bytes of read buffers for the dump file
+            native : `bool`
+                decompress data in-process whenever the file format is
+                supported. Otherwise, an external program is always used.
+        """
         self.path = path
+        self.ext = maps.EXT_RE.search(self.path).groups()[0]
+        self.buffer_size = buffer_size
+        self.native = native
+        self.root_tag = None
 
     def open_dump(self):
         """
         Turns a path to a dump file into a file-like object of (decompressed)
         XML data.
 
-        :Parameters:
-            path : `str`
-                the path to the dump file to read
+        Uncompressed files are memory-mapped, while bz2, gzip and lzma
+        files are decompressed in-process. The external programs in
+        maps.EXTENSIONS are only used for other formats (7z) or if the
+        native reader is disabled.
+        """
+        if self.native:
+            in_stream = open_native(self.path, self.ext,
+                                    buffer_size=self.buffer_size)
+            if in_stream is not None:
+                return in_stream
+        return self._open_pipe()
+
+    def _open_pipe(self):
+        """
+        Decompress dump file with an external program, returning a pipe
+        to read XML data from its standard output.
         """
-        match = maps.EXT_RE.search(self.path)
-        ext = match.groups()[0]
         p = subprocess.Popen(
-            "%s %s" % (maps.EXTENSIONS[ext], self.path),
+            "%s %s" % (maps.EXTENSIONS[self.ext], self.path),
             shell=True,
+            bufsize=self.buffer_size,
             stdout=subprocess.PIPE,
             stderr=open(os.devnull, "w")
         )
@@ -42,100 +100,499 @@ class DumpFile(object):
         # return False
         return p.stdout
 
+    def chunks(self, num_chunks):
+        """
+        Split the dump file in (up to) num_chunks page-aligned chunks, that
+        can be parsed independently by different processes.
 
-def process_xml(dump_file=None):
-    rev_parent_id = None
-    page_dict = None
+        Chunk boundaries are placed on <page> tags (uncompressed XML) or on
+        bz2 stream boundaries (bz2 multistream files, in which every stream
+        holds complete pages). Other formats cannot be split, so a single
+        chunk covering the whole file is returned.
 
-    in_stream = dump_file.open_dump()
-    for event, elem in etree.iterparse(in_stream, huge_tree=True):
-        # Drop tag namespace
-        tag = elem.tag.split('}')[1]
+        Returns a list of (start, end) byte offsets in the dump file, or
+        [None] if the file is not split.
+        """
+        if num_chunks <= 1 or self.ext not in ('xml', 'bz2'):
+            return [None]
 
-        # Insert namespace info in DB
-        if tag == 'namespaces':
-            ns_dict = {int(c.attrib.get('key')): c.text for c in elem}
-            ns_dict[0] = ''
+        size = os.path.getsize(self.path)
+        offsets = [0]
+        for num in range(1, num_chunks):
+            target = max(size * num // num_chunks, offsets[-1] + 1)
+            offset = self._find_boundary(target)
+            if offset is None:
+                break
+            if offset > offsets[-1]:
+                offsets.append(offset)
+        offsets.append(size)
 
-            ns_list = ''
-            for ns in ns_dict.iteritems():
-                ns_list = "".join([ns_list, '(', str(ns[0]), ',',
-                                   "'", ns[1], "'),"])
-            ns_list = ns_list[:-1]
+        if len(offsets) <= 2:
+            return [None]
+        return zip(offsets[:-1], offsets[1:])
 
-#                ns_insert = "".join(["INSERT INTO namespaces VALUES",
-#                                     ns_list])
+    def _find_boundary(self, offset):
+        """
+        Return offset of the first chunk boundary found at or after offset
+        """
+        if self.ext == 'xml':
+            return find_forward(self.path, offset, PAGE_RE)
 
-            # print ns_insert
-            # Write ns_insert to DB
-            # dbutils.send_query(con, cursor, ns_insert, 5, log_file)
+        # Make sure that a candidate bz2 stream header is a true one, and
+        # not a random match inside compressed data
+        while True:
+            offset = find_forward(self.path, offset, BZ2_STREAM_RE)
+            if offset is None:
+                return None
+            raw = RangeFile(self.path, offset)
+            decomp = bz2.BZ2Decompressor()
+            data = ''
+            try:
+                while not data.strip():
+                    block = raw.read(256*1024)
+                    if not block:
+                        break
+                    data = decomp.decompress(block)
+            except (IOError, EOFError):
+                data = ''
+            finally:
+                raw.close()
+            if data.lstrip().startswith('<page>'):
+                return offset
+            offset += 1
 
-        # Retrieve contributor info to be embedded in current revision
+    def open_chunk(self, chunk):
+        """
+        Turns a chunk of a dump file, returned by method chunks(), into a
+        file-like object of (decompressed) well-formed XML data.
+
+        :Parameters:
+            chunk : `tuple`
+                (start, end) byte offsets of the chunk in the dump file
+        """
+        start, end = chunk
+        body = RangeFile(self.path, start, end, buffer_size=self.buffer_size)
+        if self.ext == 'bz2':
+            body = BZ2StreamReader(body, buffer_size=self.buffer_size)
+        # Only the first chunk includes the opening root tag (and siteinfo)
+        # and only the last one includes the closing root tag
+        prefix = self._root_tag() if start > 0 else ''
+        suffix = ROOT_END_TAG if end < os.path.getsize(self.path) else ''
+        return ChunkReader(body, prefix=prefix, suffix=suffix)
+
+    def _root_tag(self):
+        """
+        Retrieve opening tag of the root element (including XML namespace
+        declarations) from the header of the dump file
+        """
+        if self.root_tag is None:
+            self.root_tag = read_root_tag(self.open_dump())
+        return self.root_tag
+
+    def xml_size(self):
+        """
+        Return size in bytes of the XML data of the dump file: its size for
+        uncompressed files, or an upper estimate for compressed ones (see
+        maps.COMPRESSION_RATIOS)
+        """
+        return (os.path.getsize(self.path) *
+                maps.COMPRESSION_RATIOS.get(self.ext, 1))
+
+    def index_path(self):
+        """
+        Default path to the page index of this dump file
+        """
+        return self.path + '.idx'
+
+    def build_index(self, index_path=None, multistream_index=None):
+        """
+        Build a persistent page index for this dump file (see index module)
+        to extract selected pages with extract_pages. Return the PageIndex.
+
+        :Parameters:
+            index_path : `str`
+                the path to the index file. Default is index_path().
+            multistream_index : `str`
+                the path to the official index of a bz2 multistream file.
+                If None, it is looked up next to the dump file, and the dump
+                file is scanned if it is not found.
+        """
+        if index_path is None:
+            index_path = self.index_path()
+        return build_index(self.path, index_path,
+                           multistream_index=multistream_index,
+                           buffer_size=self.buffer_size)
+
+    def extract_pages(self, page_ids=None, titles=None, index_path=None,
+                      parser=None, **kwargs):
+        """
+        Yield Page and Revision items of selected pages only, seeking to
+        their position in the dump file with the page index (which is
+        built if it does not exist yet).
+
+        :Parameters:
+            page_ids : `list`
+                page ids of pages to extract
+            titles : `list`
+                titles (unicode strings) of pages to extract
+            index_path : `str`
+                the path to the index file. Default is index_path().
+            parser : `function`
+                parser backend, process_xml (default) or
+                dump_expat.process_xml_expat. Other keyword arguments are
+                passed to it.
+        """
+        if index_path is None:
+            index_path = self.index_path()
+        if os.path.isfile(index_path):
+            page_index = PageIndex(index_path)
+        else:
+            page_index = self.build_index(index_path)
+        try:
+            selected = set(int(page_id) for page_id in page_ids or [])
+            for title in titles or []:
+                page_id = page_index.page_id(title)
+                if page_id is not None:
+                    selected.add(page_id)
+            chunks = page_index.chunks(selected)
+        finally:
+            page_index.close()
+
+        if parser is None:
+            parser = process_xml
+        for chunk in sorted(chunks):
+            item_filter = ItemFilter(page_list=chunks[chunk])
+            for item in parser(dump_file=self, chunk=chunk,
+                               item_filter=item_filter, **kwargs):
+                yield item
+
+
+class ItemBuilder(object):
+    """
+    Builds Page, Revision and LogItem elements from the fields of XML
+    elements extracted from a dump file. Keeps track of the state of the
+    parsing process (current page, parent of next revision, namespaces),
+    so that all parser backends yield identical items.
+
+    In metadata only mode, text-related fields of revisions (see
+    revision.process_text) are computed here, and the text is dropped
+    before revisions are sent to other processes. FA, FLIST and GA
+    detection is only done if a language is given (stats of detection are
+    printed by parser backends at the end). Text metadata of reverts and
+    identical revisions is taken from a cache of up to text_cache_size
+    texts (see revision.TextCache), whose counters are published with
+    stats of the stage, if given. Text is hashed with hash_type and, with
+    trust_dump, its length and hash are taken from the dump file when
+    available (see revision.text_fields).
+
+    Identity reverts of up to revert_radius revisions are detected among
+    revisions kept by the item filter (see reverts.RevertDetector), and
+    revisions carry a field 'revert' ([reverted_to, reverted ids], or
+    None). A revert_radius of 0 disables detection.
+
+    Pages and revisions discarded by an item filter (see filters.ItemFilter)
+    are never built. Parser backends check skip_page to avoid any work on
+    elements of discarded pages.
+
+    If a chunk number is given, pages and revisions carry a field 'seq' to
+    track their loading in checkpoints (see checkpoint module):
+    [chunk_num, page_seq, page_id] for pages and [chunk_num, page_seq,
+    rev_seq, page_id] for revisions, numbered from 0 in this chunk.
+    """
+    def __init__(self, metadata_only=False, lang=None, detect_FA=True,
+                 detect_FLIST=True, detect_GA=True, item_filter=None,
+                 chunk_num=None, text_cache_size=10000, hash_type='sha256',
+                 trust_dump=False, revert_radius=15, stats=None):
+        self.ns_dict = {}
+        self.page_dict = None
+        self.contrib_dict = None
+        self.rev_parent_id = None
+        self.skip_page = False
+
+        self.chunk_num = chunk_num
+        self.page_seq = -1
+        self.rev_seq = -1
+
+        if item_filter is not None and item_filter.is_empty():
+            item_filter = None
+        self.item_filter = item_filter
+
+        self.metadata_only = metadata_only
+        self.lang = lang
+        if lang is not None:
+            self.detector = text_detector(lang, detect_FA=detect_FA,
+                                          detect_FLIST=detect_FLIST,
+                                          detect_GA=detect_GA)
+        else:
+            self.detector = None
+        self.cache = (text_cache(text_cache_size, stats) if metadata_only
+                      else None)
+        self.hash_type = hash_type
+        self.trust_dump = trust_dump
+        self.reverts = revert_detector(revert_radius)
+
+    def needs_text(self):
+        """
+        Return True if the full text of revisions must be kept. Otherwise,
+        parser backends can compute text metadata on the fly, while
+        reading the text.
+        """
+        return not self.metadata_only or self.detector is not None
+
+    def namespaces(self, ns_dict):
+        """
+        Register namespaces of this wiki, as a dict {key: name}
+        """
+        ns_dict[0] = ''
+        self.ns_dict = ns_dict
+
+        ns_list = ''
+        for ns in ns_dict.iteritems():
+            ns_list = "".join([ns_list, '(', str(ns[0]), ',',
+                               "'", ns[1], "'),"])
+        ns_list = ns_list[:-1]
+
+#            ns_insert = "".join(["INSERT INTO namespaces VALUES",
+#                                 ns_list])
+
+        # print ns_insert
+        # Write ns_insert to DB
+        # dbutils.send_query(con, cursor, ns_insert, 5, log_file)
+
+    def contributor(self, contrib_dict):
+        """
+        Register contributor info to be embedded in current revision
+        """
         # TODO: Handle contributor information properly
-        if tag == 'contributor':
+        if not self.skip_page:
+            self.contrib_dict = contrib_dict
+#        yield User(data_dict=contrib_dict)
+
+    def start_page(self, page_dict):
+        """
+        Register fields of current page (children of page above its first
+        revision tag)
+        """
+        self.page_dict = page_dict
+        self.skip_page = (self.item_filter is not None and
+                          not self.item_filter.match_page(page_dict))
+        if not self.skip_page:
+            self.page_seq += 1
+            if self.reverts is not None:
+                self.reverts.start_page()
+
+    def revision(self, rev_dict):
+        """
+        Return Revision item from the fields of a revision element, or
+        None if it is discarded by the item filter
+        """
+        if self.skip_page:
+            return None
+        if (self.item_filter is not None and
+                not self.item_filter.match_revision(rev_dict)):
+            # Discarded revisions are still parents of the next ones
+            self.rev_parent_id = rev_dict['id']
+            self.contrib_dict = None
+            return None
+
+        # Embed page_id, contrib_dict and return item
+        rev_dict['page_id'] = self.page_dict['id']
+        # To skip pattern matching for non-articles
+        rev_dict['ns'] = self.page_dict['ns']
+        rev_dict['contrib_dict'] = self.contrib_dict
+        rev_dict['rev_parent_id'] = self.rev_parent_id
+
+        rev_dict['item_type'] = 'revision'
+
+        # Metadata only mode, compute text metadata and drop text
+        # (unless a parser backend already did it)
+        if self.metadata_only and 'text_hash' not in rev_dict:
+            rev_dict['text_hash'] = process_text(rev_dict,
+                                                 detector=self.detector,
+                                                 cache=self.cache,
+                                                 hash_type=self.hash_type,
+                                                 trust_dump=self.trust_dump)
+            del rev_dict['text']
+
+        if self.reverts is not None:
+            rev_dict['revert'] = self.reverts.add(
+                rev_dict['id'], revision_key(rev_dict, self.trust_dump))
+
+        if self.chunk_num is not None:
+            self.rev_seq += 1
+            rev_dict['seq'] = [self.chunk_num, self.page_seq, self.rev_seq,
+                               int(rev_dict['page_id'])]
+
+        # Save rev_id (rev_parent_id of the next revision item)
+        self.rev_parent_id = rev_dict['id']
+        # Clear up contributor dictionary
+        self.contrib_dict = None
+        return Revision(rev_dict)
+
+    def end_page(self):
+        """
+        Return Page item for current page, once all its revisions are done,
+        or None if it is discarded by the item filter
+        """
+        page_dict = self.page_dict
+        skip_page = self.skip_page
+
+        self.page_dict = None
+        self.rev_parent_id = None
+        self.skip_page = False
+        if skip_page or page_dict is None:
+            return None
+        page_dict['item_type'] = 'page'
+        if self.chunk_num is not None:
+            page_dict['seq'] = [self.chunk_num, self.page_seq,
+                                int(page_dict['id'])]
+        return Page(page_dict)
+
+    def logitem(self, log_dict):
+        """
+        Return LogItem from the fields of a logitem element
+        """
+        # Get namespace for this log item from page title prefix
+        if 'logtitle' in log_dict:
+            ns_prefix = log_dict['logtitle'].split(':')
+            if (len(ns_prefix) == 2 and ns_prefix[0] in self.ns_dict):
+                log_dict['namespace'] = str(self.ns_dict[ns_prefix[0]])
+            else:
+                log_dict['namespace'] = '0'
+        else:
+            log_dict['logtitle'] = ''
+            log_dict['namespace'] = '-1000'  # Fake namespace
+
+        return LogItem(log_dict)
+
+
+def open_xml(dump_file, chunk=None):
+    """
+    Return file-like object of XML data from a dump file or a chunk of it
+    """
+    if chunk is None:
+        return dump_file.open_dump()
+    else:
+        return dump_file.open_chunk(chunk)
+
+
+def process_xml(dump_file=None, chunk=None, metadata_only=False, lang=None,
+                detect_FA=True, detect_FLIST=True, detect_GA=True,
+                item_filter=None, chunk_num=None, text_cache_size=10000,
+                hash_type='sha256', trust_dump=False, revert_radius=15,
+                stats=None):
+    """
+    Parse XML data from a dump file, yielding Page, Revision and LogItem
+    elements.
+
+    :Parameters:
+        dump_file : `DumpFile`
+            the dump file to read
+        chunk : `tuple`
+            (start, end) offsets of a chunk of the dump file returned by
+            DumpFile.chunks(). If None, the whole file is processed.
+        metadata_only : `bool`
+            yield revisions without text, but with text metadata (length,
+            hash, redirect and FA/FLIST/GA flags) already computed
+        lang : `str`
+            language for FA/FLIST/GA detection in metadata only mode. If
+            None, detection is disabled.
+        detect_FA, detect_FLIST, detect_GA : `bool`
+            enable detection of each type of template in metadata only mode
+        item_filter : `filters.ItemFilter`
+            discard pages and revisions not matching this filter
+        chunk_num : `int`
+            number of this chunk, to tag items with sequence numbers for
+            checkpoints. If None, items are not tagged.
+        text_cache_size : `int`
+            max. number of texts whose metadata is cached in metadata only
+            mode (see revision.TextCache), 0 to disable the cache
+        hash_type : `str`
+            hash of revision text in metadata only mode (see
+            revision.HASH_TYPES)
+        trust_dump : `bool`
+            take length and hash of revision text from the dump file in
+            metadata only mode, if available (see revision.text_fields)
+        revert_radius : `int`
+            max. number of revisions reverted by identity reverts detected
+            (see reverts.RevertDetector), 0 to disable detection
+        stats : `stats.StageStats`
+            counters of the XML reader, to publish those of the text cache
+    """
+    builder = ItemBuilder(metadata_only=metadata_only, lang=lang,
+                          detect_FA=detect_FA, detect_FLIST=detect_FLIST,
+                          detect_GA=detect_GA, item_filter=item_filter,
+                          chunk_num=chunk_num,
+                          text_cache_size=text_cache_size,
+                          hash_type=hash_type, trust_dump=trust_dump,
+                          revert_radius=revert_radius, stats=stats)
+    in_stream = open_xml(dump_file, chunk)
+    names = LocalNames()
+    for event, elem in iterparse_dump(in_stream):
+        # Drop tag namespace
+        tag = names[elem.tag]
+
+        # Insert namespace info in DB
+        if tag == 'namespaces':
+            builder.namespaces({int(c.attrib.get('key')): c.text
+                                for c in elem})
+
+        # Retrieve contributor info to be embedded in current revision
+        if tag == 'contributor' and not builder.skip_page:
             # Build dict {tag:text} for contributor info
-            contrib_dict = {x.tag.split('}')[1]: x.text for x in elem}
-#                yield User(data_dict=contrib_dict)
+            builder.contributor({names[x.tag]: x.text for x in elem})
 
         if tag == 'revision':
             # First revision for current page, retrieve page info
-            if page_dict is None:
-                page = elem.getparent()
+            if builder.page_dict is None:
                 # Build dict {tag:text} for all children of page
-                # above first revision tag
-                page_dict = {x.tag.split('}')[1]: x.text for x in page}
-
-            # Build dict {tag:text} for all children of revision
-            rev_dict = {x.tag.split('}')[1]: x.text for x in elem}
-            # Embed page_id, contrib_dict and return item
-            rev_dict['page_id'] = page_dict['id']
-            # To skip pattern matching for non-articles
-            rev_dict['ns'] = page_dict['ns']
-            rev_dict['contrib_dict'] = contrib_dict
-            rev_dict['rev_parent_id'] = rev_parent_id
-
-            rev_dict['item_type'] = 'revision'
-            yield Revision(rev_dict)
-
-            # Save rev_id (rev_parent_id of the next revision item)
-            rev_parent_id = rev_dict['id']
-            # Clear up revision and contributor dictionaries
-            rev_dict = None
-            contrib_dict = None
+                # above first revision tag (the parser may have already
+                # added next revisions to the tree)
+                page_dict = {}
+                for x in elem.itersiblings(preceding=True):
+                    page_dict[names[x.tag]] = x.text
+                builder.start_page(page_dict)
+
+            # Build dict {tag:text} for all children of revision, unless
+            # the page is discarded by the item filter
+            if not builder.skip_page:
+                rev_dict = {}
+                for x in elem:
+                    child = names[x.tag]
+                    rev_dict[child] = x.text
+                    # Length of text in bytes, given by modern dump files
+                    if child == 'text' and 'bytes' in x.attrib:
+                        rev_dict['text_bytes'] = x.attrib['bytes']
+                rev = builder.revision(rev_dict)
+                if rev is not None:
+                    yield rev
+
             # Clear memory
             elem.clear()
             while elem.getprevious() is not None:
                 del elem.getparent()[0]
 
         if tag == 'page':
-            page_dict['item_type'] = 'page'
-            yield Page(page_dict)
+            page = builder.end_page()
+            if page is not None:
+                yield page
 
-            page_dict = None
-            rev_parent_id = None
             # Clear memory
             elem.clear()
             while elem.getprevious() is not None:
                 del elem.getparent()[0]
 
         if tag == 'logitem':
-            log_dict = {x.tag.split('}')[1]: x.text for x in elem}
-
-            # Get namespace for this log item from page title prefix
-            if 'logtitle' in log_dict:
-                ns_prefix = log_dict['logtitle'].split(':')
-                if (len(ns_prefix) == 2 and ns_prefix[0] in ns_dict):
-                    log_dict['namespace'] = str(ns_dict[ns_prefix[0]])
-                else:
-                    log_dict['namespace'] = '0'
-            else:
-                log_dict['logtitle'] = ''
-                log_dict['namespace'] = '-1000'  # Fake namespace
-
-            yield LogItem(log_dict)
+            yield builder.logitem({names[x.tag]: x.text for x in elem})
 
             #Clear memory
-            log_dict = None
             elem.clear()
             while elem.getprevious() is not None:
                 del elem.getparent()[0]
+
+    if builder.detector is not None and builder.detector.scanned:
+        print builder.detector.report()
+    if builder.cache is not None and builder.cache.lookups:
+        print builder.cache.report()
+    if builder.reverts is not None and builder.reverts.revisions:
+        print builder.reverts.report()
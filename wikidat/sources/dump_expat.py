@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 18 16:21:47 2014
+
+Event-driven (expat) parser backend for dump files. It yields the same
+Page, Revision and LogItem items as dump.process_xml, but it never builds
+an element tree: only the text of fields of interest is kept in memory.
+
+@author: jfelipe
+"""
+from xml.parsers import expat
+import hashlib
+from dump import ItemBuilder, open_xml
+from revision import text_digest
+
+# Elements whose children are collected as {tag: text} fields
+CONTAINERS = frozenset(['page', 'revision', 'contributor', 'logitem',
+                        'namespaces'])
+
+
+class DumpHandler(object):
+    """
+    Handler for expat events. Stores items built from dump elements in a
+    list, to be consumed by the caller after each block of data is parsed.
+
+    Text of an element is its character data before its first child
+    element (or None if empty), the same as the text attribute of lxml
+    elements.
+
+    Fields of the page are registered in the builder when its first
+    revision starts, so that nothing below a page discarded by the item
+    filter is collected.
+    """
+    def __init__(self, builder):
+        self.builder = builder
+        self.items = []
+        # Stack of open elements, as lists [name, text parts, fields, key]
+        self.stack = []
+        # Text parts of current element, if it is being collected
+        self.parts = None
+
+        # If the builder does not need revision text, its metadata is
+        # computed on the fly and the text is never stored. Trusted text
+        # (see trusted) is hashed, but not measured.
+        self.stream_text = not builder.needs_text()
+        self.in_text = False
+        self.text_trusted = False
+        self.text_hash = None
+        self.text_len = 0
+        self.text_head = u''
+
+    def start(self, name, attrs):
+        stack = self.stack
+        if self.parts is not None:
+            # First child of current element, stop collecting its text
+            self.parts = None
+        parent = stack[-1][0] if stack else None
+        builder = self.builder
+        if name == 'revision' and builder.page_dict is None:
+            # First revision for current page, retrieve page info
+            builder.start_page(dict(stack[-1][2]))
+        if builder.skip_page and parent != 'page':
+            # Element below a discarded page, ignore it
+            pass
+        elif self.stream_text and name == 'text' and parent == 'revision':
+            self.in_text = True
+            self.text_trusted = self.trusted(attrs)
+            self.text_hash = hashlib.new(builder.hash_type)
+            self.text_len = 0
+            self.text_head = u''
+        elif parent in CONTAINERS:
+            self.parts = []
+        if name == 'text' and parent == 'revision' and 'bytes' in attrs:
+            # Length of text in bytes, given by modern dump files
+            stack[-1][2]['text_bytes'] = attrs['bytes']
+        stack.append([name, self.parts,
+                      {} if name in CONTAINERS else None,
+                      attrs.get('key') if name == 'namespace' else None])
+
+    def end(self, name):
+        name, parts, fields, key = self.stack.pop()
+        self.parts = None
+        if self.in_text:
+            self.end_text(self.stack[-1][2])
+        if parts is not None:
+            text = ''.join(parts) if parts else None
+            parent_fields = self.stack[-1][2]
+            if key is not None:
+                # Namespace declaration in siteinfo
+                parent_fields[int(key)] = text
+            else:
+                parent_fields[name] = text
+
+        if fields is None:
+            return
+        builder = self.builder
+        if name == 'contributor':
+            builder.contributor(fields)
+        elif name == 'revision':
+            rev = builder.revision(fields)
+            if rev is not None:
+                self.items.append(rev)
+        elif name == 'page':
+            page = builder.end_page()
+            if page is not None:
+                self.items.append(page)
+        elif name == 'logitem':
+            self.items.append(builder.logitem(fields))
+        elif name == 'namespaces':
+            builder.namespaces(fields)
+
+    def characters(self, data):
+        if self.parts is not None:
+            self.parts.append(data)
+        elif self.in_text:
+            text = data.encode('utf-8')
+            self.text_hash.update(text)
+            self.text_len += len(text)
+            if len(self.text_head) < 9:
+                self.text_head += data[:9]
+
+    def end_text(self, rev_fields):
+        """
+        Store metadata of revision text computed on the fly, with the same
+        fields as revision.process_text without FA/FLIST/GA detection.
+        Trusted text takes its length from the dump file.
+        """
+        rev_fields['text_hash'] = text_digest(self.text_hash,
+                                              self.builder.hash_type)
+        if self.text_trusted:
+            rev_fields['len_text'] = rev_fields['text_bytes']
+        else:
+            rev_fields['len_text'] = str(self.text_len)
+        rev_fields['redirect'] = ('1' if self.text_head[0:9].upper() ==
+                                  '#REDIRECT' else '0')
+        rev_fields['is_fa'] = '0'
+        rev_fields['is_flist'] = '0'
+        rev_fields['is_ga'] = '0'
+        self.in_text = False
+        self.text_hash = None
+
+    def trusted(self, attrs):
+        """
+        Return True if the length of a revision text with these attributes
+        can be taken from the dump file: trust_dump, and a bytes attribute.
+        Its hash is always computed while streaming, since the <sha1> of the
+        revision only comes after the text, and it may be empty.
+        """
+        return self.builder.trust_dump and 'bytes' in attrs
+
+
+def process_xml_expat(dump_file=None, chunk=None, metadata_only=False,
+                      lang=None, detect_FA=True, detect_FLIST=True,
+                      detect_GA=True, item_filter=None, chunk_num=None,
+                      text_cache_size=10000, hash_type='sha256',
+                      trust_dump=False, revert_radius=15, stats=None):
+    """
+    Parse XML data from a dump file with expat, yielding Page, Revision and
+    LogItem elements. Arguments are the same as in dump.process_xml.
+
+    In metadata only mode without FA/FLIST/GA detection, revision text is
+    hashed and measured while it is read, and it is never stored (with
+    trust_dump, its length is taken from the dump file instead, see
+    DumpHandler.trusted).
+    """
+    in_stream = open_xml(dump_file, chunk)
+    handler = DumpHandler(ItemBuilder(metadata_only=metadata_only,
+                                      lang=lang, detect_FA=detect_FA,
+                                      detect_FLIST=detect_FLIST,
+                                      detect_GA=detect_GA,
+                                      item_filter=item_filter,
+                                      chunk_num=chunk_num,
+                                      text_cache_size=text_cache_size,
+                                      hash_type=hash_type,
+                                      trust_dump=trust_dump,
+                                      revert_radius=revert_radius,
+                                      stats=stats))
+
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = 1024*1024
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.CharacterDataHandler = handler.characters
+
+    while True:
+        data = in_stream.read(1024*1024)
+        parser.Parse(data, not data)
+        for item in handler.items:
+            yield item
+        del handler.items[:]
+        if not data:
+            break
+
+    builder = handler.builder
+    if builder.detector is not None and builder.detector.scanned:
+        print builder.detector.report()
+    if builder.cache is not None and builder.cache.lookups:
+        print builder.cache.report()
+    if builder.reverts is not None and builder.reverts.revisions:
+        print builder.reverts.report()
@@ -7,13 +7,34 @@ Created on Sun Mar 30 18:09:16 2014
 # import multiprocessing as mp
 import sys
 import os
+import logging
+import resource
+import shutil
+import socket
+import tempfile
 import time
+import functools
+import itertools
 import multiprocessing as mp
-from processors import Producer, Processor, Consumer
+import zmq
+from Queue import Empty
+from processors import (Producer, Processor, Consumer, channel_address,
+                        bind_address, public_endpoint, split_records)
 from dump import DumpFile, process_xml
+from dump_expat import process_xml_expat
+from filters import ItemFilter
+from checkpoint import DumpCheckpoint
+from records import PageRecord, RevisionRecord
+from autoscale import Autoscaler
+from remote import Registry
 from page import process_pages_to_file, store_pages_file_db
-from revision import process_revs_to_file, store_revs_file_db
+from revision import process_revs_to_file, store_revs_file_db, HASH_TYPES
+from wikidat.utils.comutils import WorkerCount
 from wikidat.utils.dbutils import MySQLDB
+from wikidat.utils.stats import PipelineMonitor
+
+# Available parser backends for XML dump files
+XML_PARSERS = {'lxml': process_xml, 'expat': process_xml_expat}
 
 
 class ETL(mp.Process):
@@ -23,8 +44,9 @@ class ETL(mp.Process):
     """
 
     def __init__(self, group=None, target=None, name=None, args=None,
-                 kwargs=None, paths_queue=None, page_fan=1, rev_fan=3,
-                 lang=None, db_name=None, db_user=None, db_passw=None):
+                 kwargs=None, paths_queue=None, xml_fan=1, page_fan=1,
+                 rev_fan=3, lang=None, db_name=None, db_user=None,
+                 db_passw=None):
         """
         Initialize new worfklow
         """
@@ -34,6 +56,7 @@ class ETL(mp.Process):
         self.kwargs = kwargs if kwargs is not None else {}
 
         self.paths_queue = paths_queue
+        self.xml_fan = xml_fan
         self.page_fan = page_fan; self.rev_fan = rev_fan; self.lang = lang
         self.db_name = db_name
         self.db_user = db_user
@@ -47,24 +70,167 @@ class PageRevisionETL(ETL):
     """
 
     def __init__(self, group=None, target=None, name=None, args=None,
-                 kwargs=None, paths_queue=None, lang=None, page_fan=1,
-                 rev_fan=3, page_cache_size=1000000, rev_cache_size=1000000,
-                 db_name=None, db_user=None, db_passw=None,
-                 base_port=None, control_port=None):
+                 kwargs=None, paths_queue=None, lang=None, xml_fan=1,
+                 page_fan=1, rev_fan=3, page_cache_size=1000000,
+                 rev_cache_size=1000000, read_buffer_size=4*1024*1024,
+                 xml_parser='lxml', metadata_only=False, detect_FA=True,
+                 detect_FLIST=True, detect_GA=True, text_cache_size=10000,
+                 hash_type='sha256', trust_dump=False, revert_radius=15,
+                 item_filter=None,
+                 resume=False, page_batch_size=1000, rev_batch_size=100,
+                 page_batch_linger=100, rev_batch_linger=100,
+                 page_codec='zlib1', rev_codec='zlib1', codec_min_size=1024,
+                 transport='ipc', page_credit_window=2, rev_credit_window=2,
+                 page_hwm=10, rev_hwm=10, stats_interval=10,
+                 autoscale=False, rev_fan_min=1, rev_fan_max=None,
+                 inline_max_size=32*1024*1024, db_name=None, db_user=None,
+                 db_passw=None, db_host='localhost', db_port=3306,
+                 base_port=None, bind_host='127.0.0.1', public_host=None,
+                 coordinator_port=None):
         """
         Initialize new PageRevision workflow
+
+        xml_parser selects the parser backend for dump files, either
+        'lxml' (iterparse) or 'expat' (event-driven, no element tree).
+
+        In metadata_only mode, text-related fields of revisions (length,
+        hash, redirect and FA/FLIST/GA flags) are computed by the XML
+        readers, and revision text is never sent to revision workers.
+        If detect_FA, detect_FLIST and detect_GA are all disabled, the
+        expat parser does not even store revision text in memory.
+
+        Text metadata of the last text_cache_size distinct texts is cached
+        by revision workers (or XML readers, in metadata_only mode), so
+        that reverts and identical revisions are not hashed nor scanned
+        again (see revision.TextCache). Hit rates of revision workers are
+        included in summaries of pipeline stats.
+
+        Revision text is hashed with hash_type (see revision.HASH_TYPES),
+        'sha1' giving the same digests as MediaWiki. With trust_dump, the
+        length and (for 'sha1') hash of revision text are taken from the
+        dump file, where available, instead of being computed.
+
+        XML readers detect identity reverts of up to revert_radius
+        revisions (0 disables it) while parsing, and they are loaded in
+        table revert (see reverts.RevertDetector). Texts are compared by
+        their <sha1> with trust_dump, or by their hash in metadata only
+        mode; otherwise, readers hash every text with MD5 (see
+        reverts.revision_key).
+
+        item_filter (see filters.ItemFilter) discards pages and revisions
+        in XML readers, before any further processing.
+
+        Loaders record checkpoints of pages completely loaded from every
+        dump file, in its logs directory. With resume, data loading for
+        each dump file restarts after the pages in its last checkpoint
+        (files completely loaded are skipped).
+
+        Pages and revisions are sent between processes in batches of up to
+        page_batch_size/rev_batch_size items, or whatever is collected
+        within page_batch_linger/rev_batch_linger milliseconds. Messages
+        larger than codec_min_size bytes are compressed with page_codec and
+        rev_codec (see comutils.CODECS).
+
+        transport selects the channels between processes: 'ipc' (Unix
+        domain sockets, in a temporary directory of this ETL line) or 'tcp'
+        (loopback, using ports from base_port on, or ephemeral ports chosen
+        by the OS if base_port is None, so that any number of ETL lines can
+        run at the same time).
+
+        Memory used by every stage is bounded: workers request at most
+        page_credit_window/rev_credit_window batches in advance from each
+        XML reader, and at most page_hwm/rev_hwm batches wait in the send
+        queue of each worker to the loaders, plus as many in the receive
+        queue of the loader for each worker (ZeroMQ high-water marks apply
+        per connection). Upstream stages block when downstream stages are
+        saturated.
+
+        Every stage publishes its counters (items, bytes, time blocked on
+        receiving and sending) on a stats channel, and a summary of every
+        group of stages is written to the log of each dump file every
+        stats_interval seconds (0 disables it, see stats.PipelineMonitor).
+
+        With autoscale, revision workers are started and retired according
+        to these stats, starting with rev_fan workers and keeping between
+        rev_fan_min and rev_fan_max (number of CPUs, by default) of them
+        (see autoscale.Autoscaler).
+
+        Dump files with less than inline_max_size bytes of XML data (0 to
+        disable), estimated from their compressed size (see
+        dump.DumpFile.xml_size), are processed in this process, chaining
+        parser, workers and loaders as plain generators, with the same
+        output (see _run_inline).
+
+        In distributed mode (tcp transport with a coordinator_port), revision
+        workers on other hosts register with this ETL line on that port and
+        run along with local workers (see remote.Registry). Channels are
+        bound to bind_host (* for all interfaces), and all workers connect
+        to them at public_host (bind_host by default, or the host name if
+        bound to all interfaces).
         """
+        if xml_parser not in XML_PARSERS:
+            raise RuntimeError('Unsupported XML parser ' + xml_parser)
+        if hash_type not in HASH_TYPES:
+            raise RuntimeError('Unsupported hash type ' + hash_type)
+        if rev_fan_max is None:
+            rev_fan_max = mp.cpu_count()
+        if autoscale and not stats_interval:
+            raise RuntimeError('Autoscaling of revision workers requires '
+                               'pipeline stats (stats_interval > 0)')
+        if autoscale and not rev_fan_min <= rev_fan <= rev_fan_max:
+            raise RuntimeError('rev_fan must be between rev_fan_min and '
+                               'rev_fan_max for autoscaling')
+        if coordinator_port is not None and transport != 'tcp':
+            raise RuntimeError('Distributed mode (coordinator_port) '
+                               'requires tcp transport')
+        if public_host is None and coordinator_port is not None:
+            public_host = (socket.getfqdn() if bind_host in ('*', '0.0.0.0')
+                           else bind_host)
         super(PageRevisionETL,
               self).__init__(group=None, target=None, name=name, args=None,
                              kwargs=None, paths_queue=paths_queue,
-                             page_fan=page_fan, rev_fan=rev_fan, lang=lang,
+                             xml_fan=xml_fan, page_fan=page_fan,
+                             rev_fan=rev_fan, lang=lang,
                              db_name=db_name,
                              db_user=db_user, db_passw=db_passw)
 
         self.page_cache_size = page_cache_size
         self.rev_cache_size = rev_cache_size
+        self.read_buffer_size = read_buffer_size
+        self.xml_parser = xml_parser
+        self.metadata_only = metadata_only
+        self.detect_FA = detect_FA
+        self.detect_FLIST = detect_FLIST
+        self.detect_GA = detect_GA
+        self.text_cache_size = text_cache_size
+        self.hash_type = hash_type
+        self.trust_dump = trust_dump
+        self.revert_radius = revert_radius
+        self.item_filter = item_filter
+        self.resume = resume
+        self.page_batch_size = page_batch_size
+        self.rev_batch_size = rev_batch_size
+        self.page_batch_linger = page_batch_linger
+        self.rev_batch_linger = rev_batch_linger
+        self.page_codec = page_codec
+        self.rev_codec = rev_codec
+        self.codec_min_size = codec_min_size
+        self.transport = transport
+        self.page_credit_window = page_credit_window
+        self.rev_credit_window = rev_credit_window
+        self.page_hwm = page_hwm
+        self.rev_hwm = rev_hwm
+        self.stats_interval = stats_interval
+        self.autoscale = autoscale
+        self.rev_fan_min = rev_fan_min
+        self.rev_fan_max = rev_fan_max
+        self.inline_max_size = inline_max_size
+        self.db_host = db_host
+        self.db_port = db_port
         self.base_port = base_port
-        self.control_port = control_port
+        self.bind_host = bind_host
+        self.public_host = public_host
+        self.coordinator_port = coordinator_port
 
     def run(self):
         """
@@ -82,78 +248,33 @@ class PageRevisionETL(ETL):
               time.strftime("%Y-%m-%d %H:%M:%S %Z",
                             time.localtime()))
 
-        db_ns = MySQLDB(host='localhost', port=3306, user=self.db_user,
-                        passwd=self.db_passw, db=self.db_name)
+        db_ns = MySQLDB(host=self.db_host, port=self.db_port,
+                        user=self.db_user, passwd=self.db_passw,
+                        db=self.db_name)
         db_ns.connect()
 
-        db_pages = MySQLDB(host='localhost', port=3306,
+        db_pages = MySQLDB(host=self.db_host, port=self.db_port,
                            user=self.db_user, passwd=self.db_passw,
                            db=self.db_name)
         db_pages.connect()
 
-        db_revs = MySQLDB(host='localhost', port=3306, user=self.db_user,
-                          passwd=self.db_passw, db=self.db_name)
+        db_revs = MySQLDB(host=self.db_host, port=self.db_port,
+                          user=self.db_user, passwd=self.db_passw,
+                          db=self.db_name)
         db_revs.connect()
 
+        # Socket files of ipc channels are private to this ETL line, and
+        # tcp channels take ephemeral ports unless a base port is given
+        ipc_dir = None
+        if self.transport == 'ipc':
+            ipc_dir = tempfile.mkdtemp(prefix='wikidat-%s-' % self.name)
+        address = channel_address(self.transport, ipc_dir,
+                                  auto_ports=self.base_port is None,
+                                  host=self.bind_host)
+        context = zmq.Context()
+
         # DATA EXTRACTION
         for path in iter(self.paths_queue.get, 'STOP'):
-            # Start subprocess to extract elements from revision dump file
-            dump_file = DumpFile(path)
-            xml_reader = Producer(name='_'.join([self.name, 'xml_reader']),
-                                  target=process_xml,
-                                  kwargs=dict(
-                                      dump_file=dump_file),
-                                  page_consumers=self.page_fan,
-                                  rev_consumers=self.rev_fan,
-                                  push_pages_port=self.base_port,
-                                  push_revs_port=self.base_port+1,
-                                  control_port=self.control_port)
-
-            print "Starting data extraction from XML revision history file"
-            print "Dump file: " + path
-            xml_reader.start()
-
-            # List to keep tracking of page and revision workers
-            workers = []
-            db_workers_revs = []
-            # Create and start page processes
-            for worker in range(self.page_fan):
-                print "page worker num. ", worker, "started"
-                process_page = Processor(name='_'.join([self.name,
-                                                        'process_page',
-                                                        unicode(worker)]),
-                                         target=process_pages_to_file,
-                                         producers=1, consumers=1,
-                                         pull_port=self.base_port,
-                                         push_port=self.base_port+2,
-                                         control_port=self.control_port)
-                process_page.start()
-                workers.append(process_page)
-
-            # Create and start revision processes
-            for worker in range(self.rev_fan):
-                print "revision worker num. ", worker, "started"
-
-                db_wrev = MySQLDB(host='localhost', port=3306,
-                                  user=self.db_user,
-                                  passwd=self.db_passw, db=self.db_name)
-                db_wrev.connect()
-
-                process_revision = Processor(name='_'.join([self.name,
-                                                            'process_revision',
-                                                            unicode(worker)]),
-                                             target=process_revs_to_file,
-                                             kwargs=dict(
-                                                 con=db_wrev,
-                                                 lang=self.lang),
-                                             producers=1, consumers=1,
-                                             pull_port=self.base_port+1,
-                                             push_port=self.base_port+3,
-                                             control_port=self.control_port)
-                process_revision.start()
-                workers.append(process_revision)
-                db_workers_revs.append(db_wrev)
-
             # Create directory for logging files if it does not exist
             log_dir = os.path.join(os.path.split(path)[0], 'logs')
             tmp_dir = os.path.join(os.getcwd(),
@@ -166,38 +287,270 @@ class PageRevisionETL(ETL):
                 os.makedirs(tmp_dir)
             log_file = os.path.join(log_dir, file_name + '.log')
 
+            # Split dump file in page-aligned chunks, parsed in parallel by
+            # their own XML reader. When resuming, chunks are taken from the
+            # last checkpoint of this file.
+            dump_file = DumpFile(path, buffer_size=self.read_buffer_size)
+            checkpoint = DumpCheckpoint(log_dir, file_name)
+            chunks = checkpoint.chunks() if self.resume else None
+            if chunks is None:
+                chunks = dump_file.chunks(self.xml_fan)
+                checkpoint.reset(chunks)
+                resume_points = [(0, None)] * len(chunks)
+            else:
+                resume_points = checkpoint.resume_points(len(chunks))
+                self._clean_partial_pages(db_pages, resume_points)
+
+            # Chunks not completely loaded yet
+            active = [num for num, point in enumerate(resume_points)
+                      if point is not None]
+            if not active:
+                print "Dump file %s already loaded, skipping it" % path
+                self.paths_queue.task_done()
+                continue
+
+            print "Starting data extraction from XML revision history file"
+            print "Dump file: " + path
+            # Options for text processing, done either by XML readers
+            # (metadata only mode) or by revision workers
+            text_opts = dict(lang=self.lang, detect_FA=self.detect_FA,
+                             detect_FLIST=self.detect_FLIST,
+                             detect_GA=self.detect_GA,
+                             text_cache_size=self.text_cache_size,
+                             hash_type=self.hash_type,
+                             trust_dump=self.trust_dump)
+            reader_opts = dict(metadata_only=self.metadata_only,
+                               revert_radius=self.revert_radius)
+            if self.metadata_only:
+                reader_opts.update(text_opts)
+
+            # Arguments of the parser for every chunk to extract
+            parser_kwargs = []
+            for chunk_num in active:
+                # Skip pages already loaded, according to checkpoint
+                item_filter = self.item_filter
+                bound = resume_points[chunk_num][0]
+                if bound > 0:
+                    if item_filter is None:
+                        item_filter = ItemFilter()
+                    item_filter = item_filter.resume(bound)
+                    print "Resuming chunk %s from page_id %s" % (chunk_num,
+                                                                 bound)
+                parser_kwargs.append(dict(reader_opts,
+                                          item_filter=item_filter,
+                                          dump_file=dump_file,
+                                          chunk=chunks[chunk_num],
+                                          chunk_num=chunk_num))
+
+            page_loader_opts = dict(con=db_pages, log_file=log_file,
+                                    tmp_dir=tmp_dir,
+                                    file_rows=self.page_cache_size,
+                                    etl_prefix=self.name,
+                                    checkpoint=checkpoint.loader(
+                                        'page', len(chunks)),
+                                    chunks=active)
+            rev_loader_opts = dict(con=db_revs, log_file=log_file,
+                                   tmp_dir=tmp_dir,
+                                   file_rows=self.rev_cache_size,
+                                   etl_prefix=self.name,
+                                   checkpoint=checkpoint.loader(
+                                       'revision', len(chunks)),
+                                   chunks=active)
+
+            # Small dump files are not worth starting the whole pipeline
+            if dump_file.xml_size() < self.inline_max_size:
+                print "Small dump file, processing it in a single process"
+                self._run_inline(parser_kwargs, text_opts, page_loader_opts,
+                                 rev_loader_opts)
+                self.paths_queue.task_done()
+                continue
+
+            channels = self._channels(len(active))
+            stats_port = None
+            monitor = None
+            if self.stats_interval:
+                monitor = PipelineMonitor(context,
+                                          bind_address(address,
+                                                       channels['stats']),
+                                          self.stats_interval,
+                                          self._stats_logger(log_file))
+                stats_port = monitor.endpoint
+                if self.public_host is not None:
+                    stats_port = public_endpoint(stats_port,
+                                                 self.public_host)
+            # Endpoints bound by XML readers and loaders, for workers
+            endpoints = mp.Queue()
+
+            self._print_memory_bounds(len(active))
+            # Number of revision workers, shared with XML readers and the
+            # loader when workers are added while running
+            rev_count = (WorkerCount(self.rev_fan)
+                         if self.autoscale or self.coordinator_port
+                         else self.rev_fan)
+
+            # Start subprocesses to extract elements from revision dump file
+            xml_readers = []
+            for num, kwargs in enumerate(parser_kwargs):
+                xml_reader = Producer(name='_'.join([self.name, 'xml_reader',
+                                                     unicode(num)]),
+                                      target=XML_PARSERS[self.xml_parser],
+                                      kwargs=kwargs,
+                                      page_consumers=self.page_fan,
+                                      rev_consumers=rev_count,
+                                      push_pages_port=channels['pages'][num],
+                                      push_revs_port=channels['revisions'][
+                                          num],
+                                      page_batch_size=self.page_batch_size,
+                                      page_batch_linger=self.page_batch_linger,
+                                      rev_batch_size=self.rev_batch_size,
+                                      rev_batch_linger=self.rev_batch_linger,
+                                      page_codec=self.page_codec,
+                                      rev_codec=self.rev_codec,
+                                      codec_min_size=self.codec_min_size,
+                                      address=address,
+                                      stats_port=stats_port,
+                                      stats_interval=self.stats_interval,
+                                      endpoints=endpoints,
+                                      target_stats=True)
+                xml_reader.start()
+                xml_readers.append(xml_reader)
+
             page_insert_db = Consumer(name='_'.join([self.name,
                                                      'insert_page']),
                                       target=store_pages_file_db,
-                                      kwargs=dict(con=db_pages,
-                                                  log_file=log_file,
-                                                  tmp_dir=tmp_dir,
-                                                  file_rows=self.page_cache_size,
-                                                  etl_prefix=self.name),
+                                      kwargs=page_loader_opts,
                                       producers=self.page_fan,
-                                      pull_port=self.base_port+2)
+                                      pull_port=channels['page_loader'],
+                                      address=address,
+                                      hwm=self.page_hwm,
+                                      stage='page_loader',
+                                      stats_port=stats_port,
+                                      stats_interval=self.stats_interval,
+                                      endpoints=endpoints)
 
             rev_insert_db = Consumer(name='_'.join([self.name,
                                                     'insert_revision']),
                                      target=store_revs_file_db,
-                                     kwargs=dict(con=db_revs,
-                                                 log_file=log_file,
-                                                 tmp_dir=tmp_dir,
-                                                 file_rows=self.rev_cache_size,
-                                                 etl_prefix=self.name),
-                                     producers=self.rev_fan,
-                                     pull_port=self.base_port+3)
+                                     kwargs=rev_loader_opts,
+                                     producers=rev_count,
+                                     pull_port=channels['rev_loader'],
+                                     address=address,
+                                     hwm=self.rev_hwm,
+                                     stage='rev_loader',
+                                     stats_port=stats_port,
+                                     stats_interval=self.stats_interval,
+                                     endpoints=endpoints)
 
             print "And inserting in DB..."
             page_insert_db.start()
             rev_insert_db.start()
 
+            # Connect workers to the endpoints actually bound
+            bound = self._bound_endpoints(
+                endpoints, channels['pages'] + channels['revisions'] +
+                [channels['page_loader'], channels['rev_loader']],
+                xml_readers + [page_insert_db, rev_insert_db])
+            if self.public_host is not None:
+                bound = dict((channel, public_endpoint(endpoint,
+                                                       self.public_host))
+                             for channel, endpoint in bound.iteritems())
+            pages_ports = [bound[channel] for channel in channels['pages']]
+            revs_ports = [bound[channel]
+                          for channel in channels['revisions']]
+
+            # List to keep tracking of page and revision workers
+            workers = []
+            db_workers_revs = []
+            # Create and start page processes
+            for worker in range(self.page_fan):
+                print "page worker num. ", worker, "started"
+                process_page = Processor(name='_'.join([self.name,
+                                                        'process_page',
+                                                        unicode(worker)]),
+                                         target=process_pages_to_file,
+                                         producers=len(xml_readers),
+                                         consumers=1,
+                                         pull_ports=pages_ports,
+                                         push_port=bound[
+                                             channels['page_loader']],
+                                         batch_size=self.page_batch_size,
+                                         batch_linger=self.page_batch_linger,
+                                         codec=self.page_codec,
+                                         codec_min_size=self.codec_min_size,
+                                         address=address,
+                                         credit_window=self.page_credit_window,
+                                         hwm=self.page_hwm,
+                                         record=PageRecord,
+                                         stage='page_worker',
+                                         stats_port=stats_port,
+                                         stats_interval=self.stats_interval)
+                process_page.start()
+                workers.append(process_page)
+
+            # Create and start revision processes
+            rev_worker_opts = dict(kwargs=text_opts,
+                                   producers=len(xml_readers),
+                                   consumers=1,
+                                   pull_ports=revs_ports,
+                                   push_port=bound[channels['rev_loader']],
+                                   batch_size=self.rev_batch_size,
+                                   batch_linger=self.rev_batch_linger,
+                                   codec=self.rev_codec,
+                                   codec_min_size=self.codec_min_size,
+                                   credit_window=self.rev_credit_window,
+                                   hwm=self.rev_hwm,
+                                   stats_port=stats_port,
+                                   stats_interval=self.stats_interval,
+                                   target_stats=True)
+            start_rev_worker = functools.partial(
+                self._start_rev_worker, worker_opts=rev_worker_opts,
+                db_cons=db_workers_revs)
+            autoscaler = None
+            if self.autoscale:
+                autoscaler = Autoscaler('rev_worker', start_rev_worker,
+                                        rev_count, self.rev_fan_min,
+                                        self.rev_fan_max, monitor.logger)
+                workers.extend(autoscaler.start(self.rev_fan))
+            else:
+                for worker in range(self.rev_fan):
+                    workers.append(start_rev_worker(worker))
+            # Remote revision workers register while XML readers run
+            registry = None
+            if self.coordinator_port is not None:
+                registry = Registry(name='_'.join([self.name, 'registry']),
+                                    count=rev_count,
+                                    worker_opts=rev_worker_opts,
+                                    address='tcp://%s:%d' % (
+                                        self.bind_host,
+                                        self.coordinator_port))
+                registry.start()
+
             print "Waiting for all processes to finish..."
-            xml_reader.join()
+            if monitor is not None:
+                stages = (xml_readers + workers +
+                          [page_insert_db, rev_insert_db])
+                callback = None
+                if autoscaler is not None:
+                    def callback(groups):
+                        started = autoscaler.update(groups)
+                        stages.extend(started)
+                        workers.extend(started)
+                for line in monitor.watch(stages, callback):
+                    print line
+                monitor.close()
+            for xml_reader in xml_readers:
+                xml_reader.join()
+            if registry is not None:
+                registry.stop()
             for w in workers:
                 w.join()
             page_insert_db.join()
             rev_insert_db.join()
+            # Peak of all child processes finished so far, not only those
+            # of this dump file
+            max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            print ("Max. resident memory of a process since the ETL line "
+                   "started: %.1f MB" % (max_rss / 1024.))
 
             # Mark this path as done
             self.paths_queue.task_done()
@@ -213,6 +566,161 @@ class PageRevisionETL(ETL):
         db_revs.close()
         for dbcon in db_workers_revs:
             dbcon.close()
+        context.term()
+        if ipc_dir is not None:
+            shutil.rmtree(ipc_dir, ignore_errors=True)
+
+    def _start_rev_worker(self, num, retire=None, worker_opts=None,
+                          db_cons=None):
+        """
+        Start and return revision worker number num, with options
+        worker_opts for its Processor and its own connection to DB
+        (appended to db_cons)
+        """
+        print "revision worker num. ", num, "started"
+
+        db_wrev = MySQLDB(host=self.db_host, port=self.db_port,
+                          user=self.db_user, passwd=self.db_passw,
+                          db=self.db_name)
+        db_wrev.connect()
+
+        opts = dict(worker_opts,
+                    kwargs=dict(worker_opts['kwargs'], con=db_wrev))
+        process_revision = Processor(name='_'.join([self.name,
+                                                    'process_revision',
+                                                    unicode(num)]),
+                                     target=process_revs_to_file,
+                                     record=RevisionRecord,
+                                     stage='rev_worker',
+                                     retire=retire,
+                                     **opts)
+        process_revision.start()
+        db_cons.append(db_wrev)
+        return process_revision
+
+    def _run_inline(self, parser_kwargs, text_opts, page_loader_opts,
+                    rev_loader_opts):
+        """
+        Extract, process and load pages and revisions of a dump file in
+        this process: chunks are parsed one after another, and items flow
+        through the targets of workers and loaders as plain generators.
+        Page records are kept in memory until all revisions are loaded.
+        """
+        parser = XML_PARSERS[self.xml_parser]
+        items = itertools.chain.from_iterable(parser(**kwargs)
+                                              for kwargs in parser_kwargs)
+        pages = []
+        revs = split_records(items, pages)
+        store_revs_file_db(process_revs_to_file(revs, **text_opts),
+                           **rev_loader_opts)
+        store_pages_file_db(process_pages_to_file(iter(pages)),
+                            **page_loader_opts)
+
+    def _channels(self, num_readers):
+        """
+        Return ports (tcp with a base port) or names of the channels of the
+        pipeline for num_readers XML readers: lists of 'pages' and
+        'revisions' channels (one per reader), 'page_loader', 'rev_loader'
+        and 'stats'
+        """
+        if self.transport == 'tcp' and self.base_port is not None:
+            # Readers other than the first one use consecutive ports after
+            # those of the loaders (base_port+3), followed by the stats port
+            pages = [self.base_port]
+            revisions = [self.base_port+1]
+            for num in range(1, num_readers):
+                pages.append(self.base_port+2+2*num)
+                revisions.append(self.base_port+3+2*num)
+            return dict(pages=pages, revisions=revisions,
+                        page_loader=self.base_port+2,
+                        rev_loader=self.base_port+3,
+                        stats=self.base_port+2+2*num_readers)
+        return dict(pages=['pages_%d' % num for num in range(num_readers)],
+                    revisions=['revisions_%d' % num
+                               for num in range(num_readers)],
+                    page_loader='page_loader', rev_loader='rev_loader',
+                    stats='stats')
+
+    def _bound_endpoints(self, endpoints, channels, processes):
+        """
+        Return dict of endpoints bound for channels by processes, collected
+        from the endpoints queue (see processors.bind_channel)
+        """
+        bound = {}
+        while len(bound) < len(channels):
+            try:
+                channel, endpoint = endpoints.get(timeout=1)
+            except Empty:
+                for process in processes:
+                    if not process.is_alive():
+                        raise RuntimeError('Process %s quit before binding '
+                                           'its channels' % process.name)
+                continue
+            bound[channel] = endpoint
+        return bound
+
+    def _stats_logger(self, log_file):
+        """
+        Return logger writing summaries of pipeline stats to the log file
+        of the current dump file
+        """
+        logger = logging.getLogger(self.name + '.stats')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        handler = logging.FileHandler(log_file)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+        return logger
+
+    def _print_memory_bounds(self, num_readers):
+        """
+        Print max. number of pages and revisions held by every stage of
+        the pipeline at the same time (items parsed by XML readers, but not
+        loaded in DB yet). Remote revision workers (distributed mode) are
+        not included.
+        """
+        for label, fan, batch_size, window, hwm in (
+                ('pages', self.page_fan, self.page_batch_size,
+                 self.page_credit_window, self.page_hwm),
+                ('revisions',
+                 self.rev_fan_max if self.autoscale else self.rev_fan,
+                 self.rev_batch_size, self.rev_credit_window, self.rev_hwm)):
+            # Batch being filled by every reader
+            readers = num_readers * batch_size
+            # Batches requested in advance plus one being processed, and
+            # the batch being filled for the loader
+            workers = fan * (num_readers * window + 2) * batch_size
+            # Send queue of every worker plus the receive queue of the
+            # loader, which holds up to hwm batches per connected worker
+            loader = 2 * fan * hwm * batch_size
+            remote = ''
+            if label == 'revisions' and self.coordinator_port is not None:
+                remote = ', plus those of remote workers'
+            print ("Max. %s in flight: %d (XML readers %d, workers %d, "
+                   "loader queues %d%s)" % (label, readers + workers + loader,
+                                            readers, workers, loader,
+                                            remote))
+
+    def _clean_partial_pages(self, con, resume_points):
+        """
+        Delete rows of pages that may have been partially loaded before
+        the last checkpoint of a dump file, since they will be loaded again
+        """
+        for point in resume_points:
+            if point is None or point[1] is None:
+                continue
+            first, last = point[1]
+            print "Deleting partially loaded pages %s to %s" % (first, last)
+            for table, column in (('page', 'page_id'),
+                                  ('revision', 'rev_page'),
+                                  ('revision_hash', 'rev_page'),
+                                  ('revert', 'rev_page')):
+                con.send_query("DELETE FROM %s WHERE %s BETWEEN %d AND %d" %
+                               (table, column, first, last))
+            con.commit()
 
 
 class PageRevisionMetaETL(ETL):
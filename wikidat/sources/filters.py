@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 19 10:05:12 2014
+
+Declarative filters for pages and revisions, evaluated by XML readers as
+soon as the relevant fields are known. Filtered out pages and revisions
+are never built, sent to workers nor loaded in the database.
+
+@author: jfelipe
+"""
+import copy
+import datetime
+import re
+
+# Accepted formats for the bounds of the date window. Timestamps in dump
+# files always follow the last one (ISO 8601, UTC).
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%SZ')
+DUMP_TIMESTAMP = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def dump_timestamp(value):
+    """
+    Convert a date (or date and time) string to the timestamp format of
+    dump files, so that timestamps can be compared as plain strings.
+    """
+    for date_format in DATE_FORMATS:
+        try:
+            date = datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+        return date.strftime(DUMP_TIMESTAMP)
+    raise RuntimeError('Invalid date in filter: ' + value)
+
+
+class ItemFilter(object):
+    """
+    Selects pages and revisions extracted from dump files. A page is kept
+    if it matches all page filters (namespace, page id range and title
+    pattern). A revision is kept if its page is kept and its timestamp is
+    in the date window. Filters set to None do not discard any item.
+    """
+    def __init__(self, namespaces=None, page_ids=None, title=None,
+                 date_start=None, date_end=None, page_list=None):
+        """
+        :Parameters:
+            namespaces : `list`
+                namespace codes of pages to keep (e.g. [0] for articles)
+            page_ids : `tuple`
+                (first, last) page ids to keep, both inclusive. Either of
+                them can be None for an open range.
+            title : `str`
+                regular expression searched in page titles
+            date_start : `str`
+                keep revisions saved at or after this date
+            date_end : `str`
+                keep revisions saved before this date
+            page_list : `list`
+                page ids of the only pages to keep
+        """
+        self.namespaces = (frozenset(str(ns) for ns in namespaces)
+                           if namespaces is not None else None)
+        if page_ids is not None:
+            first, last = page_ids
+            self.first_id = int(first) if first is not None else None
+            self.last_id = int(last) if last is not None else None
+        else:
+            self.first_id = self.last_id = None
+        self.title_re = (re.compile(title, re.UNICODE)
+                         if title is not None else None)
+        self.date_start = (dump_timestamp(date_start)
+                           if date_start is not None else None)
+        self.date_end = (dump_timestamp(date_end)
+                         if date_end is not None else None)
+        self.page_list = (frozenset(int(page_id) for page_id in page_list)
+                          if page_list is not None else None)
+
+    def is_empty(self):
+        """
+        Return True if this filter does not discard any item
+        """
+        return (self.namespaces is None and self.first_id is None and
+                self.last_id is None and self.title_re is None and
+                self.date_start is None and self.date_end is None and
+                self.page_list is None)
+
+    def resume(self, page_id):
+        """
+        Return a copy of this filter that also discards pages with a lower
+        page_id, to resume data loading from a checkpoint
+        """
+        item_filter = copy.copy(self)
+        if self.first_id is None or page_id > self.first_id:
+            item_filter.first_id = page_id
+        return item_filter
+
+    def match_page(self, page_dict):
+        """
+        Return True if a page (dict of fields ns, id and title) is kept
+        """
+        if (self.namespaces is not None and
+                page_dict['ns'] not in self.namespaces):
+            return False
+        if (self.first_id is not None or self.last_id is not None or
+                self.page_list is not None):
+            page_id = int(page_dict['id'])
+            if self.page_list is not None and page_id not in self.page_list:
+                return False
+            if self.first_id is not None and page_id < self.first_id:
+                return False
+            if self.last_id is not None and page_id > self.last_id:
+                return False
+        if (self.title_re is not None and
+                self.title_re.search(page_dict['title'] or u'') is None):
+            return False
+        return True
+
+    def match_revision(self, rev_dict):
+        """
+        Return True if a revision (dict of fields, including timestamp) of
+        a page that is kept is also kept
+        """
+        timestamp = rev_dict['timestamp']
+        if self.date_start is not None and timestamp < self.date_start:
+            return False
+        if self.date_end is not None and timestamp >= self.date_end:
+            return False
+        return True
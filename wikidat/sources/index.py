@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 19 18:47:20 2014
+
+Persistent index of pages in dump files, for random access to the full
+history of selected pages (see DumpFile.extract_pages).
+
+For every page, the index stores its page_id, its title and the byte range
+of the dump file holding it: the compressed bz2 stream in multistream files
+or the page element itself in uncompressed XML files. Byte ranges can be
+parsed with DumpFile.open_chunk.
+
+The index is stored in a SQLite database file. It is built from the
+official index of multistream dump files (*-multistream-index.txt.bz2)
+if available, or by scanning the dump file otherwise.
+
+@author: jfelipe
+"""
+import bz2
+import os
+import re
+import sqlite3
+import sys
+from xml.sax.saxutils import unescape
+from readers import open_mmap, BUFFER_SIZE
+from wikidat.utils import maps
+
+# Title and page_id at the beginning of every page element
+PAGE_HEAD_RE = re.compile(r'<page>\s*<title>([^<]*)</title>.*?<id>(\d+)</id>',
+                          re.DOTALL)
+# Entities found in page titles, other than &amp; &lt; &gt;
+TITLE_ENTITIES = {'&quot;': '"', '&#039;': "'"}
+
+# Number of pages inserted in the index in every transaction
+BATCH_SIZE = 10000
+
+
+def iter_bz2_streams(path, buffer_size=BUFFER_SIZE):
+    """
+    Yield (start, end, data) for every bz2 stream in a (multistream) bz2
+    file: byte range of the compressed stream and its decompressed data
+    """
+    with open(path, 'rb', buffer_size) as fobj:
+        decomp = bz2.BZ2Decompressor()
+        start = 0
+        out = []
+        while True:
+            block = fobj.read(buffer_size)
+            if not block:
+                break
+            while block:
+                try:
+                    out.append(decomp.decompress(block))
+                except EOFError:
+                    # Previous stream ended right at the end of the last read
+                    end = fobj.tell() - len(block)
+                    yield start, end, ''.join(out)
+                    decomp = bz2.BZ2Decompressor()
+                    start = end
+                    out = []
+                    continue
+                # Data past the end of current stream belongs to the next one
+                block = decomp.unused_data
+                if block:
+                    end = fobj.tell() - len(block)
+                    yield start, end, ''.join(out)
+                    decomp = bz2.BZ2Decompressor()
+                    start = end
+                    out = []
+        if out:
+            yield start, fobj.tell(), ''.join(out)
+
+
+def page_heads(data):
+    """
+    Yield (page_id, title, offset) for every page element in a string of
+    XML data
+    """
+    for match in PAGE_HEAD_RE.finditer(data):
+        title = unescape(match.group(1), TITLE_ENTITIES).decode('utf-8')
+        yield int(match.group(2)), title, match.start()
+
+
+def scan_xml(path):
+    """
+    Yield (page_id, title, start, end) for every page in an uncompressed
+    XML dump file, where [start, end) is the byte range of the page
+    """
+    data = open_mmap(path)
+    try:
+        last = None
+        for page_id, title, offset in page_heads(data):
+            if last is not None:
+                yield last + (offset,)
+            last = (page_id, title, offset)
+        if last is not None:
+            yield last + (os.path.getsize(path),)
+    finally:
+        data.close()
+
+
+def scan_bz2(path, buffer_size=BUFFER_SIZE):
+    """
+    Yield (page_id, title, start, end) for every page in a bz2 dump file,
+    where [start, end) is the byte range of the bz2 stream holding it.
+    Files with a single stream can be indexed, but all pages will point to
+    the whole file.
+    """
+    for start, end, data in iter_bz2_streams(path, buffer_size):
+        for page_id, title, offset in page_heads(data):
+            yield page_id, title, start, end
+
+
+def read_multistream_index(index_path, dump_size):
+    """
+    Yield (page_id, title, start, end) for every page listed in the official
+    index of a multistream dump file (lines 'offset:page_id:title'), where
+    [start, end) is the byte range of the bz2 stream holding it.
+    """
+    if index_path.endswith('.bz2'):
+        fobj = bz2.BZ2File(index_path)
+    else:
+        fobj = open(index_path, 'rb')
+    try:
+        # Streams end at the beginning of the next one. The last stream
+        # with pages is followed by one holding the closing root tag, which
+        # is parsed along with it.
+        stream = []
+        stream_start = None
+        for line in fobj:
+            offset, page_id, title = line.rstrip('\n').split(':', 2)
+            offset = int(offset)
+            if offset != stream_start:
+                for entry in stream:
+                    yield entry + (offset,)
+                stream = []
+                stream_start = offset
+            stream.append((int(page_id), title.decode('utf-8'), offset))
+        for entry in stream:
+            yield entry + (dump_size,)
+    finally:
+        fobj.close()
+
+
+def find_multistream_index(path):
+    """
+    Return path to the official index of a multistream dump file, if it is
+    found in the same directory, otherwise None
+    """
+    base = re.sub(r'\.xml\.bz2$', '', path)
+    for candidate in (base + '-index.txt.bz2', base + '-index.txt'):
+        if candidate != path and os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+class PageIndex(object):
+    """
+    Page index of a dump file, stored in a SQLite database file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.execute("""CREATE TABLE IF NOT EXISTS page_index (
+                                page_id INTEGER PRIMARY KEY,
+                                title TEXT,
+                                start_offset INTEGER,
+                                end_offset INTEGER)""")
+
+    def add_pages(self, entries):
+        """
+        Insert (page_id, title, start, end) entries in the index
+        """
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) == BATCH_SIZE:
+                self._insert(batch)
+                batch = []
+        self._insert(batch)
+
+    def _insert(self, batch):
+        with self.con:
+            self.con.executemany("""INSERT OR REPLACE INTO page_index
+                                    VALUES (?, ?, ?, ?)""", batch)
+
+    def create_title_index(self):
+        """
+        Create index to look up pages by title, once all pages are inserted
+        """
+        with self.con:
+            self.con.execute("""CREATE INDEX IF NOT EXISTS page_index_title
+                                ON page_index (title)""")
+
+    def page_id(self, title):
+        """
+        Return page_id of a page given its title, or None if not found
+        """
+        row = self.con.execute("""SELECT page_id FROM page_index
+                                  WHERE title = ?""", (title,)).fetchone()
+        return row[0] if row is not None else None
+
+    def chunk(self, page_id):
+        """
+        Return (start, end) byte range holding a page, or None if not found
+        """
+        row = self.con.execute("""SELECT start_offset, end_offset
+                                  FROM page_index WHERE page_id = ?""",
+                               (page_id,)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def chunks(self, page_ids):
+        """
+        Return dict {(start, end): set of page_id} for the given pages, so
+        that each byte range is only parsed once
+        """
+        chunks = {}
+        for page_id in page_ids:
+            chunk = self.chunk(page_id)
+            if chunk is not None:
+                chunks.setdefault(chunk, set()).add(page_id)
+        return chunks
+
+    def __len__(self):
+        row = self.con.execute("SELECT COUNT(*) FROM page_index").fetchone()
+        return row[0]
+
+    def close(self):
+        self.con.close()
+
+
+def build_index(path, index_path, multistream_index=None,
+                buffer_size=BUFFER_SIZE):
+    """
+    Build a new page index for a dump file. Return the PageIndex.
+
+    :Parameters:
+        path : `str`
+            the path to the dump file (uncompressed XML or bz2)
+        index_path : `str`
+            the path to the index file to create (replaced if it exists)
+        multistream_index : `str`
+            the path to the official index of a multistream dump file. If
+            None, it is looked up next to the dump file, and the dump file
+            is scanned if it is not found.
+        buffer_size : `int`
+            size in bytes of read buffers for the dump file
+    """
+    ext = maps.EXT_RE.search(path).groups()[0]
+    if ext not in ('xml', 'bz2'):
+        raise RuntimeError('Page index not supported for %s files' % ext)
+    if multistream_index is None and ext == 'bz2':
+        multistream_index = find_multistream_index(path)
+
+    if multistream_index is not None:
+        entries = read_multistream_index(multistream_index,
+                                         os.path.getsize(path))
+    elif ext == 'xml':
+        entries = scan_xml(path)
+    else:
+        entries = scan_bz2(path, buffer_size)
+
+    if os.path.isfile(index_path):
+        os.remove(index_path)
+    index = PageIndex(index_path)
+    index.add_pages(entries)
+    index.create_title_index()
+    return index
+
+
+if __name__ == '__main__':
+    dump_path = sys.argv[1]
+    ms_index = sys.argv[2] if len(sys.argv) > 2 else None
+
+    page_index = build_index(dump_path, dump_path + '.idx',
+                             multistream_index=ms_index)
+    print "%d pages indexed in %s" % (len(page_index), page_index.path)
+    page_index.close()
@@ -9,6 +9,7 @@ from data_item import DataItem
 import logging
 import csv
 import os
+from checkpoint import load_file_db
 
 
 class Page(DataItem):
@@ -56,27 +57,38 @@ def process_pages(pages_iter):
 
 def process_pages_to_file(pages_iter):
     """
-    Process an iterator of Page objects and yields unicode tuples to be
-    stored in a temp file for later bulk data load in DB.
+    Process an iterator of page records (records.PageRecord) and yields
+    unicode tuples to be stored in a temp file for later bulk data load in
+    DB.
+
+    If pages carry a sequence number for checkpoints, it is appended as
+    the last element of the tuple.
     """
     for page in pages_iter:
-        page_insert = (int(page['id']), int(page['ns']),
-                       page['title'],
-                       (page['restrictions'] if 'restrictions' in page
+        page_insert = (page.id, page.ns, page.title,
+                       (page.restrictions if page.restrictions is not None
                         else u'NULL'),
                        )
+        if page.seq is not None:
+            page_insert += (page.seq,)
         yield page_insert
 
 
 def store_pages_file_db(pages_iter, con=None, log_file=None,
                         tmp_dir=None, file_rows=1000000,
-                        etl_prefix=None):
+                        etl_prefix=None, checkpoint=None, chunks=None):
     """
     Process page insert items received from iterator. Page inserts are stored
     in a temp file, then a bulk data load is triggered in MySQL.
+
+    If a checkpoint (checkpoint.LoaderCheckpoint) is given, it is updated
+    after every bulk data load with the sequence numbers of loaded pages,
+    and the list of chunk numbers in chunks is marked as done at the end.
     """
     insert_rows = 0
     total_pages = 0
+    seqs = []
+    all_loaded = True
     logging.basicConfig(filename=log_file, level=logging.DEBUG)
 
     print "Starting data loading at %s." % (
@@ -98,6 +110,10 @@ def store_pages_file_db(pages_iter, con=None, log_file=None,
 
     for page in pages_iter:
         total_pages += 1
+        if len(page) > 4:
+            # Sequence number for checkpoints
+            seqs.append(page[4])
+            page = page[:4]
 
         if insert_rows == 0:
             file_page = open(path_file_page, 'wb')
@@ -117,13 +133,20 @@ def store_pages_file_db(pages_iter, con=None, log_file=None,
         if insert_rows == file_rows:
             # Insert in DB
             file_page.close()
-            con.send_query(insert_pages % path_file_page)
+            all_loaded &= load_file_db(con, [insert_pages % path_file_page],
+                                       checkpoint=checkpoint, seqs=seqs)
+            seqs = []
             insert_rows = 0
             # No need to delete tmp files, as they are empty each time we
             # open them again for writing
 
-    file_page.close()
-    con.send_query(insert_pages % path_file_page)
+    # Load remaining entries (if any, filters may discard all pages)
+    if insert_rows > 0:
+        file_page.close()
+        all_loaded &= load_file_db(con, [insert_pages % path_file_page],
+                                   checkpoint=checkpoint, seqs=seqs)
+    if checkpoint is not None and all_loaded:
+        checkpoint.finish(chunks)
     # Clean tmp files
 #    os.remove(path_file_page)
 
@@ -3,9 +3,9 @@
 # Felipe Ortega and Aaron Halfaker
 ######
 
-from lxml import etree
 import MySQLdb, sys, codecs, os, subprocess, time
 from wikidat.utils import maps
+from wikidat.sources.dump import LocalNames, iterparse_dump
 import warnings
 
 
@@ -13,6 +13,9 @@ class Parser(object):
     """
     Parses content of Wikimedia dump files (pages-logging.xml)
     """
+    # Elements handled by the parser, any other element is skipped
+    tags = ('namespaces', 'contributor', 'logitem')
+
     def __init__(self, db, cursor, log_file):
         # DB connection
         self.db = db
@@ -35,10 +38,11 @@ class Parser(object):
     def parse(self, path):
         self.in_stream = self._open_dump(self._check_dump(path))
 
-        for event, elem in etree.iterparse(self.in_stream):
+        names = LocalNames()
+        for event, elem in iterparse_dump(self.in_stream, tags=self.tags):
 
             # Drop tag namespace
-            tag = elem.tag.split('}')[1]
+            tag = names[elem.tag]
 
             if tag == 'namespaces':
                 self.ns_dict = {c.text: int(c.attrib.get('key')) for c in elem}
@@ -46,10 +50,10 @@ class Parser(object):
 
             if tag == 'contributor':
                 # Build dict {tag:text} for contributor info
-                self.contrib_dict = {x.tag.split('}')[1]: x.text for x in elem}
+                self.contrib_dict = {names[x.tag]: x.text for x in elem}
 
             if tag == 'logitem':
-                self.log_dict = {x.tag.split('}')[1]: x.text for x in elem}
+                self.log_dict = {names[x.tag]: x.text for x in elem}
 
                 # Get namespace for this log item from page title prefix
                 if 'logtitle' in self.log_dict:
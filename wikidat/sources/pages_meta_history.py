@@ -3,15 +3,17 @@
 # Aaron Halfaker and Felipe Ortega
 ######
 
-from lxml import etree
 import MySQLdb, hashlib, sys, codecs, os, subprocess, time
 from wikidat.utils import maps
+from wikidat.sources.dump import LocalNames, iterparse_dump
 import warnings
 
 class Parser(object):
     """
     Parses content of Wikimedia dump files (pages-meta-history.xml)
     """
+    # Elements handled by the parser, any other element is skipped
+    tags = ('namespaces', 'contributor', 'revision', 'page')
       
     def __init__(self, db, cursor, lang, log_file):
         # DB connection
@@ -67,10 +69,11 @@ class Parser(object):
         
         self.in_stream = self._open_dump(self._check_dump(path))
         
-        for event, elem in etree.iterparse(self.in_stream):
+        names = LocalNames()
+        for event, elem in iterparse_dump(self.in_stream, tags=self.tags):
             
             # Drop tag namespace
-            tag = elem.tag.split('}')[1]
+            tag = names[elem.tag]
             
             if tag == 'namespaces':
                 self.ns_dict = {int(c.attrib.get('key')):c.text for c in elem}
@@ -91,7 +94,7 @@ class Parser(object):
             
             if tag == 'contributor':
                 # Build dict {tag:text} for contributor info
-                self.contrib_dict = {x.tag.split('}')[1]:x.text for x in elem}
+                self.contrib_dict = {names[x.tag]:x.text for x in elem}
                 
             elif tag == 'revision':
                 self.revisions += 1
@@ -100,10 +103,10 @@ class Parser(object):
                     page = elem.getparent()
                     # Build dict {tag:text} for all children of page
                     # above first revision tag
-                    self.page_dict = {x.tag.split('}')[1]:x.text for x in page}
+                    self.page_dict = {names[x.tag]:x.text for x in page}
                 
                 # Build dict {tag:text} for all children of revision
-                self.rev_dict = {x.tag.split('}')[1]:x.text for x in elem}
+                self.rev_dict = {names[x.tag]:x.text for x in elem}
                 
                 # Stores SHA-256 hash of revision text
                 self.text_hash = hashlib.sha256()
@@ -19,15 +19,100 @@ Example code for ZeroMQ patterns can be found in the official guide:
 http://zguide.zeromq.org/page:all
 """
 
-import time
 import multiprocessing as mp
+import time
 import zmq
-from wikidat.utils.comutils import send_ujson, recv_ujson
+from wikidat.utils.comutils import (send_ujson, recv_batch, BatchSender,
+                                    Codec, RequestChannel, AckChannel)
 from page import Page
 from revision import Revision
+from records import (PageRecord, RevisionRecord, page_record,
+                     revision_record, REVISION_TEXT)
+from wikidat.utils.stats import stage_stats
 # from logitem import LogItem
 # from user import User
 
+# Address templates of channels, given their port number or name. Unix
+# domain sockets (ipc) skip the loopback TCP stack and do not take any ports.
+TCP_ADDRESS = "tcp://127.0.0.1:%s"
+IPC_ADDRESS = "ipc://%s/%%s.ipc"
+# Channels bound to this address take an ephemeral port chosen by the OS,
+# so that concurrent ETL lines never need to agree on port numbers
+TCP_AUTO_ADDRESS = "tcp://127.0.0.1:*"
+
+
+def channel_address(transport='tcp', ipc_dir=None, auto_ports=False,
+                    host=None):
+    """
+    Return address template for channels using a transport, either 'tcp'
+    or 'ipc' (socket files are created in ipc_dir). With auto_ports, tcp
+    channels are bound to ephemeral ports (see bind_channel). tcp channels
+    are bound to the loopback interface, unless another host (interface
+    name or address, or * for all of them) is given.
+    """
+    if transport == 'tcp':
+        if host is not None and host != '127.0.0.1':
+            return 'tcp://%s:%s' % (host, '*' if auto_ports else '%s')
+        return TCP_AUTO_ADDRESS if auto_ports else TCP_ADDRESS
+    elif transport == 'ipc':
+        return IPC_ADDRESS % ipc_dir
+    raise RuntimeError('Unknown transport for ETL channels: %s' % transport)
+
+
+def bind_address(address, channel):
+    """
+    Return address to bind a channel, given its port number or name
+    """
+    if address.endswith(':*'):
+        return address
+    return address % channel
+
+
+def channel_endpoint(address, channel):
+    """
+    Return endpoint to connect to a channel, given either its port number
+    or name, or the endpoint reported by the process binding it
+    """
+    if channel is None:
+        return None
+    if '://' in unicode(channel):
+        return channel
+    return address % channel
+
+
+def public_endpoint(endpoint, host):
+    """
+    Return tcp endpoint with its host replaced, e.g. to connect from other
+    hosts to a channel bound to all interfaces (tcp://0.0.0.0:5000)
+    """
+    return 'tcp://%s:%s' % (host, endpoint.rsplit(':', 1)[1])
+
+
+def bind_channel(socket, address, channel, endpoints=None):
+    """
+    Bind socket to a channel and return the endpoint actually bound, also
+    put as (channel, endpoint) in the endpoints queue, if given
+    """
+    socket.bind(bind_address(address, channel))
+    endpoint = socket.getsockopt(zmq.LAST_ENDPOINT)
+    if endpoints is not None:
+        endpoints.put((channel, endpoint))
+    return endpoint
+
+
+def split_records(items, pages):
+    """
+    Yield revision records (records.RevisionRecord) for Revision items,
+    appending page records (records.PageRecord) for Page items to list
+    pages. Items are converted just like Producer and Processor do, to
+    run a whole pipeline in a single process.
+    """
+    for item in items:
+        if isinstance(item, Page):
+            pages.append(PageRecord._make(page_record(item)))
+        elif isinstance(item, Revision):
+            yield RevisionRecord._make(revision_record(item))
+
 
 class Producer(mp.Process):
     """
@@ -38,12 +123,40 @@ class Producer(mp.Process):
 
     The example has been modified to support two output queues, one for
     page and another one for revision elements
+
+    Items are sent in batches of up to page_batch_size/rev_batch_size items,
+    or whatever is collected within page_batch_linger/rev_batch_linger
+    milliseconds (see comutils.BatchSender), compressed with page_codec and
+    rev_codec (see comutils.CODECS) if they are larger than codec_min_size
+    bytes.
+
+    Pages and revisions are sent as records (see records module), with the
+    text of revisions as raw data. Batches are only sent to workers that
+    request them (see comutils.RequestChannel), so that the reader never
+    runs ahead of the credit window of workers. When all items have been
+    sent, every one of the page_consumers and rev_consumers workers receives
+    a STOP message after its last batch. The number of workers may be a
+    comutils.WorkerCount, if workers are added while the reader is running.
+
+    Snapshots of its counters (see stats.StageStats) are published every
+    stats_interval seconds on the stats channel at stats_port, if given. If
+    target_stats is True, these counters are passed to target as keyword
+    argument stats, so that it can add its own.
+
+    Ports of channels may also be names (ipc) or, with addresses taking
+    ephemeral ports, just labels of channels (see channel_address). The
+    endpoints actually bound are put in the endpoints queue, if given (see
+    bind_channel).
     """
     def __init__(self, group=None, target=None, name=None, args=None,
                  kwargs=None, page_consumers=0, rev_consumers=0,
                  logitem_consumers=0, user_consumers=0,
                  push_pages_port=None, push_revs_port=None,
-                 control_port=None):
+                 page_batch_size=1, page_batch_linger=0,
+                 rev_batch_size=1, rev_batch_linger=0, page_codec='zlib1',
+                 rev_codec='zlib1', codec_min_size=1024,
+                 address=TCP_ADDRESS, stats_port=None, stats_interval=10,
+                 endpoints=None, target_stats=False):
 
         super(Producer, self).__init__(name=name)
         self.target = target
@@ -55,34 +168,61 @@ class Producer(mp.Process):
         self.user_consumers = user_consumers
         self.push_pages_port = push_pages_port
         self.push_revs_port = push_revs_port
-        self.control_port = control_port
+        self.page_batch_size = page_batch_size
+        self.page_batch_linger = page_batch_linger
+        self.rev_batch_size = rev_batch_size
+        self.rev_batch_linger = rev_batch_linger
+        self.page_codec = page_codec
+        self.rev_codec = rev_codec
+        self.codec_min_size = codec_min_size
+        self.address = address
+        self.stats_port = stats_port
+        self.stats_interval = stats_interval
+        self.endpoints = endpoints
+        self.target_stats = target_stats
 
     def run(self):
         target = self.target
 
         context = zmq.Context()
+        stats = stage_stats(context, 'xml_reader', self.name,
+                            channel_endpoint(self.address, self.stats_port),
+                            self.stats_interval)
         # Set up sending channel for page elements
-        channel_pages_send = context.socket(zmq.PUSH)
-        channel_pages_send.bind("tcp://127.0.0.1:%s" % self.push_pages_port)
+        channel_pages_send = context.socket(zmq.ROUTER)
+        bind_channel(channel_pages_send, self.address, self.push_pages_port,
+                     self.endpoints)
 
         # Set up sending channel for revision elements
-        channel_revs_send = context.socket(zmq.PUSH)
-        channel_revs_send.bind("tcp://127.0.0.1:%s" % self.push_revs_port)
-
-        channel_control = context.socket(zmq.PUB)
-        channel_control.bind("tcp://127.0.0.1:%s" % self.control_port)
-
-        # Wait a second to wake up and connect
-        time.sleep(1)
-
-        for item in target(*self.args, **self.kwargs):
+        channel_revs_send = context.socket(zmq.ROUTER)
+        bind_channel(channel_revs_send, self.address, self.push_revs_port,
+                     self.endpoints)
+
+        pages_channel = RequestChannel(channel_pages_send, self.page_consumers)
+        revs_channel = RequestChannel(channel_revs_send, self.rev_consumers)
+        pages_codec = Codec(self.page_codec, self.codec_min_size)
+        revs_codec = Codec(self.rev_codec, self.codec_min_size)
+        pages_send = BatchSender(pages_channel, self.page_batch_size,
+                                 self.page_batch_linger, pages_codec,
+                                 stats=stats.channel('pages'))
+        # Revision text travels as raw data, not escaped as JSON
+        revs_send = BatchSender(revs_channel, self.rev_batch_size,
+                                self.rev_batch_linger, revs_codec,
+                                raw_index=REVISION_TEXT,
+                                stats=stats.channel('revisions'))
+
+        kwargs = self.kwargs
+        if self.target_stats:
+            kwargs = dict(kwargs, stats=stats)
+        for item in target(*self.args, **kwargs):
+            stats.items_in += 1
             # Classify outcome elements in their corresponding queue
             # for later processing
             if isinstance(item, Page):
-                send_ujson(channel_pages_send, item)
+                pages_send.send(page_record(item))
 
             elif isinstance(item, Revision):
-                send_ujson(channel_revs_send, item)
+                revs_send.send(revision_record(item))
 
 #            elif isinstance(item, LogItem):
 #                if self.out_logitem_queue is not None:
@@ -92,17 +232,19 @@ class Producer(mp.Process):
 #                if self.out_user_queue is not None:
 #                    self.output_user_queue.put(item)
 
-        # Wait few seconds to let workers empty data pipeline
-        time.sleep(20)
-        #channel_pages_send.close()
-        #channel_revs_send.close()
-
-        # Send STOP message to all workers and quit
-        if self.page_consumers > 0 and self.rev_consumers > 0:
-            channel_control.send('STOP')
+        pages_send.flush()
+        revs_send.flush()
+        print "%s pages %s" % (self.name, pages_codec.report())
+        print "%s revisions %s" % (self.name, revs_codec.report())
 
-        time.sleep(5)
-        #channel_control.close()
+        # Send STOP message to all workers, behind their last batch, and
+        # quit once all messages have been delivered
+        pages_channel.stop()
+        revs_channel.stop()
+        stats.close()
+        channel_pages_send.close(linger=-1)
+        channel_revs_send.close(linger=-1)
+        context.term()
 
 
 class Consumer(mp.Process):
@@ -111,9 +253,23 @@ class Consumer(mp.Process):
 
     The "target" must be a function which expects an iterable as it's
     only argument.  Therefore, the args value is not used here.
+
+    Items are received until a STOP message arrives from each one of the
+    producers (a number, or a comutils.WorkerCount if producers are added
+    while running), which is acknowledged (see comutils.AckChannel). At
+    most hwm batches are queued for reception, so that producers block
+    while the target is busy (e.g. loading data in DB).
+
+    Snapshots of its counters, as stage, are published every stats_interval
+    seconds on the stats channel at stats_port, if given.
+
+    The endpoint bound for pull_port is put in the endpoints queue, if
+    given (see Producer).
     """
     def __init__(self, group=None, target=None, name=None, args=None,
-                 kwargs=None, producers=0, pull_port=None):
+                 kwargs=None, producers=0, pull_port=None,
+                 address=TCP_ADDRESS, hwm=10, stage='loader',
+                 stats_port=None, stats_interval=10, endpoints=None):
 
         super(Consumer, self).__init__(name=name)
         self.target = target
@@ -121,29 +277,45 @@ class Consumer(mp.Process):
         self.kwargs = kwargs if kwargs is not None else {}
         self.producers = producers
         self.pull_port = pull_port
+        self.address = address
+        self.hwm = hwm
+        self.stage = stage
+        self.stats_port = stats_port
+        self.stats_interval = stats_interval
+        self.endpoints = endpoints
+        self.stats = None
 
     def items(self):
         context = zmq.Context()
-        data_recv = context.socket(zmq.PULL)
-        data_recv.bind("tcp://127.0.0.1:"+str(self.pull_port))
-
-        # Wait a second to wake up and connect
-        time.sleep(1)
+        data_recv = context.socket(zmq.ROUTER)
+        data_recv.setsockopt(zmq.RCVHWM, self.hwm)
+        bind_channel(data_recv, self.address, self.pull_port, self.endpoints)
+        channel = AckChannel(data_recv)
 
-        while self.producers > 0:
+        stopped = 0
+        while stopped < int(self.producers):
             while True:
-                item = recv_ujson(data_recv)
-                if item == 'STOP':
+                batch = recv_batch(channel, stats=self.stats)
+                if batch == 'STOP':
+                    channel.ack()
                     break
-                yield item
-            self.producers -= 1
+                for item in batch:
+                    yield item
+            stopped += 1
 
-        time.sleep(1)
-        #data_recv.close()
+        data_recv.close()
+        context.term()
 
     def run(self):
         target = self.target
+        context = zmq.Context()
+        self.stats = stage_stats(context, self.stage, self.name,
+                                 channel_endpoint(self.address,
+                                                  self.stats_port),
+                                 self.stats_interval)
         target(self.items(), **self.kwargs)
+        self.stats.close()
+        context.term()
 
 
 class Processor(mp.Process):
@@ -153,70 +325,153 @@ class Processor(mp.Process):
     The "target" must be a generator function which yields
     pickable items derived from DataItems and which expects an iterable as its
     only argument.  Therefore, the args value is not used here.
+
+    Items are requested in batches from every producer, and passed one by
+    one to the target (as record named tuples, if a record type is given,
+    see records module), until all producers have sent a STOP message. At
+    most credit_window batches from each producer are requested in advance.
+    Its output is sent in batches of up to batch_size items, or whatever is
+    collected within batch_linger milliseconds, compressed with codec if
+    it is larger than codec_min_size bytes. A STOP message is sent to each
+    consumer after the last batch, and the worker quits once all of them
+    have been acknowledged. At most hwm output batches are queued,
+    blocking the target (and further requests) when consumers are busy.
+
+    If retire (a multiprocessing Event) is given, the worker retires when
+    it is set: it stops requesting batches, and quits as soon as it has
+    processed the batches already requested (see comutils.RequestChannel).
+
+    Snapshots of its counters, as stage, are published every stats_interval
+    seconds on the stats channel at stats_port, if given. Ports may also be
+    channel names or endpoints (see channel_endpoint). If target_stats is
+    True, these counters (stats.StageStats) are passed to target as keyword
+    argument stats, so that it can add its own.
     """
     def __init__(self, group=None, target=None, name=None, args=None,
                  kwargs=None, producers=0, consumers=0,
-                 pull_port=None, push_port=None, control_port=None):
+                 pull_ports=None, push_port=None,
+                 batch_size=1, batch_linger=0, codec='zlib1',
+                 codec_min_size=1024, address=TCP_ADDRESS,
+                 credit_window=2, hwm=10, record=None, stage='worker',
+                 stats_port=None, stats_interval=10, retire=None,
+                 target_stats=False):
         super(Processor, self).__init__(name=name)
         self.target = target  # String with method name, not method itself
         self.args = args if args is not None else []
         self.kwargs = kwargs if kwargs is not None else {}
         self.producers = producers
         self.consumers = consumers
-        self.pull_port = pull_port
+        # One pull port per producer
+        self.pull_ports = pull_ports if pull_ports is not None else []
         self.push_port = push_port
-        self.control_port = control_port
+        self.batch_size = batch_size
+        self.batch_linger = batch_linger
+        self.codec = codec
+        self.codec_min_size = codec_min_size
+        self.address = address
+        self.credit_window = credit_window
+        self.hwm = hwm
+        self.record = record
+        self.stage = stage
+        self.stats_port = stats_port
+        self.stats_interval = stats_interval
+        self.retire = retire
+        self.target_stats = target_stats
+        self.channel_send = None
+        self.stats = None
 
     def items(self):
         context = zmq.Context()
-        data_recv = context.socket(zmq.PULL)
-        data_recv.connect("tcp://127.0.0.1:%s" % self.pull_port)
-
-        control_sub = context.socket(zmq.SUB)
-        control_sub.connect("tcp://127.0.0.1:%s" % self.control_port)
-        control_sub.setsockopt(zmq.SUBSCRIBE, "STOP")
-
-        # Wait a second to wake up and connect
-        time.sleep(1)
-
-        # Initialize poll set
+        # Initialize poll set, with one channel per producer
         poller = zmq.Poller()
-        poller.register(data_recv, zmq.POLLIN)
-        poller.register(control_sub, zmq.POLLIN)
-
+        channels = []
+        for pull_port in self.pull_ports:
+            data_recv = context.socket(zmq.DEALER)
+            data_recv.connect(channel_endpoint(self.address, pull_port))
+            # First requests tell the producer that we are ready
+            for credit in range(self.credit_window):
+                data_recv.send('READY')
+            poller.register(data_recv, zmq.POLLIN)
+            channels.append(data_recv)
+
+        retiring = False
         while self.producers > 0:
-            # Work on requests from pipelining and control channel
-            while True:
-                socks = dict(poller.poll())
-                if data_recv in socks and socks[data_recv] == zmq.POLLIN:
-                    yield(recv_ujson(data_recv))
-
-                if control_sub in socks and socks[control_sub] == zmq.POLLIN:
-                    message = control_sub.recv()
-                    if message == "STOP":
-                        print "Recieved exit command, client %s stop recieving messages" % self.name
-                        break  # Exit poll loop
-
-            self.producers -= 1
-
-        time.sleep(1)
-        #data_recv.close()
-        #control_sub.close()
+            if (self.retire is not None and not retiring and
+                    self.retire.is_set()):
+                # Producers answer with STOP after the batches requested
+                for data_recv in channels:
+                    data_recv.send('BYE')
+                retiring = True
+            # Do not keep output items waiting longer than the linger
+            # time if no more input is coming
+            start = time.time()
+            if self.channel_send.pending():
+                socks = dict(poller.poll(self.batch_linger))
+                self.stats.received(0, 0, time.time() - start)
+                if not socks:
+                    self.channel_send.flush()
+                    continue
+            else:
+                # Check the retire event at least once per second
+                timeout = (1000 if self.retire is not None and not retiring
+                           else None)
+                socks = dict(poller.poll(timeout))
+                self.stats.received(0, 0, time.time() - start)
+                if not socks:
+                    continue
+            for data_recv in socks:
+                batch = recv_batch(data_recv, stats=self.stats)
+                if batch == 'STOP':
+                    # No more items from this producer. Credits still
+                    # pending to be sent are dropped, since the producer
+                    # may be gone.
+                    poller.unregister(data_recv)
+                    channels.remove(data_recv)
+                    data_recv.close(linger=0)
+                    self.producers -= 1
+                    continue
+                # Renew the credit used by this batch before processing it
+                if not retiring:
+                    data_recv.send('READY')
+                if self.record is not None:
+                    for item in batch:
+                        yield self.record._make(item)
+                else:
+                    for item in batch:
+                        yield item
+
+        context.term()
 
     def run(self):
         target = self.target
         context = zmq.Context()
-        channel_send = context.socket(zmq.PUSH)
-        channel_send.connect("tcp://127.0.0.1:" + str(self.push_port))
-
-        # Wait a second to wake up and connect
-        time.sleep(1)
-
-        for item in target(self.items(), **self.kwargs):
-            send_ujson(channel_send, item)
+        channel_send = context.socket(zmq.DEALER)
+        channel_send.setsockopt(zmq.SNDHWM, self.hwm)
+        channel_send.connect(channel_endpoint(self.address, self.push_port))
+        codec = Codec(self.codec, self.codec_min_size)
+        self.stats = stage_stats(context, self.stage, self.name,
+                                 channel_endpoint(self.address,
+                                                  self.stats_port),
+                                 self.stats_interval)
+        self.channel_send = BatchSender(channel_send, self.batch_size,
+                                        self.batch_linger, codec,
+                                        stats=self.stats)
+
+        kwargs = self.kwargs
+        if self.target_stats:
+            kwargs = dict(kwargs, stats=self.stats)
+        for item in target(self.items(), **kwargs):
+            self.channel_send.send(item)
+        self.channel_send.flush()
+        print "%s %s" % (self.name, codec.report())
 
         for x in range(self.consumers):
             send_ujson(channel_send, 'STOP')
-
-        time.sleep(1)
-        #channel_send.close()
+        # Quit once all messages have been received by consumers
+        start = time.time()
+        for x in range(self.consumers):
+            channel_send.recv()
+        self.stats.send_wait += time.time() - start
+        self.stats.close()
+        channel_send.close(linger=-1)
+        context.term()
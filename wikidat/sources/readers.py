@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 18 10:12:31 2014
+
+File-like readers over dump files, used to feed the XML parser with
+(decompressed) data from a whole dump file or from a page-aligned fragment
+(chunk) of it.
+
+@author: jfelipe
+"""
+import bz2
+import gzip
+import mmap
+import re
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Default size of read buffers for dump files
+BUFFER_SIZE = 4*1024*1024
+
+# Magic bytes at the beginning of every bz2 stream: stream header ('BZh'),
+# block size ('1'-'9') and the magic number of the first compressed block
+BZ2_STREAM_RE = re.compile(r'BZh[1-9]1AY&SY')
+
+# Opening tag of the root element in MediaWiki XML dumps
+ROOT_TAG_RE = re.compile(r'<mediawiki[^>]*>')
+ROOT_END_TAG = '</mediawiki>'
+
+# Opening tag of every page element
+PAGE_RE = re.compile(r'<page>')
+
+
+class RangeFile(object):
+    """
+    Read-only file-like object restricted to bytes [start, end) of a file
+    """
+    def __init__(self, path, start=0, end=None, buffer_size=BUFFER_SIZE):
+        self.fobj = open(path, 'rb', buffer_size)
+        self.fobj.seek(start)
+        self.remaining = end - start if end is not None else None
+
+    def read(self, size=-1):
+        if self.remaining is None:
+            return self.fobj.read(size)
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.fobj.close()
+
+
+class BZ2StreamReader(object):
+    """
+    File-like object decompressing bz2 data read from another file-like
+    object. Concatenated streams (bz2 multistream files) are supported.
+    """
+    def __init__(self, raw, buffer_size=BUFFER_SIZE):
+        self.raw = raw
+        self.buffer_size = buffer_size
+        self.decomp = bz2.BZ2Decompressor()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """
+        Decompress more data into the internal buffer. Return False if
+        the underlying file is exhausted.
+        """
+        data = self.raw.read(self.buffer_size)
+        if not data:
+            return False
+        out = [self.buffer[self.pos:]]
+        while data:
+            try:
+                out.append(self.decomp.decompress(data))
+            except EOFError:
+                # Previous stream ended right at the end of the last read
+                self.decomp = bz2.BZ2Decompressor()
+                continue
+            # Data past the end of current stream belongs to the next one
+            data = self.decomp.unused_data
+            if data:
+                self.decomp = bz2.BZ2Decompressor()
+        self.buffer = ''.join(out)
+        self.pos = 0
+        return True
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or
+                                len(self.buffer) - self.pos < size):
+            if not self._fill():
+                self.eof = True
+        if size < 0:
+            size = len(self.buffer) - self.pos
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.raw.close()
+
+
+class ChunkReader(object):
+    """
+    File-like object returning a prefix string, then the content of another
+    file-like object and finally a suffix string. It is used to wrap the
+    pages in a chunk of a dump file in a well-formed XML document.
+    """
+    def __init__(self, body, prefix='', suffix=''):
+        self.parts = [prefix, body, suffix]
+
+    def read(self, size=-1):
+        chunks = []
+        while self.parts and size != 0:
+            part = self.parts[0]
+            if isinstance(part, str):
+                data = part if size < 0 else part[:size]
+                if len(data) == len(part):
+                    self.parts.pop(0)
+                else:
+                    self.parts[0] = part[len(data):]
+            else:
+                data = part.read(size)
+                if not data:
+                    part.close()
+                    self.parts.pop(0)
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(chunks)
+
+    def close(self):
+        for part in self.parts:
+            if not isinstance(part, str):
+                part.close()
+        self.parts = []
+
+
+def open_mmap(path):
+    """
+    Return a read-only memory map of an uncompressed file, which can be
+    read as a file object without copying data through an extra buffer.
+    Empty files cannot be mapped, so a regular file object is returned.
+    """
+    with open(path, 'rb') as fobj:
+        try:
+            return mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return open(path, 'rb')
+
+
+def open_native(path, ext, buffer_size=BUFFER_SIZE):
+    """
+    Return a file-like object of decompressed data read from a dump file,
+    using in-process decompression. Return None if the file format is not
+    supported natively (e.g. 7z files).
+
+    :Parameters:
+        path : `str`
+            the path to the dump file to read
+        ext : `str`
+            file extension, as in maps.EXTENSIONS
+        buffer_size : `int`
+            size in bytes of read buffer for compressed data
+    """
+    if ext == 'xml':
+        return open_mmap(path)
+    elif ext == 'bz2':
+        return BZ2StreamReader(open(path, 'rb', buffer_size),
+                               buffer_size=buffer_size)
+    elif ext == 'gz':
+        return gzip.GzipFile(fileobj=open(path, 'rb', buffer_size))
+    elif ext == 'lzma' and lzma is not None:
+        return lzma.LZMAFile(open(path, 'rb', buffer_size))
+    return None
+
+
+def find_forward(path, offset, pattern, block_size=1024*1024):
+    """
+    Return the offset of the first match of a regular expression in a file,
+    starting the search at the given offset, or None if it is not found.
+    """
+    overlap = 64
+    with open(path, 'rb') as fobj:
+        fobj.seek(offset)
+        tail = ''
+        while True:
+            block = fobj.read(block_size)
+            if not block:
+                return None
+            data = tail + block
+            match = pattern.search(data)
+            if match is not None:
+                return offset - len(tail) + match.start()
+            tail = data[-overlap:]
+            offset += len(block)
+
+
+def read_root_tag(raw):
+    """
+    Return the opening tag of the root element read from the beginning of
+    a file-like object of (decompressed) XML data.
+    """
+    header = raw.read(64*1024)
+    raw.close()
+    match = ROOT_TAG_RE.search(header)
+    if match is None:
+        raise RuntimeError('Root element not found in dump file header')
+    return match.group(0)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 21 09:12:37 2014
+
+Fixed schemas to send pages and revisions between processes as records:
+lists of values in schema order, with numeric fields already converted to
+integers, instead of dicts repeating field names in every message.
+
+Records are decoded straight into named tuples (PageRecord and
+RevisionRecord), ready to build the rows of CSV files for bulk data loads.
+
+@author: jfelipe
+"""
+from collections import namedtuple
+
+PageRecord = namedtuple('PageRecord', ['id', 'ns', 'title', 'restrictions',
+                                       'seq'])
+
+# Fields text_hash, len_text, redirect, is_fa, is_flist and is_ga are only
+# set for revisions without text (metadata only mode, see
+# revision.process_text). user is -1 for missing contributors and 0 for
+# anonymous ones, with user_text holding their IP address. sha1 and
+# text_bytes are the digest and length of the text given by the dump file
+# (None in old dumps). revert is [reverted_to, reverted ids] for identity
+# reverts (see reverts.RevertDetector), None otherwise.
+RevisionRecord = namedtuple('RevisionRecord', ['id', 'page_id', 'ns',
+                                               'timestamp', 'rev_parent_id',
+                                               'minor', 'comment', 'user',
+                                               'user_text', 'text', 'sha1',
+                                               'text_bytes', 'text_hash',
+                                               'len_text', 'redirect',
+                                               'is_fa', 'is_flist', 'is_ga',
+                                               'revert', 'seq'])
+
+# Position of revision text, sent as raw data (see comutils.send_batch)
+REVISION_TEXT = RevisionRecord._fields.index('text')
+
+
+def page_record(page):
+    """
+    Return record (list of values in PageRecord order) for a Page item
+    """
+    return [int(page['id']), int(page['ns']), page['title'],
+            page.get('restrictions'), page.get('seq')]
+
+
+def revision_record(rev):
+    """
+    Return record (list of values in RevisionRecord order) for a Revision
+    item
+    """
+    contrib_dict = rev['contrib_dict']
+    if not contrib_dict:
+        user, user_text = -1, None
+    elif 'ip' in contrib_dict:
+        user, user_text = 0, contrib_dict['ip']
+    else:
+        user, user_text = int(contrib_dict['id']), contrib_dict['username']
+
+    rev_parent_id = rev['rev_parent_id']
+    text_bytes = rev.get('text_bytes')
+    revert = rev.get('revert')
+    if revert is not None:
+        revert = [int(revert[0]), [int(rev_id) for rev_id in revert[1]]]
+    if 'text_hash' in rev:
+        text_fields = [rev['text_hash'], int(rev['len_text']),
+                       int(rev['redirect']), int(rev['is_fa']),
+                       int(rev['is_flist']), int(rev['is_ga'])]
+    else:
+        text_fields = [None] * 6
+    return ([int(rev['id']), int(rev['page_id']), int(rev['ns']),
+             rev['timestamp'],
+             int(rev_parent_id) if rev_parent_id is not None else None,
+             'minor' in rev, rev.get('comment'), user, user_text,
+             rev.get('text'), rev.get('sha1'),
+             int(text_bytes) if text_bytes is not None else None] +
+            text_fields + [revert, rev.get('seq')])
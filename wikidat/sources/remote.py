@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 25 11:32:10 2014
+
+Distributed ETL: revision workers running on other hosts.
+
+An ETL line in distributed mode (the coordinator) runs XML readers and
+loaders as usual, plus a Registry where workers on remote hosts register
+(see run_workers). Registered workers get the endpoints and options of a
+revision worker for the dump file being processed, so that they run just
+like local workers, and are counted with the revision workers of the line
+(see comutils.WorkerCount) once they confirm they can reach all channels.
+Remote workers do not need access to DB.
+
+@author: jfelipe
+"""
+import os
+import socket
+import time
+import multiprocessing as mp
+import ujson
+import zmq
+from processors import Processor
+from records import RevisionRecord
+from revision import process_revs_to_file
+
+# Seconds to wait for an answer of the coordinator to every registration
+REGISTER_TIMEOUT = 5
+# Seconds to wait before registering again, if the coordinator is not
+# accepting workers
+REGISTER_RETRY = 1
+# Seconds a registration waits for the confirmation of the worker, before
+# it is dropped
+CONFIRM_TIMEOUT = 30
+# Attempts of workers to confirm their registration, if the coordinator
+# does not answer
+CONFIRM_RETRIES = 5
+
+
+class Registry(mp.Process):
+    """
+    Registers remote revision workers for the dump file being processed by
+    an ETL line, on a channel bound to address (a fixed tcp endpoint, such
+    as tcp://*:9000).
+
+    Workers send a REGISTER message with their name. While XML readers
+    accept new workers (count is the comutils.WorkerCount of revision
+    workers), they are answered with OK and the options of their Processor
+    (worker_opts, with endpoints of all channels). Otherwise, they are
+    answered with WAIT, to register again later (e.g. for the next dump
+    file).
+
+    Registered workers are only counted when they send a CONFIRM message,
+    once they have checked that all channels are reachable, and before
+    connecting to them: XML readers and loaders wait for a STOP message
+    from every worker counted. Registrations not confirmed within
+    CONFIRM_TIMEOUT seconds are dropped. CONFIRM is answered with OK if the
+    worker is counted, and with WAIT if it must not run. Workers already
+    counted are answered with OK again if they repeat their messages (e.g.
+    after a lost answer). Malformed messages are ignored.
+    """
+    def __init__(self, name=None, count=None, worker_opts=None,
+                 address=None):
+        super(Registry, self).__init__(name=name)
+        self.count = count
+        self.worker_opts = worker_opts
+        self.address = address
+        self.done = mp.Event()
+
+    def run(self):
+        context = zmq.Context()
+        channel = context.socket(zmq.ROUTER)
+        channel.bind(self.address)
+        # Registrations waiting for confirmation, with their deadline
+        pending = {}
+        confirmed = set()
+        while not self.done.is_set():
+            now = time.time()
+            for name, deadline in pending.items():
+                if deadline < now:
+                    print "%s: registration of %s not confirmed" % (
+                          self.name, name)
+                    del pending[name]
+            if not channel.poll(500):
+                continue
+            frames = channel.recv_multipart()
+            # Requests of REQ sockets: identity, delimiter, message, name
+            if len(frames) != 4 or frames[1] != '':
+                print "%s: malformed request with %d frames" % (
+                      self.name, len(frames))
+                continue
+            identity, empty, message, name = frames
+            reply = ['WAIT']
+            if message == 'REGISTER':
+                # Workers already counted register again if the answer to
+                # their confirmation was lost
+                if name in confirmed or not self.count.closed.is_set():
+                    if name not in confirmed:
+                        pending[name] = time.time() + CONFIRM_TIMEOUT
+                    reply = ['OK', ujson.dumps(self.worker_opts)]
+            elif message == 'CONFIRM':
+                if name in confirmed:
+                    reply = ['OK']
+                elif name in pending and self.count.add():
+                    del pending[name]
+                    confirmed.add(name)
+                    print "%s: remote revision worker %s registered" % (
+                          self.name, name)
+                    reply = ['OK']
+            channel.send_multipart([identity, empty] + reply)
+        channel.close(linger=0)
+        context.term()
+
+    def stop(self):
+        """
+        Stop answering registrations, and wait for the registry to quit
+        """
+        self.done.set()
+        self.join()
+
+
+def request(context, coordinator, message, name, timeout=REGISTER_TIMEOUT):
+    """
+    Send message for revision worker with name to coordinator endpoint.
+    Return the frames of the answer, or None if it does not answer within
+    timeout seconds.
+    """
+    channel = context.socket(zmq.REQ)
+    channel.connect(coordinator)
+    channel.send_multipart([message, name])
+    answer = None
+    if channel.poll(timeout * 1000):
+        answer = channel.recv_multipart()
+    channel.close(linger=0)
+    return answer
+
+
+def register(context, coordinator, name):
+    """
+    Register revision worker with name at coordinator endpoint. Return
+    options for its Processor, or None if the coordinator is not accepting
+    workers (or does not answer).
+    """
+    answer = request(context, coordinator, 'REGISTER', name)
+    if answer is None or answer[0] != 'OK' or len(answer) != 2:
+        return None
+    opts = dict((str(key), value)
+                for key, value in ujson.loads(answer[1]).iteritems())
+    opts['kwargs'] = dict((str(key), value)
+                          for key, value in opts['kwargs'].iteritems())
+    return opts
+
+
+def confirm(context, coordinator, name, retries=CONFIRM_RETRIES):
+    """
+    Confirm registration of revision worker with name at coordinator
+    endpoint. Return True if the worker has been counted, so that it must
+    run, or False otherwise (e.g. registration dropped or XML readers
+    done). Unanswered confirmations are repeated up to retries times.
+    """
+    for attempt in range(retries):
+        answer = request(context, coordinator, 'CONFIRM', name)
+        if answer is not None:
+            return answer[0] == 'OK'
+    return False
+
+
+def reachable(opts, timeout=REGISTER_TIMEOUT):
+    """
+    Return True if all tcp channels that a revision worker connects to,
+    given the options of its Processor, accept connections from this host
+    """
+    for endpoint in opts['pull_ports'] + [opts['push_port']]:
+        host, port = endpoint.split('://', 1)[1].rsplit(':', 1)
+        try:
+            socket.create_connection((host, int(port)), timeout).close()
+        except socket.error:
+            return False
+    return True
+
+
+def run_workers(coordinator, workers=1, name=None, idle_timeout=None):
+    """
+    Run up to workers revision workers in this host for the ETL line at
+    coordinator endpoint (e.g. tcp://etl-host:9000), registering a new
+    one whenever there is a free slot. Workers are only started once the
+    coordinator has counted them, after checking that they can reach all
+    channels. Return once idle_timeout seconds pass without workers running
+    nor accepted (never, if None).
+    """
+    if name is None:
+        name = '%s-%d' % (socket.gethostname(), os.getpid())
+    context = zmq.Context()
+    running = []
+    registered = 0
+    last_active = time.time()
+    while True:
+        running = [process for process in running if process.is_alive()]
+        if running:
+            last_active = time.time()
+        if len(running) >= workers:
+            time.sleep(REGISTER_RETRY)
+            continue
+        worker_name = '%s_%d' % (name, registered)
+        opts = register(context, coordinator, worker_name)
+        if opts is not None and not reachable(opts):
+            print "channels of %s not reachable from this host" % coordinator
+            opts = None
+        if opts is not None and not confirm(context, coordinator,
+                                            worker_name):
+            opts = None
+        if opts is None:
+            if (idle_timeout is not None and not running and
+                    time.time() - last_active > idle_timeout):
+                break
+            time.sleep(REGISTER_RETRY)
+            continue
+        print "remote revision worker %s started" % worker_name
+        process = Processor(name=worker_name, target=process_revs_to_file,
+                            record=RevisionRecord, stage='rev_worker',
+                            **opts)
+        process.start()
+        running.append(process)
+        registered += 1
+    context.term()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 23 10:31:06 2014
+
+Detection of identity reverts while dump files are parsed. A revision is
+an identity revert if its text is identical to that of an earlier revision
+of the same page (reverted_to), other than its parent: all revisions in
+between are reverted by it.
+
+Revisions of every page are found in order, one page after another, by a
+single XML reader (chunks of dump files are page-aligned). Thus reverts are
+detected in the same pass that extracts revisions, keeping just a window of
+the latest revisions of the current page, instead of joining revision_hash
+with itself once the whole dump file is loaded.
+
+@author: jfelipe
+"""
+from collections import deque
+import hashlib
+
+
+def revision_key(rev_dict, trust_dump=False):
+    """
+    Return key identifying the text of a revision (fields of its XML
+    element), always of the same type in a parsing pass: with trust_dump,
+    the SHA-1 digest given by the dump file; otherwise its hash, if text
+    metadata was computed in metadata only mode, or the MD5 digest of its
+    text (an extra pass over the text in XML readers). Revisions with empty
+    or missing text (e.g. deleted), or without <sha1> with trust_dump, have
+    no key (None), so that they are never taken as identical.
+    """
+    if trust_dump:
+        if (not rev_dict.get('sha1') or
+                rev_dict.get('text_bytes') in ('0', 0)):
+            return None
+        return rev_dict['sha1']
+    if 'text_hash' in rev_dict:
+        if not int(rev_dict.get('len_text') or 0):
+            return None
+        return rev_dict['text_hash'] or None
+    text = rev_dict.get('text')
+    if not text:
+        return None
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.md5(text).digest()
+
+
+class RevertDetector(object):
+    """
+    Finds identity reverts among the revisions of a page, given in order.
+    Only reverts of up to radius revisions are detected: the window holds
+    the keys of the latest radius + 1 revisions of the page.
+
+    Revisions and reverts found are counted, and printed by parser backends
+    at the end (see report).
+    """
+    def __init__(self, radius=15):
+        self.radius = radius
+        self.window = deque(maxlen=radius + 1)
+        self.revisions = 0
+        self.reverts = 0
+        self.reverted = 0
+
+    def start_page(self):
+        """
+        Forget revisions of the previous page
+        """
+        self.window.clear()
+
+    def add(self, rev_id, key):
+        """
+        Register the next revision of the page, with the key of its text
+        (see revision_key). Returns [reverted_to, reverted] if it is an
+        identity revert, with the id of the revision it restores and the
+        list of ids of revisions reverted by it, or None otherwise.
+        """
+        self.revisions += 1
+        if key is None:
+            # Revisions without text are not reverted to, but they can be
+            # reverted
+            self.window.append((None, rev_id))
+            return None
+
+        revert = None
+        reverted = []
+        for prev_key, prev_id in reversed(self.window):
+            if prev_key == key:
+                if reverted:
+                    reverted.reverse()
+                    revert = [prev_id, reverted]
+                break
+            reverted.append(prev_id)
+        self.window.append((key, rev_id))
+
+        if revert is not None:
+            self.reverts += 1
+            self.reverted += len(reverted)
+        return revert
+
+    def report(self):
+        """
+        Return summary of reverts found
+        """
+        return ("reverts: %d revisions, %d identity reverts (%.2f%%), "
+                "%d revisions reverted, radius %d" % (
+                    self.revisions, self.reverts,
+                    (100. * self.reverts / self.revisions
+                     if self.revisions else 0.),
+                    self.reverted, self.radius))
+
+
+def revert_detector(radius):
+    """
+    Return a RevertDetector for reverts of up to radius revisions, or None
+    if radius is 0 (detection disabled)
+    """
+    if not radius:
+        return None
+    return RevertDetector(radius)
@@ -5,11 +5,15 @@ Created on Sat Mar 29 22:13:42 2014
 @author: jfelipe
 """
 import hashlib
+import re
 import time
+from collections import OrderedDict
 from wikidat.utils import maps
 from data_item import DataItem
 import csv
 import os
+from checkpoint import load_file_db
+from templates import TemplateDetector
 
 import logging
 
@@ -35,6 +39,264 @@ class Revision(DataItem):
         super(Revision, self).__init__(*args, **kwargs)
 
 
+# Max. number of users remembered by every revision worker and loader, to
+# skip rows of users already written to table people. Rows of the same
+# user loaded again just replace the previous one.
+USER_CACHE_SIZE = 1000000
+
+
+def new_user(users, user, user_text):
+    """
+    Return True if a registered user must be written to table people:
+    it is not in users dict (id -> username) yet, or it was stored without
+    username. The dict is updated, and cleared when it gets full.
+    """
+    if user <= 0:
+        return False
+    if user in users and (users[user] is not None or user_text is None):
+        return False
+    if len(users) >= USER_CACHE_SIZE:
+        users.clear()
+    users[user] = user_text
+    return True
+
+
+# Character classes with non-ASCII characters, which cannot be matched
+# as such in UTF-8 encoded text
+NON_ASCII_CLASS_RE = re.compile(ur'\[([^\]\\\-^]*[^\x00-\x7f][^\]\\\-^]*)\]')
+
+
+def bytes_pattern(pattern):
+    """
+    Return a compiled regular expression equivalent to pattern, that
+    searches UTF-8 encoded text (str) instead of unicode strings
+    """
+    if pattern is None:
+        return None
+    source = pattern.pattern
+    if isinstance(source, unicode):
+        source = NON_ASCII_CLASS_RE.sub(
+            lambda m: u'(?:%s)' % u'|'.join(m.group(1)), source)
+        source = source.encode('utf-8')
+    return re.compile(source, pattern.flags & ~re.UNICODE)
+
+
+def text_patterns(lang, detect_FA=True, detect_FLIST=True, detect_GA=True):
+    """
+    Return tuple of regular expressions (fa_pat, flist_pat, ga_pat) to
+    identify Featured Articles, Featured Lists and Good Articles in a given
+    language, in UTF-8 encoded text. Patterns not supported in that
+    language, or whose detection is disabled, are None.
+    """
+    if ((lang in maps.FA_RE) and (lang in maps.FLIST_RE) and
+            (lang in maps.GA_RE)):
+        fa_pat = maps.FA_RE[lang] if detect_FA else None
+        flist_pat = maps.FLIST_RE[lang] if detect_FLIST else None
+        ga_pat = maps.GA_RE[lang] if detect_GA else None
+    else:
+        raise RuntimeError('Unsupported language ' + lang)
+    return (bytes_pattern(fa_pat), bytes_pattern(flist_pat),
+            bytes_pattern(ga_pat))
+
+
+def text_detector(lang, detect_FA=True, detect_FLIST=True, detect_GA=True):
+    """
+    Return a templates.TemplateDetector for FA, FLIST and GA templates in
+    a given language (see text_patterns), or None if detection of all of
+    them is disabled or not supported.
+    """
+    patterns = text_patterns(lang, detect_FA=detect_FA,
+                             detect_FLIST=detect_FLIST, detect_GA=detect_GA)
+    if patterns == (None, None, None):
+        return None
+    return TemplateDetector(lang, patterns)
+
+
+class TextCache(object):
+    """
+    Bounded LRU cache of text fields of revisions (see text_fields), keyed
+    by digest of their text, holding up to size entries. Reverts and
+    identical revisions are not hashed nor scanned again.
+
+    Hits and lookups are counted, and published as counters text_cache_hits
+    and text_cache_lookups of the stage (see stats.StageStats.add_counters).
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.lookups = 0
+
+    def get(self, key):
+        """
+        Return fields cached for key (marked as most recently used), or None
+        """
+        self.lookups += 1
+        fields = self.entries.pop(key, None)
+        if fields is not None:
+            self.entries[key] = fields
+            self.hits += 1
+        return fields
+
+    def put(self, key, fields):
+        if len(self.entries) >= self.size:
+            self.entries.popitem(last=False)
+        self.entries[key] = fields
+
+    def counters(self):
+        return {'text_cache_hits': self.hits,
+                'text_cache_lookups': self.lookups}
+
+    def report(self):
+        """
+        Return summary of lookups and hit rate of the cache
+        """
+        return "text cache: %d lookups, %d hits (%.1f%%), %d entries" % (
+            self.lookups, self.hits,
+            100. * self.hits / self.lookups if self.lookups else 0.,
+            len(self.entries))
+
+
+def text_cache(size, stats=None):
+    """
+    Return a TextCache holding up to size entries (None if size is 0),
+    publishing its counters with stats of the stage, if given
+    """
+    if not size:
+        return None
+    cache = TextCache(size)
+    if stats is not None:
+        stats.add_counters(cache)
+    return cache
+
+
+# Hash types of revision text stored in table revision_hash: hex digest of
+# SHA-256, or SHA-1 in base 36 (the format of <sha1> in dump files)
+HASH_TYPES = ['sha256', 'sha1']
+
+BASE36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def text_digest(hasher, hash_type='sha256'):
+    """
+    Return digest of hasher (hashlib object of hash_type) in the format
+    stored for hash_type (see HASH_TYPES)
+    """
+    if hash_type == 'sha256':
+        return hasher.hexdigest()
+    # Same format as MediaWiki: base 36, zero padded to 31 digits
+    value = int(hasher.hexdigest(), 16)
+    digits = []
+    while value:
+        value, digit = divmod(value, 36)
+        digits.append(BASE36_DIGITS[digit])
+    return ''.join(reversed(digits)).rjust(31, '0')
+
+
+def hash_text(text, hash_type='sha256'):
+    """
+    Return hash of UTF-8 encoded text, of hash_type (see HASH_TYPES)
+    """
+    return text_digest(hashlib.new(hash_type, text), hash_type)
+
+
+def text_fields(text, main_ns=True, detector=None, cache=None, sha1=None,
+                text_bytes=None, hash_type='sha256', trust_dump=False):
+    """
+    Text-related operations for a revision: compute hash (of hash_type,
+    see HASH_TYPES) and length of revision text, detect REDIRECT and (for
+    the main namespace) FA, FLIST and GA templates, with detector (see
+    text_detector).
+
+    Revision text can be either unicode or UTF-8 encoded (str).
+
+    If a TextCache is given, fields are looked up by the SHA-1 digest of
+    the text in the dump file (sha1), skipping all work on a hit, or by
+    its hash if the dump file has no SHA-1 digests.
+
+    With trust_dump, the length is taken from the bytes attribute of the
+    text in the dump file (text_bytes) and, for hash type 'sha1', the hash
+    from its SHA-1 digest, if given. Text is then neither hashed nor
+    encoded, unless it must be scanned for templates.
+
+    Returns tuple (text_hash, len_text, redirect, is_fa, is_flist, is_ga),
+    with the digest of the hash, the length in bytes and 0/1 flags.
+    """
+    # TODO: Inspect why there are pages without text
+    # Default values to 0. These fields will be set below if any of the
+    # target patterns is detected
+    redirect = is_fa = is_flist = is_ga = 0
+
+    if text is None:
+        # Hash of empty text
+        return hash_text('', hash_type), 0, 0, 0, 0, 0
+
+    # Flags are only detected in the main namespace
+    key = None
+    if cache is not None and sha1 is not None:
+        key = (sha1, main_ns)
+        fields = cache.get(key)
+        if fields is not None:
+            return fields
+
+    # Length and hash given by the dump file
+    text_hash = len_text = None
+    if trust_dump:
+        if text_bytes is not None:
+            len_text = int(text_bytes)
+        if hash_type == 'sha1':
+            text_hash = sha1
+    scan = main_ns and detector is not None
+
+    if isinstance(text, unicode) and (text_hash is None or
+                                      len_text is None or scan):
+        text = text.encode('utf-8')
+    if text_hash is None:
+        text_hash = hash_text(text, hash_type)
+    if len_text is None:
+        len_text = len(text)
+
+    if cache is not None and key is None:
+        key = (text_hash, main_ns)
+        fields = cache.get(key)
+        if fields is not None:
+            return fields
+
+    # Detect pattern for redirect pages
+    if text[0:9].upper() == '#REDIRECT':
+        redirect = 1
+
+    # FA, FLIST and GA detection, in a single scan of the text
+    # Currently 39 languages are supported regarding FA detection
+    # We only enter pattern matching for revisions of pages in
+    # main namespace
+    if scan:
+        is_fa, is_flist, is_ga = detector.detect(text)
+
+    fields = (text_hash, len_text, redirect, is_fa, is_flist, is_ga)
+    if cache is not None:
+        cache.put(key, fields)
+    return fields
+
+
+def process_text(rev, detector=None, cache=None, hash_type='sha256',
+                 trust_dump=False):
+    """
+    Text-related operations for a revision (see text_fields). Fields
+    'len_text', 'redirect', 'is_fa', 'is_flist' and 'is_ga' are set in rev.
+
+    Returns hash of revision text, of hash_type.
+    """
+    fields = text_fields(rev['text'], main_ns=(rev['ns'] == '0'),
+                         detector=detector, cache=cache,
+                         sha1=rev.get('sha1'),
+                         text_bytes=rev.get('text_bytes'),
+                         hash_type=hash_type, trust_dump=trust_dump)
+    (text_hash, rev['len_text'], rev['redirect'], rev['is_fa'],
+     rev['is_flist'], rev['is_ga']) = [str(x) for x in fields]
+    return text_hash
+
+
 def process_revs(rev_iter, con=None, lang=None):
     """
     Process iterator of Revision objects extracted from dump files
@@ -254,144 +516,144 @@ def process_revs(rev_iter, con=None, lang=None):
         text_hash = None
 
 
-def process_revs_to_file(rev_iter, con=None, lang=None):
+def revert_rows(rev):
     """
-    Process iterator of Revision objects extracted from dump files
+    Return rows of table revert for a revision (records.RevisionRecord)
+    that is an identity revert: one row (rev_id, rev_page, rev_reverted_by,
+    rev_reverted_to) for every revision reverted by it
+    """
+    reverted_to, reverted = rev.revert
+    return [[rev_id, rev.page_id, rev.id, reverted_to]
+            for rev_id in reverted]
+
+
+def process_revs_to_file(rev_iter, con=None, lang=None, detect_FA=True,
+                         detect_FLIST=True, detect_GA=True,
+                         text_cache_size=10000, hash_type='sha256',
+                         trust_dump=False, stats=None):
+    """
+    Process iterator of revision records extracted from dump files
     :Parameters:
-        - rev_iter: iterator of Revision objects
+        - rev_iter: iterator of revisions (records.RevisionRecord)
         - lang: identifier of Wikipedia language edition from which this
         element comes from (e.g. frwiki, eswiki, dewiki...)
+        - detect_FA, detect_FLIST, detect_GA: enable detection of
+        Featured Articles, Featured Lists and Good Articles, respectively
+        - text_cache_size: max. number of texts whose fields are cached
+        (see TextCache), 0 to disable the cache
+        - hash_type: hash of revision text stored in table revision_hash
+        (see HASH_TYPES)
+        - trust_dump: take length and (for hash type 'sha1') hash of
+        revision text from the dump file, if given (see text_fields)
+        - stats: stats.StageStats of the worker, to publish counters of
+        the cache
+
+    Revisions extracted in metadata only mode come without text, but
+    with fields text_hash, len_text, redirect, is_fa, is_flist and is_ga
+    already computed by the XML reader.
+
+    Hits of every template and time spent detecting them, and the hit rate
+    of the text cache, are printed at the end.
+
+    Yielded tuples hold the values of the revision and revision_hash rows,
+    the (id, username) of registered users not seen before by this worker,
+    to fill table people (None otherwise), and the rows of table revert
+    for identity reverts found by XML readers (None otherwise, see
+    revert_rows). If revisions carry a sequence number for checkpoints, it
+    is appended as the last element.
     """
     # Get tags to identify Featured Articles, Featured Lists and
     # Good Articles
-    # lang = 'dewiki'
-    # new_user = False
-
-    if ((lang in maps.FA_RE) and (lang in maps.FLIST_RE) and
-            (lang in maps.GA_RE)):
-        fa_pat = maps.FA_RE[lang]
-        flist_pat = maps.FLIST_RE[lang]
-        ga_pat = maps.GA_RE[lang]
-    else:
-        raise RuntimeError('Unsupported language ' + lang)
+    detector = text_detector(lang, detect_FA=detect_FA,
+                             detect_FLIST=detect_FLIST, detect_GA=detect_GA)
+    # Fields of texts already processed, for reverts
+    cache = text_cache(text_cache_size, stats)
+    # Users already sent to the loader (id -> username)
+    users = {}
 
     for rev in rev_iter:
-        contrib_dict = rev['contrib_dict']
-
         # ### TEXT-RELATED OPERATIONS ###
-        # Calculate SHA-256 hash, length of revision text and check
-        # for REDIRECT
-        # TODO: Inspect why there are pages without text
-
-        # Stores SHA-256 hash of revision text
-        text_hash = hashlib.sha256()
-        # Default values to 0. These fields will be set below if any of the
-        # target patterns is detected
-        rev['redirect'] = '0'
-        rev['is_fa'] = '0'
-        rev['is_flist'] = '0'
-        rev['is_ga'] = '0'
-
-        if rev['text'] is not None:
-            text = rev['text'].encode('utf-8')
-            text_hash.update(text)
-            rev['len_text'] = str(len(text))
-
-            # Detect pattern for redirect pages
-            if rev['text'][0:9].upper() == '#REDIRECT':
-                rev['redirect'] = '1'
-
-            # FA and FList detection
-            # Currently 39 languages are supported regarding FA detection
-            # We only enter pattern matching for revisions of pages in
-            # main namespace
-            if rev['ns'] == '0':
-                if fa_pat is not None:
-                    mfa = fa_pat.search(rev['text'])
-                    # Case of standard language, one type of FA template
-                    if (mfa is not None and len(mfa.groups()) == 1):
-                        rev['is_fa'] = '1'
-                    # Case of fawiki or cawiki, 2 types of FA templates
-                    # Possible matches: (A, None) or (None, B)
-                    if lang == 'fawiki' or lang == 'cawiki':
-                        if (mfa is not None and len(mfa.groups()) == 2 and
-                                (mfa.groups()[1] is None or
-                                 mfa.groups()[0] is None)):
-                                    rev['is_fa'] = '1'
-
-                # Check if FLIST is supported in this language, detect if so
-                if flist_pat is not None:
-                    mflist = flist_pat.search(rev['text'])
-                    if mflist is not None and len(mflist.groups()) == 1:
-                        rev['is_flist'] = '1'
-
-                # Check if GA is supported in this language, detect if so
-                if ga_pat is not None:
-                    mga = ga_pat.search(rev['text'])
-                    if mga is not None and len(mga.groups()) == 1:
-                        rev['is_ga'] = '1'
-        # Compute hash for empty text here instead of in default block above
-        # This way, we avoid computing the hash twice for revisions with text
+        if rev.text_hash is not None:
+            text_hash, len_text = rev.text_hash, rev.len_text
+            redirect, is_fa, is_flist, is_ga = (rev.redirect, rev.is_fa,
+                                                rev.is_flist, rev.is_ga)
         else:
-            rev['len_text'] = '0'
-            text_hash.update('')
+            (text_hash, len_text, redirect, is_fa, is_flist,
+             is_ga) = text_fields(rev.text, main_ns=(rev.ns == 0),
+                                  detector=detector, cache=cache,
+                                  sha1=rev.sha1, text_bytes=rev.text_bytes,
+                                  hash_type=hash_type,
+                                  trust_dump=trust_dump)
 
-        # Default value is missing user
-        user = -1
-        if len(contrib_dict) > 0:
-            if 'ip' in contrib_dict:
-                user = 0
-                ip = contrib_dict['ip']
-            else:
-                user = int(contrib_dict['id'])
-                ip = u'NULL'
+        # IP address only for anonymous users
+        ip = rev.user_text if rev.user == 0 else u'NULL'
 
         # Tuple of revision values
-        rev_insert = (int(rev['id']), int(rev['page_id']), int(user),
-                      rev['timestamp'].replace('Z', '').replace('T', ' '),
-                      int(rev['len_text']),
-                      (int(rev['rev_parent_id'])
-                       if rev['rev_parent_id'] is not None else u'NULL'),
-                      int(rev['redirect']),
-                      (0 if 'minor' in rev else 1),
-                      int(rev['is_fa']), int(rev['is_flist']),
-                      int(rev['is_ga']),
-                      (rev['comment'] if 'comment' in rev and
-                       rev['comment'] is not None else u'NULL'),
+        rev_insert = (rev.id, rev.page_id, rev.user,
+                      rev.timestamp.replace('Z', '').replace('T', ' '),
+                      len_text,
+                      (rev.rev_parent_id
+                       if rev.rev_parent_id is not None else u'NULL'),
+                      redirect,
+                      (0 if rev.minor else 1),
+                      is_fa, is_flist, is_ga,
+                      (rev.comment if rev.comment is not None else u'NULL'),
                       ip,
                       )
 
         # Tuple of revision_hash values
-        rev_hash = (int(rev['id']), int(rev['page_id']), int(user),
-                    text_hash.hexdigest(),
-                    )
+        rev_hash = (rev.id, rev.page_id, rev.user, text_hash)
 
-        yield (rev_insert, rev_hash)
+        # New users for people table
+        user = None
+        if new_user(users, rev.user, rev.user_text):
+            user = (rev.user, rev.user_text)
 
-        rev = None
-        contrib_dict = None
-        text = None
-        text_hash = None
+        reverts = None
+        if rev.revert is not None:
+            reverts = revert_rows(rev)
+
+        if rev.seq is not None:
+            yield (rev_insert, rev_hash, user, reverts, rev.seq)
+        else:
+            yield (rev_insert, rev_hash, user, reverts)
+
+    if detector is not None and detector.scanned:
+        print detector.report()
+    if cache is not None and cache.lookups:
+        print cache.report()
 
 
 def store_revs_file_db(rev_iter, con=None, log_file=None,
                        tmp_dir=None, file_rows=1000000,
-                       etl_prefix=None):
+                       etl_prefix=None, checkpoint=None, chunks=None):
     """
     Processor to insert revision info in DB
 
     This version uses an intermediate temp data file to speed up bulk data
     loading in MySQL/MariaDB, using LOAD DATA INFILE.
 
+    Rows of new users in table people are loaded along with every file of
+    revisions, replacing those of the same users (loaded by other workers
+    or ETL lines), so that they are never loaded one at a time. So are the
+    rows of table revert, for identity reverts.
+
     Arguments:
-        - rev_iter: Iterator providing tuples (rev_insert, rev_hash_insert)
+        - rev_iter: Iterator providing tuples (rev_insert, rev_hash_insert,
+          user, reverts), see process_revs_to_file
         - con: Connection to local DB
         - log_file: Log file to track progress of data loading operations
         - tmp_dir: Directory to store temporary data files
         - file_rows: Number of rows to store in each tmp file
+        - checkpoint: Checkpoint (checkpoint.LoaderCheckpoint) updated after
+          every bulk data load, with the sequence numbers of loaded revisions
+        - chunks: List of chunk numbers marked as done in the checkpoint at
+          the end
     """
     insert_rows = 0
     total_revs = 0
+    seqs = []
+    all_loaded = True
 
     logging.basicConfig(filename=log_file, level=logging.DEBUG)
     logging.info("Starting parsing process...")
@@ -406,27 +668,55 @@ def store_revs_file_db(rev_iter, con=None, log_file=None,
                          TERMINATED BY '\t' ESCAPED BY '"'
                          LINES TERMINATED BY '\n'"""
 
+    insert_people = """LOAD DATA LOCAL INFILE '%s' REPLACE INTO TABLE people
+                       FIELDS OPTIONALLY ENCLOSED BY '"'
+                       TERMINATED BY '\t' ESCAPED BY '"'
+                       LINES TERMINATED BY '\n'"""
+
     path_file_rev = os.path.join(tmp_dir, etl_prefix + '_revision.csv')
     path_file_rev_hash = os.path.join(tmp_dir,
                                       etl_prefix + '_revision_hash.csv')
+    insert_revert = """LOAD DATA LOCAL INFILE '%s' INTO TABLE revert
+                       FIELDS OPTIONALLY ENCLOSED BY '"'
+                       TERMINATED BY '\t' ESCAPED BY '"'
+                       LINES TERMINATED BY '\n'"""
+
+    path_file_people = os.path.join(tmp_dir, etl_prefix + '_people.csv')
+    path_file_revert = os.path.join(tmp_dir, etl_prefix + '_revert.csv')
 
     # Delete previous versions of tmp files if present
     if os.path.isfile(path_file_rev):
         os.remove(path_file_rev)
     if os.path.isfile(path_file_rev_hash):
         os.remove(path_file_rev_hash)
-
-    for rev, rev_hash in rev_iter:
+    if os.path.isfile(path_file_people):
+        os.remove(path_file_people)
+    if os.path.isfile(path_file_revert):
+        os.remove(path_file_revert)
+    # Users already loaded, from all workers (id -> username)
+    users = {}
+
+    for item in rev_iter:
+        rev, rev_hash, user, reverts = item[0], item[1], item[2], item[3]
+        if len(item) > 4:
+            # Sequence number for checkpoints
+            seqs.append(item[4])
         total_revs += 1
 
         # Initialize new temp data file
         if insert_rows == 0:
             file_rev = open(path_file_rev, 'wb')
             file_rev_hash = open(path_file_rev_hash, 'wb')
+            file_people = open(path_file_people, 'wb')
+            file_revert = open(path_file_revert, 'wb')
             writer = csv.writer(file_rev, dialect='excel-tab',
                                 lineterminator='\n')
             writer2 = csv.writer(file_rev_hash, dialect='excel-tab',
                                  lineterminator='\n')
+            writer3 = csv.writer(file_people, dialect='excel-tab',
+                                 lineterminator='\n')
+            writer4 = csv.writer(file_revert, dialect='excel-tab',
+                                 lineterminator='\n')
 
         # Write data to tmp file
         try:
@@ -435,6 +725,16 @@ def store_revs_file_db(rev_iter, con=None, log_file=None,
 
             writer2.writerow([s.encode('utf-8') if isinstance(s, unicode)
                              else s for s in rev_hash])
+
+            if user is not None and new_user(users, user[0], user[1]):
+                people = (user[0],
+                          user[1] if user[1] is not None else u'NULL')
+                writer3.writerow([s.encode('utf-8')
+                                  if isinstance(s, unicode) else s
+                                  for s in people])
+
+            if reverts is not None:
+                writer4.writerows(reverts)
         except(Exception), e:
             print e
             print rev
@@ -445,8 +745,15 @@ def store_revs_file_db(rev_iter, con=None, log_file=None,
         if insert_rows == file_rows:
             file_rev.close()
             file_rev_hash.close()
-            con.send_query(insert_rev % path_file_rev)
-            con.send_query(insert_rev_hash % path_file_rev_hash)
+            file_people.close()
+            file_revert.close()
+            all_loaded &= load_file_db(con,
+                                       [insert_rev % path_file_rev,
+                                        insert_rev_hash % path_file_rev_hash,
+                                        insert_people % path_file_people,
+                                        insert_revert % path_file_revert],
+                                       checkpoint=checkpoint, seqs=seqs)
+            seqs = []
 
             logging.info("%s revisions %s." % (
                          total_revs,
@@ -457,12 +764,22 @@ def store_revs_file_db(rev_iter, con=None, log_file=None,
             # No need to delete tmp files, as they are empty each time we
             # open them again for writing
 
-    # Load remaining entries in last tmp files into DB
-    file_rev.close()
-    file_rev_hash.close()
-
-    con.send_query(insert_rev % path_file_rev)
-    con.send_query(insert_rev_hash % path_file_rev_hash)
+    # Load remaining entries in last tmp files into DB (if any, filters
+    # may discard all revisions)
+    if insert_rows > 0:
+        file_rev.close()
+        file_rev_hash.close()
+        file_people.close()
+        file_revert.close()
+
+        all_loaded &= load_file_db(con,
+                                   [insert_rev % path_file_rev,
+                                    insert_rev_hash % path_file_rev_hash,
+                                    insert_people % path_file_people,
+                                    insert_revert % path_file_revert],
+                                   checkpoint=checkpoint, seqs=seqs)
+    if checkpoint is not None and all_loaded:
+        checkpoint.finish(chunks)
     # Clean tmp files
 #    os.remove(path_file_rev)
 #    os.remove(path_file_rev_hash)
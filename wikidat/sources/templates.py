@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 26 10:14:25 2014
+
+Detection of FA, FLIST and GA templates in revision text, in a single
+pass over the text.
+
+Every pattern in maps.FA_RE, maps.FLIST_RE and maps.GA_RE matches a
+template, starting with '{{' followed by some literal characters (e.g.
+'{{[Ee]xzellent|'). These anchors of all patterns of a language are
+combined in a single regular expression, which is cheap to search for
+(no backtracking). Full patterns are only tried where an anchor is found,
+so that scanning a revision finds the same templates as searching for
+every pattern in the whole text.
+
+@author: jfelipe
+"""
+import re
+import sre_constants
+import sre_parse
+import time
+
+# Names of templates, in the order of flags returned by TemplateDetector
+TEMPLATES = ('FA', 'FLIST', 'GA')
+
+
+def _literal_regex(op, av):
+    """
+    Return a regular expression matching parsed item (op, av), if it only
+    matches a fixed set of strings (literals, sets of literals, or groups
+    and branches of them), or None otherwise
+    """
+    if op == sre_constants.LITERAL:
+        return re.escape(chr(av))
+    if op == sre_constants.IN:
+        if all(o == sre_constants.LITERAL for o, a in av):
+            return '[%s]' % ''.join(re.escape(chr(a)) for o, a in av)
+    elif op == sre_constants.SUBPATTERN:
+        return _literal_sequence(av[1])
+    elif op == sre_constants.BRANCH:
+        branches = [_literal_sequence(branch) for branch in av[1]]
+        if None not in branches:
+            return '(?:%s)' % '|'.join(branches)
+    return None
+
+
+def _literal_sequence(items):
+    pieces = [_literal_regex(op, av) for op, av in items]
+    if None in pieces:
+        return None
+    return ''.join(pieces)
+
+
+def _anchor_branches(items):
+    """
+    Return list of anchors (regular expressions without the leading '{{')
+    of a parsed pattern, one for every branch, or None if any branch does
+    not start with '{{'
+    """
+    if not items:
+        return None
+    op, av = items[0]
+    if op == sre_constants.SUBPATTERN:
+        return _anchor_branches(av[1])
+    if op == sre_constants.BRANCH:
+        branches = []
+        for branch in av[1]:
+            anchors = _anchor_branches(branch)
+            if anchors is None:
+                return None
+            branches.extend(anchors)
+        return branches
+
+    if list(items[:2]) != [(sre_constants.LITERAL, ord('{'))] * 2:
+        return None
+    # Longest run of items matching fixed strings, skipping any of them
+    # followed by a repeat (parsed as a single item with its repeat)
+    pieces = []
+    for op, av in items[2:]:
+        piece = _literal_regex(op, av)
+        if piece is None:
+            break
+        pieces.append(piece)
+    return [''.join(pieces)]
+
+
+def template_anchors(pattern):
+    """
+    Return list of anchors of every branch of a compiled pattern (see
+    _anchor_branches), or None if it cannot be anchored at '{{'. Only
+    patterns searching UTF-8 encoded text (str) can be anchored.
+    """
+    if (isinstance(pattern.pattern, unicode) or
+            pattern.flags & re.IGNORECASE):
+        return None
+    return _anchor_branches(list(sre_parse.parse(pattern.pattern,
+                                                 pattern.flags)))
+
+
+class TemplateDetector(object):
+    """
+    Detects FA, FLIST and GA templates of a language in UTF-8 encoded
+    text, given their patterns (see revision.text_patterns, None if
+    disabled or not supported). Patterns that cannot be anchored at '{{'
+    are searched in the whole text, as a fallback.
+
+    Keeps stats of revisions scanned, hits of every template and CPU time
+    spent scanning, summarized by report().
+    """
+    def __init__(self, lang, patterns):
+        self.lang = lang
+        self.patterns = patterns
+        # [(flag index, pattern)] tried where anchors match, or searched
+        self.anchored = []
+        self.searched = []
+        anchors = []
+        for index, pattern in enumerate(patterns):
+            if pattern is None:
+                continue
+            branches = template_anchors(pattern)
+            if branches is None:
+                self.searched.append((index, pattern))
+            else:
+                self.anchored.append((index, pattern))
+                anchors.extend(a for a in branches if a not in anchors)
+        # Only '{' is consumed by every match, so that no position where a
+        # template may start is skipped (e.g. '{{{')
+        self.anchor_re = None
+        if self.anchored:
+            self.anchor_re = re.compile(r'\{(?=\{(?:%s))' %
+                                        '|'.join(anchors))
+        self.scanned = 0
+        self.candidates = 0
+        self.hits = [0, 0, 0]
+        self.cpu_time = 0.0
+
+    def detect(self, text):
+        """
+        Return list of flags [is_fa, is_flist, is_ga] (0/1) for UTF-8
+        encoded text
+        """
+        start = time.clock()
+        flags = [0, 0, 0]
+        for index, pattern in self.searched:
+            if pattern.search(text) is not None:
+                flags[index] = 1
+        if self.anchor_re is not None:
+            pending = self.anchored
+            for match in self.anchor_re.finditer(text):
+                self.candidates += 1
+                pos = match.start()
+                found = [(index, pattern) for index, pattern in pending
+                         if pattern.match(text, pos) is not None]
+                if found:
+                    for index, pattern in found:
+                        flags[index] = 1
+                    pending = [item for item in pending if item not in found]
+                    if not pending:
+                        break
+        self.cpu_time += time.clock() - start
+        self.scanned += 1
+        for index in range(3):
+            self.hits[index] += flags[index]
+        return flags
+
+    def report(self):
+        """
+        Return a summary of detection stats
+        """
+        hits = ', '.join('%s %d (%.2f%%)' % (
+            name, self.hits[index],
+            (100. * self.hits[index] / self.scanned) if self.scanned else 0.)
+            for index, name in enumerate(TEMPLATES)
+            if self.patterns[index] is not None)
+        return ("templates %s: %d revisions scanned, %s, %d candidates, "
+                "%.3f s CPU" % (self.lang, self.scanned, hits,
+                                self.candidates, self.cpu_time))
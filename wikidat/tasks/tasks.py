@@ -14,6 +14,7 @@ processes with Wikipedia data:
 """
 
 from wikidat.sources.etl import PageRevisionETL
+from wikidat.sources.filters import ItemFilter
 from download import RevHistDownloader
 from wikidat.utils.dbutils import MySQLDB
 import multiprocessing as mp
@@ -56,22 +57,110 @@ class RevisionHistoryTask(Task):
         self.etl_lines = etl_lines
         self.etl_list = []
 
-    # TODO: include args detect_FA, detect_FLIST, detect_GA
-    # and implement flow control in process_revision
-    def execute(self, page_fan, rev_fan, page_cache_size, rev_cache_size,
+    def execute(self, xml_fan, page_fan, rev_fan, page_cache_size,
+                rev_cache_size,
                 host, port, db_name, db_user, db_passw, db_engine,
                 mirror, download_files,
-                base_ports, control_ports,
-                dumps_dir=None):
+                base_ports,
+                dumps_dir=None, read_buffer_size=4*1024*1024,
+                xml_parser='lxml', metadata_only=False,
+                detect_FA=True, detect_FLIST=True, detect_GA=True,
+                text_cache_size=10000, hash_type='sha256', trust_dump=False,
+                revert_radius=15, filter_namespaces=None, filter_page_ids=None,
+                filter_title=None, filter_date_start=None,
+                filter_date_end=None, resume=False, page_batch_size=1000,
+                rev_batch_size=100, page_batch_linger=100,
+                rev_batch_linger=100, page_codec='zlib1', rev_codec='zlib1',
+                codec_min_size=1024, transport='ipc', page_credit_window=2,
+                rev_credit_window=2, page_hwm=10, rev_hwm=10,
+                stats_interval=10, autoscale=False, rev_fan_min=1,
+                rev_fan_max=None, inline_max_size=32*1024*1024,
+                bind_host='127.0.0.1', public_host=None,
+                coordinator_port=None):
         """
         Run data retrieval and loading actions.
         Arguments:
+            - xml_fan = Number of XML readers parsing chunks of each dump
+              file in parallel
             - page_fan = Number of workers to fan out page elements parsing
             - rev_fan = Number of workers to fan out rev elements parsing
             - db_user = User name to connect to local database
             - db_passw = Password for database user
             - mirror = Base URL of site hosting XML dumps
+            - read_buffer_size = Size in bytes of read buffers for dump files
+            - xml_parser = Parser backend for dump files ('lxml' or 'expat')
+            - metadata_only = Compute revision text metadata in XML readers,
+              never sending revision text to revision workers
+            - detect_FA, detect_FLIST, detect_GA = Enable detection of
+              Featured Articles, Featured Lists and Good Articles
+            - text_cache_size = Max. number of distinct texts whose metadata
+              is cached, for reverts and identical revisions (0 to disable)
+            - hash_type = Hash of revision text ('sha256' or 'sha1', in
+              base 36 as in MediaWiki)
+            - trust_dump = Take length and (with 'sha1') hash of revision
+              text from the dump file, instead of computing them
+            - revert_radius = Max. number of revisions reverted by identity
+              reverts detected while parsing (0 to disable). Without
+              metadata_only nor trust_dump, XML readers hash the text of
+              every revision (MD5) for it
+            - filter_namespaces = Only load pages in these namespaces
+            - filter_page_ids = Only load pages in this (first, last) range
+              of page ids
+            - filter_title = Only load pages whose title matches this regexp
+            - filter_date_start, filter_date_end = Only load revisions saved
+              in this date window
+            - resume = Resume data loading from the last checkpoint of each
+              dump file, keeping the existing database
+            - page_batch_size, rev_batch_size = Max. number of pages and
+              revisions in each message between processes
+            - page_batch_linger, rev_batch_linger = Max. time (msec) to wait
+              for more pages and revisions before sending a message
+            - page_codec, rev_codec = Codec to compress messages with pages
+              and revisions (none, zlib1, zlib3, zlib6 or lzma)
+            - codec_min_size = Messages smaller than this (in bytes) are
+              not compressed
+            - transport = Channels between processes, either 'ipc' (Unix
+              domain sockets) or 'tcp' (loopback, using base_ports)
+            - base_ports = Base port of the tcp channels of every ETL line
+              (None to take ephemeral ports chosen by the OS)
+            - page_credit_window, rev_credit_window = Max. number of batches
+              of pages and revisions that every worker requests in advance
+              from each XML reader
+            - page_hwm, rev_hwm = Max. number of batches of pages and
+              revisions queued by every worker to the loader, and by the
+              loader from every worker
+            - stats_interval = Seconds between summaries of pipeline stats
+              (throughput, time blocked and queued items of every stage)
+              in the log of each dump file (0 to disable)
+            - autoscale = Start and retire revision workers according to
+              pipeline stats, starting with rev_fan workers
+            - rev_fan_min, rev_fan_max = Min. and max. number of revision
+              workers with autoscale (max. is the number of CPUs by
+              default)
+            - inline_max_size = Dump files with less than this (in bytes) of
+              uncompressed XML data, estimated for compressed files, are
+              processed in a single process, without the pipeline (0 to
+              disable)
+            - coordinator_port = Port where revision workers on other hosts
+              register with the first ETL line (next ones use the following
+              ports), enabling distributed mode (None to disable)
+            - bind_host, public_host = Interface where tcp channels are
+              bound (* for all), and host name used by workers to connect
+              to them (see etl.PageRevisionETL)
         """
+        # Build (and validate) item filter before any other action
+        item_filter = ItemFilter(namespaces=filter_namespaces,
+                                 page_ids=filter_page_ids,
+                                 title=filter_title,
+                                 date_start=filter_date_start,
+                                 date_end=filter_date_end)
+        if coordinator_port is not None and transport != 'tcp':
+            raise RuntimeError('Distributed mode (coordinator_port) '
+                               'requires tcp transport')
+        if base_ports and len(base_ports) < self.etl_lines:
+            raise RuntimeError('Got %d base ports for %d ETL lines' % (
+                               len(base_ports), self.etl_lines))
+
         if download_files:
             # TODO: Use proper logging module to track execution progress
             # Choose corresponding file downloader and etl wrapper
@@ -125,16 +214,21 @@ class RevisionHistoryTask(Task):
         print "paths: " + unicode(self.paths)
 
         # DB SCHEMA PREPARATION
-        db_create = MySQLDB(host=host, port=port, user=db_user,
-                            passwd=db_passw)
-        db_create.connect()
-        db_create.create_database(db_name)
-        db_create.close()
-        db_schema = MySQLDB(host=host, port=port, user=db_user,
-                            passwd=db_passw, db=db_name)
-        db_schema.connect()
-        db_schema.create_schema(engine=db_engine)
-        db_schema.close()
+        # When resuming, the database already holds data loaded before
+        # the last checkpoints, so it must not be recreated
+        if resume:
+            print "Resuming data loading in existing database %s" % db_name
+        else:
+            db_create = MySQLDB(host=host, port=port, user=db_user,
+                                passwd=db_passw)
+            db_create.connect()
+            db_create.create_database(db_name)
+            db_create.close()
+            db_schema = MySQLDB(host=host, port=port, user=db_user,
+                                passwd=db_passw, db=db_name)
+            db_schema.connect()
+            db_schema.create_schema(engine=db_engine)
+            db_schema.close()
 
         # Complete the queue of paths to be processed and STOP flags for
         # each ETL subprocess
@@ -148,13 +242,49 @@ class RevisionHistoryTask(Task):
         for x in range(self.etl_lines):
             new_etl = PageRevisionETL(name="ETL-process-%s" % x,
                                       paths_queue=paths_queue, lang=self.lang,
+                                      xml_fan=xml_fan,
                                       page_fan=page_fan, rev_fan=rev_fan,
                                       page_cache_size=page_cache_size,
                                       rev_cache_size=rev_cache_size,
+                                      read_buffer_size=read_buffer_size,
+                                      xml_parser=xml_parser,
+                                      metadata_only=metadata_only,
+                                      detect_FA=detect_FA,
+                                      detect_FLIST=detect_FLIST,
+                                      detect_GA=detect_GA,
+                                      text_cache_size=text_cache_size,
+                                      hash_type=hash_type,
+                                      trust_dump=trust_dump,
+                                      revert_radius=revert_radius,
+                                      item_filter=item_filter,
+                                      resume=resume,
+                                      page_batch_size=page_batch_size,
+                                      rev_batch_size=rev_batch_size,
+                                      page_batch_linger=page_batch_linger,
+                                      rev_batch_linger=rev_batch_linger,
+                                      page_codec=page_codec,
+                                      rev_codec=rev_codec,
+                                      codec_min_size=codec_min_size,
+                                      transport=transport,
+                                      page_credit_window=page_credit_window,
+                                      rev_credit_window=rev_credit_window,
+                                      page_hwm=page_hwm, rev_hwm=rev_hwm,
+                                      stats_interval=stats_interval,
+                                      autoscale=autoscale,
+                                      rev_fan_min=rev_fan_min,
+                                      rev_fan_max=rev_fan_max,
+                                      inline_max_size=inline_max_size,
+                                      db_host=host, db_port=port,
                                       db_name=db_name,
                                       db_user=db_user, db_passw=db_passw,
-                                      base_port=base_ports[x]+(20*x),
-                                      control_port=control_ports[x]+(20*x))
+                                      base_port=(base_ports[x]+(20*x)
+                                                 if base_ports else None),
+                                      bind_host=bind_host,
+                                      public_host=public_host,
+                                      coordinator_port=(
+                                          coordinator_port + x
+                                          if coordinator_port is not None
+                                          else None))
             self.etl_list.append(new_etl)
 
         print "ETL process for page and revision history defined OK."
@@ -176,7 +306,7 @@ class RevisionHistoryTask(Task):
         # TODO: This must also be tracked by official logging module
         print "Now creating primary key indexes in database tables."
         print "This may take a while..."
-        db_pks = MySQLDB(host='localhost', port=3306, user=db_user,
+        db_pks = MySQLDB(host=host, port=port, user=db_user,
                          passwd=db_passw, db=db_name)
         db_pks.connect()
         db_pks.create_pks()
@@ -4,19 +4,337 @@ Created on Thu May 29 00:33:50 2014
 
 @author: jfelipe
 """
+import multiprocessing as mp
+import time
 import ujson
 import zlib
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
+# Every message starts with a tag byte identifying the codec used to
+# compress it, so receivers decode messages from any channel without
+# further negotiation. The codec of each channel is chosen by its sender.
+TAG_NONE = 'n'
+TAG_ZLIB = 'z'
+TAG_LZMA = 'x'
 
-def send_ujson(socket, obj, flags=0):
+DECOMPRESSORS = {TAG_NONE: lambda data: data,
+                 TAG_ZLIB: zlib.decompress}
+if lzma is not None:
+    DECOMPRESSORS[TAG_LZMA] = lzma.decompress
+
+# Registry of codecs: name -> (tag, compress function)
+CODECS = {'none': (TAG_NONE, None),
+          'zlib1': (TAG_ZLIB, lambda data: zlib.compress(data, 1)),
+          'zlib3': (TAG_ZLIB, lambda data: zlib.compress(data, 3)),
+          'zlib6': (TAG_ZLIB, lambda data: zlib.compress(data, 6))}
+if lzma is not None:
+    CODECS['lzma'] = (TAG_LZMA,
+                      lambda data: lzma.compress(data, preset=0))
+
+# Messages smaller than this (in bytes) are not compressed by default
+MIN_SIZE = 1024
+
+
+class Codec(object):
+    """
+    Compresses messages sent through a channel with one of the registered
+    CODECS. Messages smaller than min_size bytes are sent uncompressed, as
+    well as messages that do not shrink after compression.
+
+    Keeps stats on CPU time spent on compression and bytes saved, to
+    choose the best codec for each channel empirically.
+    """
+    def __init__(self, name='zlib1', min_size=MIN_SIZE):
+        if name not in CODECS:
+            raise RuntimeError('Unknown codec %s (available: %s)' % (
+                               name, ', '.join(sorted(CODECS))))
+        self.name = name
+        self.tag, self.compress = CODECS[name]
+        self.min_size = min_size
+        self.messages = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+
+    def encode(self, data):
+        """
+        Return data compressed and prefixed with the tag byte of its codec
+        """
+        self.messages += 1
+        self.bytes_in += len(data)
+        if self.compress is not None and len(data) >= self.min_size:
+            start = time.clock()
+            z = self.compress(data)
+            self.cpu_time += time.clock() - start
+            if len(z) < len(data):
+                self.compressed += 1
+                self.bytes_out += len(z) + 1
+                return self.tag + z
+        self.bytes_out += len(data) + 1
+        return TAG_NONE + data
+
+    def report(self):
+        """
+        Return a summary of codec stats
+        """
+        saved = self.bytes_in - self.bytes_out
+        ratio = (100. * saved / self.bytes_in) if self.bytes_in else 0.
+        return ("codec %s: %d messages (%d compressed), %d bytes in, "
+                "%d bytes out, %d saved (%.1f%%), %.3f s CPU" % (
+                    self.name, self.messages, self.compressed,
+                    self.bytes_in, self.bytes_out, saved, ratio,
+                    self.cpu_time))
+
+
+def decode(message):
+    """
+    Return decompressed data from a message encoded by any Codec
+    """
+    try:
+        decompress = DECOMPRESSORS[message[:1]]
+    except KeyError:
+        raise RuntimeError('Unknown codec tag in message: %r' % message[:1])
+    return decompress(message[1:])
+
+
+def send_ujson(socket, obj, flags=0, codec=None):
     """Serialize object using ultra-fast ujson"""
     m = ujson.dumps(obj)
-    z = zlib.compress(m)
+    if codec is None:
+        z = TAG_NONE + m
+    else:
+        z = codec.encode(m)
     return socket.send(z, flags=flags)
 
 
 def recv_ujson(socket, flags=0):
     """Load object from ujson serialization"""
     z = socket.recv(flags)
-    m = zlib.decompress(z)
+    m = decode(z)
     return ujson.loads(m)
+
+
+def send_batch(socket, items, flags=0, codec=None, raw_index=None,
+               stats=None):
+    """
+    Send a list of items (lists of values) as a multipart message. If
+    raw_index is given, the values at that position in all items (unicode
+    or UTF-8 encoded strings, or None) are joined in a single raw frame
+    after the ujson serialized items, so they are never escaped. Items keep
+    the length of their value at that position. The raw frame is compressed
+    as a whole, so that redundancy between consecutive values (e.g.
+    revisions of the same page) is not lost.
+
+    If stats (see stats.StageStats) is given, items and bytes sent and time
+    blocked on sending are added to it.
+    """
+    values = []
+    if raw_index is not None:
+        for item in items:
+            value = item[raw_index]
+            if value is not None:
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                values.append(value)
+                item[raw_index] = len(value)
+    m = ujson.dumps(items)
+    frames = [codec.encode(m) if codec is not None else TAG_NONE + m]
+    if values:
+        raw = ''.join(values)
+        frames.append(str(raw_index))
+        frames.append(codec.encode(raw) if codec is not None
+                      else TAG_NONE + raw)
+    if stats is None:
+        return socket.send_multipart(frames, flags=flags)
+    start = time.time()
+    result = socket.send_multipart(frames, flags=flags)
+    stats.sent(len(items), sum(len(frame) for frame in frames),
+               time.time() - start)
+    return result
+
+
+def recv_batch(socket, flags=0, stats=None):
+    """
+    Receive a list of items sent by send_batch, or a single object sent by
+    send_ujson (such as 'STOP'). Raw values are UTF-8 encoded strings (str).
+
+    If stats (see stats.StageStats) is given, items and bytes received and
+    time blocked on receiving are added to it.
+    """
+    start = time.time()
+    frames = socket.recv_multipart(flags)
+    wait = time.time() - start
+    items = ujson.loads(decode(frames[0]))
+    if len(frames) > 1:
+        raw_index = int(frames[1])
+        raw = decode(frames[2])
+        offset = 0
+        for item in items:
+            length = item[raw_index]
+            if length is not None:
+                item[raw_index] = raw[offset:offset+length]
+                offset += length
+    if stats is not None:
+        stats.received(len(items) if isinstance(items, list) else 0,
+                       sum(len(frame) for frame in frames), wait)
+    return items
+
+
+class BatchSender(object):
+    """
+    Packs items sent to a socket in batches (lists of items), each one
+    serialized as a single message. A batch is sent when it holds
+    batch_size items, or when linger milliseconds have passed since its
+    first item was added. Call flush() to send pending items at any time.
+
+    Messages are compressed with codec (a Codec instance), if given.
+    Values at position raw_index of items, if given, are sent as raw data
+    (see send_batch). Sent batches are counted in stats, if given.
+    """
+    def __init__(self, socket, batch_size=1, linger=0, codec=None,
+                 raw_index=None, stats=None):
+        self.socket = socket
+        self.batch_size = batch_size
+        self.linger = linger / 1000.
+        self.codec = codec
+        self.raw_index = raw_index
+        self.stats = stats
+        self.items = []
+        self.first_time = None
+
+    def send(self, item):
+        items = self.items
+        items.append(item)
+        if len(items) == 1:
+            self.first_time = time.time()
+        if (len(items) >= self.batch_size or
+                time.time() - self.first_time >= self.linger):
+            self.flush()
+
+    def pending(self):
+        """
+        Return True if some items are waiting to be sent
+        """
+        return len(self.items) > 0
+
+    def flush(self):
+        if self.items:
+            send_batch(self.socket, self.items, codec=self.codec,
+                       raw_index=self.raw_index, stats=self.stats)
+            self.items = []
+
+
+class RequestChannel(object):
+    """
+    Sends messages through a ROUTER socket only to workers that have asked
+    for them. Workers (DEALER sockets) send a request (one credit) for each
+    message they are ready to receive, up to a fixed window of credits, so
+    that sending blocks until some worker has room for more messages, and no
+    message is lost because workers are not connected yet.
+
+    A worker retires by sending a BYE request instead of renewing its
+    credits: it is answered with an in-band STOP message, after all
+    messages it had already requested. stop() answers the next request of
+    every other worker with STOP, once all data has been sent.
+
+    workers is the number of workers, or a WorkerCount shared with other
+    processes if workers may join while messages are being sent.
+    """
+    def __init__(self, socket, workers):
+        self.socket = socket
+        self.workers = workers
+        # Workers already sent a STOP message
+        self.stopped = set()
+        self.message_stop = TAG_NONE + ujson.dumps('STOP')
+
+    def send(self, data, flags=0):
+        return self.send_multipart([data], flags=flags)
+
+    def send_multipart(self, frames, flags=0):
+        while True:
+            identity, request = self.socket.recv_multipart()
+            if identity in self.stopped:
+                # Credits left by retired workers
+                continue
+            if request == 'BYE':
+                self.socket.send_multipart([identity, self.message_stop])
+                self.stopped.add(identity)
+                continue
+            return self.socket.send_multipart([identity] + frames,
+                                              flags=flags)
+
+    def stop(self):
+        """
+        Send STOP to all workers, each one after its last message. Other
+        credits of workers already stopped are discarded.
+        """
+        if isinstance(self.workers, WorkerCount):
+            # No more workers may join from now on
+            self.workers.close()
+        while len(self.stopped) < int(self.workers):
+            identity, request = self.socket.recv_multipart()
+            if identity not in self.stopped:
+                self.socket.send_multipart([identity, self.message_stop])
+                self.stopped.add(identity)
+
+
+class WorkerCount(object):
+    """
+    Number of workers of a stage, shared by all processes of an ETL line
+    (created before they are started), for stages whose workers are
+    added while the line is running (see autoscale.Autoscaler). Workers
+    can only be added until the first producer closes the count, before
+    sending its STOP messages, so that every worker receives STOP from all
+    producers.
+    """
+    def __init__(self, workers):
+        self.count = mp.Value('i', workers)
+        self.closed = mp.Event()
+
+    def __int__(self):
+        return self.count.value
+
+    def add(self):
+        """
+        Add one worker, return False if the count is already closed
+        """
+        with self.count.get_lock():
+            if self.closed.is_set():
+                return False
+            self.count.value += 1
+            return True
+
+    def close(self):
+        with self.count.get_lock():
+            self.closed.set()
+
+
+class AckChannel(object):
+    """
+    Receives messages sent by workers (DEALER sockets) through a ROUTER
+    socket, so that their STOP messages can be acknowledged. Workers must
+    wait for this acknowledgement before quitting: with ipc transport,
+    messages still in transit when a worker disconnects may be lost if the
+    receive queue is at its high-water mark.
+    """
+    def __init__(self, socket):
+        self.socket = socket
+        self.identity = None
+
+    def recv_multipart(self, flags=0):
+        frames = self.socket.recv_multipart(flags)
+        self.identity = frames[0]
+        return frames[1:]
+
+    def ack(self):
+        """
+        Acknowledge the last message received to its sender
+        """
+        self.socket.send_multipart([self.identity, 'ACK'])
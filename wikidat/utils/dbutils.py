@@ -81,6 +81,8 @@ class MySQLDB(object):
         self.send_query(bs.create_revision.format(**params))
         self.send_query(bs.drop_revision_hash)
         self.send_query(bs.create_revision_hash.format(**params))
+        self.send_query(bs.drop_revert)
+        self.send_query(bs.create_revert.format(**params))
         self.send_query(bs.drop_namespaces)
         self.send_query(bs.create_namespaces.format(**params))
         self.send_query(bs.drop_people)
@@ -98,8 +100,6 @@ class MySQLDB(object):
         self.send_query(bs.pk_revision)
         print "Creating primary key for table namespaces..."
         self.send_query(bs.pk_namespaces)
-        print "Creating primary key for table people..."
-        self.send_query(bs.pk_people)
         print "Creating primary key for table logging..."
         self.send_query(bs.pk_logging)
 
@@ -107,6 +107,7 @@ class MySQLDB(object):
         """
         Send query to DB. Attempt 'ntimes' consecutive times before giving up
         query: query to be sent to DB
+        Returns True if the query was executed without errors.
         """
         # TODO: Handle errors properly with logger library
         #chances = 0
@@ -123,6 +124,14 @@ class MySQLDB(object):
                 # capture and log DB exceptions adequately using
                 # Python logger
                 print "Exception in send_query method: ", e
+                return False
+        return True
+
+    def commit(self):
+        """
+        Commit current transaction (no effect on non-transactional engines)
+        """
+        self.con.commit()
 
     def insert_many(self, query_template, values):
         """
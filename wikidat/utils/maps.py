@@ -27,6 +27,19 @@ A regular expression for extracting the final extension of a file.
 """
 EXT_RE = re.compile(r'\.([^\.]+)$')
 
+"""
+Upper estimates of the ratio of uncompressed (XML) size to compressed size
+of dump files, for every file extension. Revision history dumps compress
+far better than dumps with only the last revision of each page.
+"""
+COMPRESSION_RATIOS = {
+    'xml': 1,
+    'bz2': 40,
+    '7z': 150,
+    'lzma': 150,
+    'gz': 20
+}
+
 """
 List of regular expressions for detection of Featured Articles,
 Featured Lists (if they exist in that language) and Good Articles
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 22 11:40:18 2014
+
+Live metrics of the ETL pipeline. Every stage (XML readers, workers and
+loaders) counts items and bytes received and sent, and time blocked on
+receiving and sending. The rest of its time is spent in its target
+function (parsing, processing items or loading them in DB).
+
+Stages publish snapshots of their counters on a stats channel every few
+seconds. The ETL process collects them with a PipelineMonitor, which logs
+a summary for every group of stages, so that the bottleneck of the
+pipeline can be found while it runs.
+
+@author: jfelipe
+"""
+import time
+import zmq
+from wikidat.utils.comutils import send_ujson, recv_ujson
+
+# Groups of stages, in pipeline order
+STAGES = ['xml_reader', 'page_worker', 'rev_worker', 'page_loader',
+          'rev_loader']
+
+# Queues between groups of stages: (upstream, channel, downstream), where
+# channel is the name of the output channel of upstream stages (None for
+# all their output)
+QUEUES = [('xml_reader', 'pages', 'page_worker'),
+          ('xml_reader', 'revisions', 'rev_worker'),
+          ('page_worker', None, 'page_loader'),
+          ('rev_worker', None, 'rev_loader')]
+
+COUNTERS = ['items_in', 'items_out', 'bytes_in', 'bytes_out', 'recv_wait',
+            'send_wait', 'elapsed']
+
+# Hit rates of caches in targets of stages (see StageStats.add_counters), as
+# (label, hits counter, lookups counter)
+HIT_RATES = [('text cache', 'text_cache_hits', 'text_cache_lookups')]
+
+
+class StageStats(object):
+    """
+    Counters of a pipeline stage. If a socket is given, a snapshot of all
+    counters is published through it every interval seconds (checked
+    whenever items are received or sent), and when the stage is closed.
+    Snapshots are dropped, never queued, if the stats channel is full.
+
+    Targets of stages may add their own counters (see add_counters).
+    """
+    def __init__(self, stage, name, socket=None, interval=10):
+        self.stage = stage
+        self.name = name
+        self.socket = socket
+        self.interval = interval
+        self.items_in = 0
+        self.items_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.recv_wait = 0.
+        self.send_wait = 0.
+        # Items sent through each named output channel
+        self.channels = {}
+        # Sources of counters of the target of the stage
+        self.sources = []
+        self.start = time.time()
+        self.next_publish = self.start + interval
+
+    def channel(self, name):
+        """
+        Return counters for items sent through output channel name
+        """
+        self.channels[name] = 0
+        return ChannelStats(self, name)
+
+    def add_counters(self, source):
+        """
+        Include counters of source in snapshots: source.counters() returns
+        a dict {counter: value}, with values growing over time
+        """
+        self.sources.append(source)
+
+    def received(self, items, nbytes, wait=0.):
+        self.items_in += items
+        self.bytes_in += nbytes
+        self.recv_wait += wait
+        self.tick()
+
+    def sent(self, items, nbytes, wait=0., channel=None):
+        self.items_out += items
+        self.bytes_out += nbytes
+        self.send_wait += wait
+        if channel is not None:
+            self.channels[channel] += items
+        self.tick()
+
+    def tick(self):
+        if self.socket is not None and time.time() >= self.next_publish:
+            self.publish()
+
+    def snapshot(self, done=False):
+        """
+        Return dict with current values of all counters
+        """
+        snapshot = dict((counter, getattr(self, counter))
+                        for counter in COUNTERS[:-1])
+        extra = {}
+        for source in self.sources:
+            extra.update(source.counters())
+        snapshot.update(stage=self.stage, name=self.name,
+                        channels=self.channels, extra=extra, done=done,
+                        elapsed=time.time() - self.start)
+        return snapshot
+
+    def publish(self, done=False):
+        self.next_publish = time.time() + self.interval
+        try:
+            send_ujson(self.socket, self.snapshot(done), flags=zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+
+    def close(self):
+        """
+        Publish final snapshot of counters and close stats socket
+        """
+        if self.socket is not None:
+            self.publish(done=True)
+            self.socket.close(linger=1000)
+            self.socket = None
+
+
+class ChannelStats(object):
+    """
+    Counters of items sent by a stage through one of its output channels
+    """
+    def __init__(self, stats, channel):
+        self.stats = stats
+        self.channel = channel
+
+    def sent(self, items, nbytes, wait=0.):
+        self.stats.sent(items, nbytes, wait, channel=self.channel)
+
+
+def stage_stats(context, stage, name, address=None, interval=10):
+    """
+    Return StageStats for a stage, publishing its snapshots to address
+    (if not None and interval is not 0)
+    """
+    socket = None
+    if address is not None and interval:
+        socket = context.socket(zmq.PUSH)
+        socket.setsockopt(zmq.SNDHWM, 100)
+        socket.connect(address)
+    return StageStats(stage, name, socket, interval)
+
+
+class PipelineMonitor(object):
+    """
+    Collects snapshots published by all stages of the pipeline on a stats
+    channel bound to address, and logs a summary of every group of stages
+    every interval seconds: throughput, % of time blocked on receiving
+    (starved) and sending (backpressure) and busy in its target, and items
+    queued between groups of stages.
+
+    Stages that are busy most of the time, while upstream stages are
+    blocked on sending and downstream ones on receiving, are the
+    bottleneck.
+
+    Stages publish to endpoint, the address actually bound (address may
+    take an ephemeral port, like tcp://127.0.0.1:*).
+    """
+    def __init__(self, context, address, interval=10, logger=None):
+        self.socket = context.socket(zmq.PULL)
+        self.socket.bind(address)
+        self.endpoint = self.socket.getsockopt(zmq.LAST_ENDPOINT)
+        self.interval = interval
+        self.logger = logger
+        # Latest snapshot of every stage, and the one of last summary
+        self.latest = {}
+        self.previous = {}
+
+    def watch(self, processes, callback=None):
+        """
+        Collect snapshots until all processes have finished, logging a
+        summary every interval seconds. If given, callback is called with
+        the counters of every group of stages (see groups) after each
+        summary, and it may add new processes to the list. The last summary
+        (totals of the whole run) is returned.
+        """
+        next_summary = time.time() + self.interval
+        while any(process.is_alive() for process in processes):
+            if self.socket.poll(500):
+                self.collect()
+            if time.time() >= next_summary:
+                groups = self.groups(self.previous)
+                self.log(self.summary(groups))
+                if callback is not None:
+                    callback(groups)
+                self.previous = dict(self.latest)
+                next_summary = time.time() + self.interval
+        # Final snapshots sent by stages before quitting
+        while self.socket.poll(100):
+            self.collect()
+        lines = self.summary(self.groups())
+        self.log(lines)
+        return lines
+
+    def collect(self):
+        while True:
+            try:
+                snapshot = recv_ujson(self.socket, zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.latest[snapshot['name']] = snapshot
+
+    def log(self, lines):
+        if self.logger is not None:
+            for line in lines:
+                self.logger.info(line)
+
+    def groups(self, previous=None):
+        """
+        Return dict with counters of every group of stages since snapshots
+        in previous (or totals, if not given), and % of time blocked on
+        receiving (recv), sending (send) and busy in the target (busy)
+        """
+        previous = previous if previous is not None else {}
+        groups = {}
+        for name, snapshot in self.latest.iteritems():
+            group = groups.setdefault(snapshot['stage'],
+                                      dict((c, 0) for c in COUNTERS))
+            group['stages'] = group.get('stages', 0) + 1
+            group['done'] = group.get('done', 0) + snapshot['done']
+            group.setdefault('updated', 0)
+            before = previous.get(name, {})
+            # Stages blocked (or busy in their target) for the whole
+            # period publish no new snapshots
+            if snapshot['elapsed'] == before.get('elapsed'):
+                continue
+            group['updated'] += 1
+            for counter in COUNTERS:
+                group[counter] += snapshot[counter] - before.get(counter, 0)
+            extra = group.setdefault('extra', {})
+            for counter, value in snapshot['extra'].iteritems():
+                extra[counter] = (extra.get(counter, 0) + value -
+                                  before.get('extra', {}).get(counter, 0))
+
+        for group in groups.itervalues():
+            if group['updated']:
+                # Each stage of the group contributes its own elapsed time
+                elapsed = group['elapsed']
+                group['seconds'] = elapsed / group['updated']
+                group['recv'] = 100. * group['recv_wait'] / elapsed
+                group['send'] = 100. * group['send_wait'] / elapsed
+                group['busy'] = max(100. - group['recv'] - group['send'], 0.)
+        return groups
+
+    def queued(self):
+        """
+        Return dict with number of items queued for every group of stages
+        (sent by upstream stages, but not received yet)
+        """
+        queued = {}
+        stages = set(s['stage'] for s in self.latest.itervalues())
+        for upstream, channel, downstream in QUEUES:
+            if upstream not in stages or downstream not in stages:
+                continue
+            sent = sum((s['channels'].get(channel, 0) if channel is not None
+                        else s['items_out'])
+                       for s in self.latest.itervalues()
+                       if s['stage'] == upstream)
+            received = sum(s['items_in'] for s in self.latest.itervalues()
+                           if s['stage'] == downstream)
+            # Snapshots of stages are taken at different times
+            queued[downstream] = max(sent - received, 0)
+        return queued
+
+    def summary(self, groups):
+        """
+        Return lines summarizing counters of groups of stages (see groups)
+        """
+        lines = []
+        busiest = None
+        for stage in STAGES:
+            if stage not in groups:
+                continue
+            g = groups[stage]
+            if not g['updated']:
+                lines.append("%s x%d (%d done): no updates" % (
+                             stage, g['stages'], g['done']))
+                continue
+            if busiest is None or g['busy'] > busiest[1]:
+                busiest = (stage, g['busy'])
+            lines.append("%s x%d (%d done): in %d (%.0f/s), out %d (%.0f/s), "
+                         "%.1f MB in, %.1f MB out, recv wait %.0f%%, "
+                         "send wait %.0f%%, busy %.0f%%" % (
+                             stage, g['stages'], g['done'], g['items_in'],
+                             g['items_in'] / g['seconds'], g['items_out'],
+                             g['items_out'] / g['seconds'],
+                             g['bytes_in'] / 1048576.,
+                             g['bytes_out'] / 1048576., g['recv'], g['send'],
+                             g['busy']))
+            extra = g.get('extra', {})
+            for label, hits, lookups in HIT_RATES:
+                if extra.get(lookups):
+                    lines.append("%s %s: %d lookups, hit rate %.1f%%" % (
+                                 stage, label, extra[lookups],
+                                 100. * extra[hits] / extra[lookups]))
+
+        queued = self.queued()
+        if queued:
+            lines.append("queued items: " + ", ".join(
+                         "%s %d" % (stage, queued[stage])
+                         for stage in STAGES if stage in queued))
+        if busiest is not None:
+            lines.append("busiest stage: %s (%.0f%% busy)" % busiest)
+        return lines
+
+    def close(self):
+        self.socket.close(linger=0)
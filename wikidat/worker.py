@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 25 12:05:37 2014
+
+Runs revision workers of WikiDAT on this host, for an ETL line running in
+distributed mode on another host (see option coordinator_port in main.py).
+Workers register with the ETL line for every dump file it processes, and
+connect straight to its XML readers and loaders. No access to DB is
+needed.
+
+Example: python -m wikidat.worker tcp://etl-host:9000 --workers 8
+
+@author: jfelipe
+"""
+
+import argparse
+import multiprocessing as mp
+from wikidat.sources.remote import run_workers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+    parser.add_argument('coordinator', metavar='ENDPOINT',
+                        help=''.join(['Endpoint of the ETL line, such as ',
+                                      'tcp://etl-host:9000 (coordinator_port ',
+                                      'of the ETL line).']))
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(),
+                        metavar='N',
+                        help=''.join(['Max. number of revision workers ',
+                                      'running at the same time (number of ',
+                                      'CPUs by default).']))
+    parser.add_argument('--name', metavar='NAME',
+                        help=''.join(['Prefix of names of workers (host name ',
+                                      'and process id by default).']))
+    parser.add_argument('--idle_timeout', type=int, metavar='SECONDS',
+                        help=''.join(['Quit after this number of seconds ',
+                                      'without workers running nor accepted ',
+                                      'by the ETL line (run forever by ',
+                                      'default).']))
+    args = parser.parse_args()
+
+    run_workers(args.coordinator, workers=args.workers, name=args.name,
+                idle_timeout=args.idle_timeout)